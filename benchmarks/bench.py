@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""
+Benchmarks of mimclib, timed against the baselines in baselines.json.
+
+    python benchmarks/bench.py                 # Run all quick benchmarks
+    python benchmarks/bench.py -full           # Include the large sets
+    python benchmarks/bench.py -filter GetIndexSet
+    python benchmarks/bench.py -update         # Store results as baselines
+
+The database benchmarks use an SQLite file in the temporary directory, or
+the MySQL server given by -db_engine mysql -db_host ... when available.
+
+Every benchmark runs in its own process, so that its peak memory (the
+growth of the maximum resident set size while setting up and running the
+benchmark) is not affected by the others. The reported time is the minimum
+over -repeat runs. A benchmark is flagged as a regression if its time or
+peak memory exceeds the baseline by more than -tolerance (relative, plus
+-min_time seconds or 1MB), and the script then exits with status 1.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import re
+import json
+import math
+import time
+import argparse
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+__dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(__dir, ".."))
+
+BASELINES = os.path.join(__dir, "baselines.json")
+# Fixed limits on the time in seconds of some benchmarks, which are flagged
+# as regressions when exceeded regardless of the baselines. The import
+# benchmarks time the whole python -c "import ..." in a fresh interpreter
+BUDGETS = {"import.mimclib.mimc": 0.05}
+__benchmarks = OrderedDict()
+
+
+def benchmark(fn):
+    # fn(args) yields (name, make, full) where make() does the setup and
+    # returns the function to time. full benchmarks only run with -full
+    __benchmarks[fn.__name__] = fn
+    return fn
+
+
+class Elapsed(float):
+    # Returned by benchmarks that measure their own time
+    pass
+
+
+class Rows(int):
+    # Returned by benchmarks that process this many rows, whose rate in
+    # rows per second is then reported
+    pass
+
+
+def _time_import(module):
+    # Wall time of python -c "import module" in a fresh interpreter,
+    # including the start up of the interpreter and the import of numpy,
+    # as seen by a script that uses mimclib
+    tic = time.time()
+    subprocess.check_call([sys.executable, "-c", "import {}".format(module)],
+                          cwd=os.path.join(__dir, ".."))
+    return time.time() - tic
+
+
+@benchmark
+def import_time(args):
+    for module in ["mimclib.mimc", "mimclib.setutil", "mimclib.test",
+                   "mimclib.plot"]:
+        def make(module=module):
+            return lambda: Elapsed(_time_import(module))
+        yield "import." + module, make, False
+
+
+def _td_degree(d, count):
+    # Smallest degree of a total degree set in d dimensions with at least
+    # count indices
+    L = 0
+    while math.factorial(L+d) // (math.factorial(L)*math.factorial(d)) < count:
+        L += 1
+    return L
+
+
+def _prof_calculators(d):
+    from mimclib import setutil
+    return OrderedDict([
+        ("aniso", lambda: setutil.AnisoProfCalculator(np.zeros(d), np.ones(d))),
+        ("misc", lambda: setutil.MISCProfCalculator(0.5*np.ones(d), 0.5*np.ones(d),
+                                                    np.zeros(0), np.zeros(0)))])
+
+
+@benchmark
+def get_index_set(args):
+    for d in [2, 5, 10, 20]:
+        for count in [10**3, 10**4, 10**5, 10**6]:
+            for calc_name, fnCalc in _prof_calculators(d).items():
+                def make(fnCalc=fnCalc, L=_td_degree(d, count)):
+                    calc = fnCalc()
+                    return lambda: calc.GetIndexSet(L)
+                yield ("setutil.GetIndexSet.{}.d{}.n{}".format(calc_name, d, count),
+                       make, count > 10**5)
+
+
+def _td_set(d, count):
+    from mimclib import setutil
+    calc = setutil.AnisoProfCalculator(np.zeros(d), np.ones(d))
+    C, profits = calc.GetIndexSet(_td_degree(d, count))
+    return calc, C, profits
+
+
+@benchmark
+def admissibility(args):
+    for d, count in [(2, 10**5), (10, 10**5), (5, 10**6)]:
+        name = "d{}.n{}".format(d, count)
+        full = count > 10**5
+
+        def make_check(d=d, count=count):
+            _, C, _ = _td_set(d, count)
+            return lambda: C.CheckAdmissibility()
+
+        def make_profits(d=d, count=count):
+            _, C, profits = _td_set(d, count)
+            return lambda: C.MakeProfitsAdmissible(profits)
+
+        def make_outer(d=d, count=count):
+            calc, C, _ = _td_set(d, count)
+            return lambda: C.calcMinOuterProf(calc)
+
+        yield "setutil.CheckAdmissibility." + name, make_check, full
+        yield "setutil.MakeProfitsAdmissible." + name, make_profits, full
+        yield "setutil.GetMinOuterProfit." + name, make_outer, full
+
+
+@benchmark
+def var_size_list(args):
+    for d, count in [(2, 10**4), (10, 10**4), (5, 10**5)]:
+        name = "d{}.n{}".format(d, count)
+
+        def make_iter(d=d, count=count):
+            _, C, _ = _td_set(d, count)
+            return lambda: sum(1 for ind in C)
+
+        def make_dense(d=d, count=count):
+            _, C, _ = _td_set(d, count)
+            return lambda: C.to_dense_matrix(d_end=d)
+
+        yield "setutil.VarSizeList.iter." + name, make_iter, count > 10**4
+        yield "setutil.VarSizeList.to_dense_matrix." + name, make_dense, False
+
+
+@benchmark
+def moments(args):
+    def make_samples():
+        import mimclib.mimc as mimc
+        x = np.random.RandomState(0).randn(10**6)
+        return lambda: mimc.MomentAccumulator.from_samples(x, 6)
+
+    def make_central():
+        import mimclib.mimc as mimc
+        rng = np.random.RandomState(0)
+        M = rng.randint(1, 10**4, size=10**4)
+        x = [rng.randn(m) for m in M[:100]]
+        psums = np.array([mimc.compute_power_sums(x[i % 100], 6)
+                          for i in range(len(M))])
+        M = np.array([len(x[i % 100]) for i in range(len(M))])
+        return lambda: mimc.compute_central_moments(psums, M)
+
+    yield "mimc.MomentAccumulator.from_samples.n1e6", make_samples, False
+    yield "mimc.compute_central_moments.L1e4", make_central, False
+
+
+def _gbm_run(TOL, extra=[]):
+    sys.path.insert(0, os.path.join(__dir, "..", "tests", "gbm"))
+    import run as gbm
+    import mimclib.mimc as mimc
+    parser = argparse.ArgumentParser()
+    gbm.addExtraArguments(parser)
+    mimc.MIMCRun.addOptionsToParser(parser)
+    params = parser.parse_args(("-mimc_TOL {} -mimc_max_TOL 0.5 -qoi_sigma 0.1 \
+-qoi_mu 1 -mimc_seed 5 -mimc_moments 4 -mimc_dim 1 -mimc_w 1 -mimc_s 1 \
+-mimc_gamma 1 -mimc_beta 2 -mimc_theta 0.2 -mimc_bayesian False".format(TOL)).split()
+                               + extra)
+    mimcRun = mimc.MIMCRun(**vars(params))
+    mimcRun.setFunctions(fnSampleQoIBatch=lambda inds, M:
+                         gbm.mySampleQoIBatch(mimcRun, inds, M))
+    return mimcRun
+
+
+@benchmark
+def gbm_do_run(args):
+    for TOL in [0.01, 0.005]:
+        def make(TOL=TOL):
+            return lambda: _gbm_run(TOL).doRun()
+        yield "mimc.doRun.gbm.TOL{}".format(TOL), make, TOL < 0.01
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def _bench_db(args, persistent=True):
+    try:
+        import mimclib.db as mimcdb
+        kwargs = dict()
+        if args.db_engine == "mysql":
+            kwargs["host"] = args.db_host
+            if args.db_user is not None:
+                kwargs["user"] = args.db_user
+        db = mimcdb.MIMCDatabase(db=args.db_name, persistent=persistent,
+                                 engine=args.db_engine, **kwargs)
+        db.getRunsIDs(tag="")
+    except Exception as e:
+        raise SkipBenchmark("No database: {}".format(e))
+    mimcRun = _gbm_run(0.01)
+    data = []
+    mimcRun.setFunctions(fnItrDone=lambda *a: data.append(a))
+    mimcRun.doRun()
+    return db, mimcRun, data
+
+
+def _many_lvls_run(L):
+    # A run with L levels and made up estimates, as written by a run
+    # on a large index set
+    import mimclib.mimc as mimc
+    mimcRun = _gbm_run(0.01)
+    rng = np.random.RandomState(0)
+    M = rng.randint(1, 1000, size=L)
+    data = mimc.MIMCData(1, lvls=np.arange(L).reshape((-1, 1)),
+                         psums=rng.rand(L, 4) * M[:, None], M=M,
+                         t=rng.rand(L))
+    mimcRun = mimc.MIMCRun(old_data=data, **mimcRun.params.getDict())
+    mimcRun.Vl_estimate = rng.rand(L)
+    mimcRun.Wl_estimate = rng.rand(L)
+    mimcRun.bias = mimcRun.stat_error = 0.1
+    return mimcRun
+
+
+@benchmark
+def database(args):
+    def make_write():
+        db, mimcRun, data = _bench_db(args)
+
+        def write():
+            run_id = db.createRun(mimc_run=mimcRun, tag="bench")
+            for itr in data:
+                db.writeRunData(run_id, mimcRun, *itr)
+            db.deleteRuns([run_id])
+        return write
+
+    def make_read():
+        db, mimcRun, data = _bench_db(args)
+        run_id = db.createRun(mimc_run=mimcRun, tag="bench")
+        for itr in data:
+            db.writeRunData(run_id, mimcRun, *itr)
+        import atexit
+        atexit.register(lambda: db.deleteRuns([run_id]))
+        return lambda: db.readRuns([run_id])
+
+    def make_write_lvls(L, persistent):
+        db, _, _ = _bench_db(args, persistent=persistent)
+        mimcRun = _many_lvls_run(L)
+
+        def write():
+            # Ten iterations of a run, in rows of levels per second
+            run_id = db.createRun(mimc_run=mimcRun, tag="bench")
+            for i in range(0, 10):
+                db.writeRunData(run_id, mimcRun, i, 0.1, 1.)
+            db.deleteRuns([run_id])
+            return Rows(10 * L)
+        return write
+
+    def make_read_lvls(L):
+        db, _, _ = _bench_db(args)
+        mimcRun = _many_lvls_run(L)
+        run_id = db.createRun(mimc_run=mimcRun, tag="bench")
+        for i in range(0, 10):
+            db.writeRunData(run_id, mimcRun, i, 0.1, 1.)
+        import atexit
+        atexit.register(lambda: db.deleteRuns([run_id]))
+
+        def read():
+            db.readRuns([run_id])
+            return Rows(10 * L)
+        return read
+
+    yield "db.writeRunData.gbm", make_write, False
+    yield "db.readRuns.gbm", make_read, False
+    for L in [100, 2000]:
+        # Reconnecting for every query, as before persistent connections
+        yield ("db.writeRunData.L{}.reconnect".format(L),
+               lambda L=L: make_write_lvls(L, False), False)
+        yield ("db.writeRunData.L{}".format(L),
+               lambda L=L: make_write_lvls(L, True), False)
+    yield "db.readRuns.L2000", lambda: make_read_lvls(2000), False
+
+
+def _cases(args):
+    for fn in __benchmarks.values():
+        for name, make, full in fn(args):
+            yield name, make, full
+
+
+def _peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and OS X bytes
+    return rss / (1024.**2 if sys.platform == "darwin" else 1024.)
+
+
+def run_one(args):
+    # Runs a single benchmark and prints its result as JSON
+    make = dict((name, make) for name, make, _ in _cases(args))[args.run_one]
+    # Load the native library first, so that it is not counted in the peak
+    # memory of the benchmark
+    from mimclib import setutil
+    getattr(setutil.__lib__, "FreeIndexSet")
+    rss = _peak_rss_mb()
+    try:
+        fn = make()
+        times = []
+        for i in range(0, args.repeat):
+            tic = time.time()
+            ret = fn()
+            times.append(time.time() - tic)
+            if isinstance(ret, Elapsed):
+                times[-1] = ret   # The benchmark timed itself
+        out = {"time": min(times), "peak_mb": _peak_rss_mb() - rss}
+        if isinstance(ret, Rows):
+            out["rows_per_s"] = ret / out["time"]
+    except SkipBenchmark as e:
+        out = {"skipped": str(e)}
+    print(json.dumps(out))
+
+
+def _is_regression(res, base, tol, min_time):
+    if base is None or "time" not in res:
+        return False
+    # Changes smaller than min_time seconds or 1MB are noise
+    return res["time"] > base["time"] * (1 + tol) + min_time or \
+        res["peak_mb"] > base["peak_mb"] * (1 + tol) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of mimclib")
+    parser.add_argument("-full", action="store_true",
+                        help="Also run the large benchmarks")
+    parser.add_argument("-filter", type=str, default="",
+                        help="Only run the benchmarks matching this regex")
+    parser.add_argument("-repeat", type=int, default=3,
+                        help="Number of runs of every benchmark")
+    parser.add_argument("-tolerance", type=float, default=0.25,
+                        help="Relative slow down that is flagged as regression")
+    parser.add_argument("-min_time", type=float, default=0.01,
+                        help="Absolute slow down in seconds below which \
+no regression is flagged")
+    parser.add_argument("-update", action="store_true",
+                        help="Store the results as baselines")
+    parser.add_argument("-baselines", type=str, default=BASELINES,
+                        help="File of the baselines")
+    parser.add_argument("-db_engine", type=str, default="sqlite",
+                        choices=["sqlite", "mysql"])
+    parser.add_argument("-db_name", type=str,
+                        help="Name of the MySQL database or path of the \
+SQLite file")
+    parser.add_argument("-db_host", type=str, default="localhost")
+    parser.add_argument("-db_user", type=str)
+    parser.add_argument("-run_one", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.db_name is None:
+        import tempfile
+        args.db_name = "mimc" if args.db_engine == "mysql" else \
+                       os.path.join(tempfile.gettempdir(), "mimc_bench.sqlite")
+
+    if args.run_one is not None:
+        return run_one(args)
+
+    baselines = dict()
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    print("{:<50}{:>12}{:>12}{:>12}{:>12}".format("Benchmark", "Time",
+                                                  "Baseline", "Peak MB",
+                                                  "Baseline"))
+    for name, _, full in _cases(args):
+        if (full and not args.full) or not re.search(args.filter, name):
+            continue
+        cmd = [sys.executable, os.path.abspath(__file__), "-run_one", name,
+               "-repeat", str(args.repeat), "-db_engine", args.db_engine,
+               "-db_name", args.db_name, "-db_host", args.db_host]
+        if args.db_user is not None:
+            cmd += ["-db_user", args.db_user]
+        out = subprocess.check_output(cmd, universal_newlines=True)
+        res = json.loads(out.strip().splitlines()[-1])
+        if "skipped" in res:
+            print("{:<50} skipped: {}".format(name, res["skipped"]))
+            continue
+        base = baselines.get(name)
+        flag = ""
+        if name in BUDGETS and res["time"] > BUDGETS[name]:
+            regressions.append(name)
+            flag = "  OVER BUDGET"
+        elif _is_regression(res, base, args.tolerance, args.min_time):
+            regressions.append(name)
+            flag = "  REGRESSION"
+        if "rows_per_s" in res:
+            flag += "  {:.4g} rows/s".format(res["rows_per_s"])
+        print("{:<50}{:>12.4g}{:>12}{:>12.1f}{:>12}{}".format(
+            name, res["time"],
+            "{:.4g}".format(base["time"]) if base else "-",
+            res["peak_mb"],
+            "{:.1f}".format(base["peak_mb"]) if base else "-", flag))
+        sys.stdout.flush()
+        if args.update:
+            baselines[name] = res
+
+    if args.update:
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+            f.write("\n")
+    if len(regressions) > 0:
+        print("Regressions in:", ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
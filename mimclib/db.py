@@ -3,6 +3,11 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 
 __all__ = []
@@ -13,42 +18,140 @@ def public(sym):
 
 
 def _pickle(obj):
-    import io
-    import cPickle
-    import MySQLdb
-    with io.BytesIO() as f:
-        cPickle.dump(obj, f, protocol=2)
-        f.seek(0)
-        return MySQLdb.Binary(f.read())
+    return pickle.dumps(obj, protocol=2)
 
 
 def _unpickle(obj):
-    import io
-    import cPickle
-    with io.BytesIO(obj) as f:
-        return cPickle.load(f)
+    import sys
+    if sys.version_info[0] >= 3:
+        # Python 2 pickles the data of numpy arrays as str, which is only
+        # read back as the same bytes with the latin1 encoding
+        return pickle.loads(bytes(obj), encoding='latin1')
+    return pickle.loads(bytes(obj))
+
+
+# Layout of the level table written by this module. In version 1, lvl is
+# the text "i|j,..." of the non-zero entries of the level with the hex md5
+# of the text as lvl_hash, and psums is the pickled array of the raw power
+# sums of the samples. In version 2, lvl is the packed array of all entries
+# of the level, lvl_hash is the binary md5 of lvl, and the samples are
+# stored as in mimc.MomentAccumulator: their mean and csums, the raw array
+# of the sums of powers of their deviations from the mean. lvl and csums are
+# read with np.frombuffer. Unlike raw power sums, the central sums keep the
+# variance of samples with a large mean.
+SCHEMA_VERSION = 2
+_LVL_DTYPE = np.dtype('<u2')
+_SUMS_DTYPE = np.dtype('<f8')
+
+
+def _pack_lvls(lvls):
+    '''
+    Returns the bytes of every row of the level matrix lvls
+    '''
+    lvls = np.asarray(lvls)
+    if lvls.size > 0 and (lvls.min() < 0 or
+                          lvls.max() > np.iinfo(_LVL_DTYPE).max):
+        raise ValueError("Levels must be between 0 and {}".
+                         format(np.iinfo(_LVL_DTYPE).max))
+    lvls = np.ascontiguousarray(lvls, dtype=_LVL_DTYPE)
+    return [r.tobytes() for r in lvls]
+
+
+def _pack_sums(sums):
+    sums = np.ascontiguousarray(sums, dtype=_SUMS_DTYPE)
+    return [r.tobytes() for r in sums]
+
+
+def _lvl_hash(lvl):
+    # Computed here since md5() of MySQL would prevent a multi-row INSERT.
+    # Binary levels get the binary digest and text levels the hex digest
+    import hashlib
+    if isinstance(lvl, bytes):
+        return hashlib.md5(lvl).digest()
+    return hashlib.md5(lvl.encode()).hexdigest()
+
+
+def _parse_lvl_text(lvl, dim):
+    ind = np.zeros(dim, dtype=np.int)
+    t = np.array([int(p) for p in re.split(r",|\|", lvl) if p],
+                 dtype=np.int)
+    ind[t[::2]] = t[1::2]
+    return ind
+
+
+def _connect(**kwargs):
+    import MySQLdb
+    return MySQLdb.connect(compress=True, **kwargs)
+
+
+def _connect_sqlite(path, **kwargs):
+    import sqlite3
+    for t in [np.int8, np.int16, np.int32, np.int64,
+              np.uint8, np.uint16, np.uint32, np.uint64]:
+        sqlite3.register_adapter(t, int)
+    # Concurrent writers wait for each other instead of failing
+    kwargs.setdefault("timeout", 60.)
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
+                           **kwargs)
+    # With a write-ahead log, readers do not block the writer and a commit
+    # does not wait for the data to be written to the database itself
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
 
 
 class DBConn(object):
-    def __init__(self, **kwargs):
+    '''
+    A transaction, committed when the context exits normally and rolled
+    back otherwise. The connection is opened and closed with the context,
+    unless an open connection conn is given.
+    '''
+    def __init__(self, conn=None, close=None, **kwargs):
         self.connArgs = kwargs
+        self.conn = conn
+        self.persistent = conn is not None if close is None else not close
 
     def __enter__(self):
-        import MySQLdb
-        self.conn = MySQLdb.connect(compress=True, **self.connArgs)
+        if self.conn is None:
+            self.conn = _connect(**self.connArgs)
         self.cur = self.conn.cursor()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.Commit()
-        self.conn.close()
+        try:
+            if type is None:
+                self.Commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.cur.close()
+            if not self.persistent:
+                self.conn.close()
+
+    def _query(self, query):
+        query = query.replace("datetime()", "now()")
+        return query.replace("?", "%s")
 
     def execute(self, query, params=[]):
-        query = query.replace("datetime()", "now()")
-        query = query.replace("?", "%s")
-        self.cur.execute(query, tuple(params))
+        self.cur.execute(self._query(query), tuple(params))
         return self.cur
 
+    def executemany(self, query, seq_params):
+        # MySQLdb sends a single multi-row INSERT when the VALUES of query
+        # are only placeholders
+        self.cur.executemany(self._query(query),
+                             [tuple(p) for p in seq_params])
+        return self.cur
+
+    def concat(self, a, b):
+        return "CONCAT({}, {})".format(a, b)
+
+    def tableExists(self, name):
+        return self.execute('''SELECT count(*) FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = ?''',
+                            [name]).fetchone()[0] > 0
+
     def getLastRowID(self):
         return self.cur.lastrowid
 
@@ -59,18 +162,149 @@ class DBConn(object):
         self.conn.commit()
 
 
+class SQLiteConn(DBConn):
+    '''
+    A transaction of an SQLite database. Takes the same queries as DBConn,
+    where "in ?" with a list parameter is expanded to "in (?, ?, ...)".
+    '''
+    def _query(self, query):
+        return query.replace("datetime()", "datetime('now', 'localtime')")
+
+    def execute(self, query, params=[]):
+        parts = self._query(query).split("?")
+        assert len(parts) == len(params)+1, "Wrong number of parameters"
+        query, flat = parts[0], []
+        for p, part in zip(params, parts[1:]):
+            if isinstance(p, (list, tuple)):
+                query += "(" + ", ".join(["?"] * len(p)) + ")"
+                flat.extend(p)
+            else:
+                query += "?"
+                flat.append(p)
+            query += part
+        self.cur.execute(query, flat)
+        return self.cur
+
+    def executemany(self, query, seq_params):
+        self.cur.executemany(self._query(query),
+                             [tuple(p) for p in seq_params])
+        return self.cur
+
+    def concat(self, a, b):
+        return "{} || {}".format(a, b)
+
+    def tableExists(self, name):
+        return self.execute('''SELECT count(*) FROM sqlite_master
+        WHERE type = 'table' AND name = ?''', [name]).fetchone()[0] > 0
+
+
 @public
 class MIMCDatabase(object):
+    '''
+    engine is either "mysql", where db is the name of the database on the
+    server given by the keyword arguments, or "sqlite", where db is the path
+    of a file that is created with the tables if needed.
+
+    With persistent=True (the default) a single connection is kept open and
+    reused by all queries of this object, and reopened when lost or when
+    used from a forked process. Call close() to close it.
+
+    The version of the level table is kept in schemaTable. Tables created
+    before it existed have version 1 and are read and written as such until
+    they are converted by migrateSchema().
+    '''
     def __init__(self, db='mimc', runTable='tbl_runs', dataTable='tbl_data',
-                 lvlTable='tbl_lvls', **kwargs):
+                 lvlTable='tbl_lvls', schemaTable='tbl_schema',
+                 persistent=True, engine="mysql", **kwargs):
+        if engine not in ["mysql", "sqlite"]:
+            raise ValueError("Unknown database engine {}".format(engine))
         self.DBName = db
         self.runTable = runTable
         self.dataTable = dataTable
         self.lvlTable = lvlTable
-        kwargs["db"] = db
+        self.schemaTable = schemaTable
+        self.persistent = persistent
+        self.engine = engine
+        if engine == "mysql":
+            kwargs["db"] = db
         self.connArgs = kwargs.copy()
+        self._conn = None
+        self._conn_pid = None
+        self._version = None
+
+    def _newConnection(self):
+        if self.engine == "mysql":
+            return _connect(**self.connArgs)
+        conn = _connect_sqlite(self.DBName, **self.connArgs)
+        with SQLiteConn(conn=conn) as cur:
+            # A new file gets the current version, while the level table of
+            # an existing file keeps its version, also while it is renamed
+            # by migrateSchema
+            new_db = not cur.tableExists(self.lvlTable) and \
+                not cur.tableExists(self.runTable)
+            conn.executescript(self.DBCreationScript(set_version=new_db))
+        return conn
+
+    def schemaVersion(self):
+        '''
+        Returns the version of the layout of the level table
+        '''
+        if self._version is None:
+            with self.connect() as cur:
+                version = None
+                if cur.tableExists(self.schemaTable):
+                    version = cur.execute('''SELECT max(version) FROM
+                    {schemaTable}'''.format(schemaTable=self.schemaTable)
+                                          ).fetchone()[0]
+                self._version = 1 if version is None else int(version)
+        if self._version > SCHEMA_VERSION:
+            raise Exception("The database has version {} but only version {} "
+                            "is supported".format(self._version,
+                                                  SCHEMA_VERSION))
+        return self._version
+
+    def connect(self):
+        '''
+        Returns a DBConn for one transaction
+        '''
+        Conn = SQLiteConn if self.engine == "sqlite" else DBConn
+        if not self.persistent:
+            return Conn(conn=self._newConnection(), close=True)
+        import os
+        if self._conn is not None and self._conn_pid == os.getpid():
+            if self.engine == "mysql":
+                try:
+                    self._conn.ping()
+                except Exception:
+                    self._conn = None
+        else:
+            # A connection of the parent process must not be shared
+            self._conn = None
+        if self._conn is None:
+            self._conn = self._newConnection()
+            self._conn_pid = os.getpid()
+        return Conn(conn=self._conn)
+
+    def close(self):
+        import os
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
 
-    def DBCreationScript(self, drop_db=False):
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def DBCreationScript(self, drop_db=False, set_version=True):
+        '''
+        Returns the SQL script creating the tables. With set_version, the
+        tables are marked as having the current version, which is only
+        correct for a new database.
+        '''
+        if self.engine == "sqlite":
+            return self._SQLiteCreationScript(drop_db, set_version)
         script = ""
         if drop_db:
             script += "DROP DATABASE IF EXISTS {DBName};".format(DBName=self.DBName)
@@ -106,33 +340,206 @@ CREATE TABLE IF NOT EXISTS {dataTable} (
 CREATE VIEW vw_data AS SELECT data_id, run_id, TOL,
 creation_date, bias, stat_error, totalTime, iteration_idx FROM {dataTable};
 
+{lvlTableScript}
+CREATE VIEW vw_lvls AS SELECT data_id, lvl,
+El, Vl, Wl, Tl, Ml FROM {lvlTable};
+
+CREATE TABLE IF NOT EXISTS {schemaTable} (
+    version       INTEGER NOT NULL
+);
+'''.format(DBName=self.DBName, runTable=self.runTable,
+           dataTable=self.dataTable, lvlTable=self.lvlTable,
+           schemaTable=self.schemaTable,
+           lvlTableScript=self._lvlTableScript(self.lvlTable))
+        if set_version:
+            script += "INSERT INTO {schemaTable}(version) VALUES({version});\n".\
+                      format(schemaTable=self.schemaTable,
+                             version=SCHEMA_VERSION)
+        return script
+
+    def _lvlTableScript(self, lvlTable):
+        '''
+        Returns the creation of a level table of the current version
+        '''
+        if self.engine == "sqlite":
+            return '''
 CREATE TABLE IF NOT EXISTS {lvlTable} (
     data_id       INTEGER NOT NULL,
-    lvl           text NOT NULL,
-    lvl_hash      varchar(35) NOT NULL,
+    lvl           BLOB NOT NULL,
+    lvl_hash      BLOB NOT NULL,
     El            REAL,
     Vl            REAL,
     Wl            REAL,
     Tl            REAL,
     Ml            INTEGER,
-    psums         mediumblob,
+    mean          REAL,
+    csums         BLOB,
+    FOREIGN KEY (data_id) REFERENCES {dataTable}(data_id) ON DELETE CASCADE,
+    UNIQUE (data_id, lvl_hash)
+);
+'''.format(lvlTable=lvlTable, dataTable=self.dataTable)
+        return '''
+CREATE TABLE IF NOT EXISTS {lvlTable} (
+    data_id       INTEGER NOT NULL,
+    lvl           blob NOT NULL,
+    lvl_hash      binary(16) NOT NULL,
+    El            REAL,
+    Vl            REAL,
+    Wl            REAL,
+    Tl            REAL,
+    Ml            INTEGER,
+    mean          REAL,
+    csums         mediumblob,
     FOREIGN KEY (data_id) REFERENCES {dataTable}(data_id) ON DELETE CASCADE,
     UNIQUE KEY idx_run_lvl (data_id, lvl_hash)
 );
+'''.format(lvlTable=lvlTable, dataTable=self.dataTable)
 
-CREATE VIEW vw_lvls AS SELECT data_id, lvl,
+    def _SQLiteCreationScript(self, drop_db=False, set_version=True):
+        script = ""
+        if drop_db:
+            script += '''
+DROP VIEW IF EXISTS vw_lvls; DROP VIEW IF EXISTS vw_data;
+DROP VIEW IF EXISTS vw_runs; DROP TABLE IF EXISTS {lvlTable};
+DROP TABLE IF EXISTS {dataTable}; DROP TABLE IF EXISTS {runTable};
+DROP TABLE IF EXISTS {schemaTable};
+'''
+        script += '''
+CREATE TABLE IF NOT EXISTS {runTable} (
+    run_id                INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    creation_date         TIMESTAMP NOT NULL,
+    TOL                   REAL,
+    done_flag             INTEGER NOT NULL,
+    dim                   INTEGER,
+    tag                   VARCHAR(128),
+    params                BLOB,
+    comment               TEXT
+);
+CREATE VIEW IF NOT EXISTS vw_runs AS SELECT run_id, creation_date, TOL, done_flag, dim, tag, comment FROM {runTable};
+
+CREATE TABLE IF NOT EXISTS {dataTable} (
+    data_id                 INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    run_id                  INTEGER NOT NULL,
+    TOL                     REAL NOT NULL,
+    bias                    REAL,
+    stat_error              REAL,
+    creation_date           TIMESTAMP NOT NULL,
+    totalTime               REAL NOT NULL,
+    Qparams                 BLOB,
+    userdata                BLOB,
+    iteration_idx           INTEGER NOT NULL,
+    FOREIGN KEY (run_id) REFERENCES {runTable}(run_id) ON DELETE CASCADE,
+    UNIQUE (run_id, iteration_idx)
+);
+CREATE VIEW IF NOT EXISTS vw_data AS SELECT data_id, run_id, TOL,
+creation_date, bias, stat_error, totalTime, iteration_idx FROM {dataTable};
+
+{lvlTableScript}
+CREATE VIEW IF NOT EXISTS vw_lvls AS SELECT data_id, lvl,
 El, Vl, Wl, Tl, Ml FROM {lvlTable};
-'''.format(DBName=self.DBName, runTable=self.runTable,
-           dataTable=self.dataTable, lvlTable=self.lvlTable)
 
-        return script
+CREATE TABLE IF NOT EXISTS {schemaTable} (
+    version       INTEGER NOT NULL
+);
+'''
+        if set_version:
+            script += "INSERT INTO {schemaTable}(version) VALUES({version});\n"
+        return script.format(runTable=self.runTable, dataTable=self.dataTable,
+                             lvlTable=self.lvlTable,
+                             schemaTable=self.schemaTable,
+                             version=SCHEMA_VERSION,
+                             lvlTableScript=self._lvlTableScript(self.lvlTable))
+
+    def migrateSchema(self, chunk_size=1000, verbose=False):
+        '''
+        Converts the level table to the current version, chunk_size
+        iterations at a time, and returns the number of converted levels.
+
+        The levels are copied to a new table, which then replaces the old
+        one. This is not atomic: MySQL commits every CREATE, DROP and
+        RENAME TABLE at once, and so does SQLite outside a transaction.
+        Instead, an interrupted migration is completed by running it again.
+        An incomplete copy is dropped and started over. Once the copy is
+        complete, the old table is renamed to a backup before the new one
+        takes its name. The backup is only dropped after the new version
+        is recorded, so an interruption at the very end can leave it behind.
+        '''
+        if self.schemaVersion() == SCHEMA_VERSION:
+            return 0
+        newTable = "{}_v{}".format(self.lvlTable, SCHEMA_VERSION)
+        oldTable = "{}_v{}".format(self.lvlTable, self.schemaVersion())
+        with self.connect() as cur:
+            copied = cur.tableExists(oldTable)
+        if not copied:
+            self._copyLevels(newTable, chunk_size, verbose)
+
+        with self.connect() as cur:
+            cur.execute("DROP VIEW IF EXISTS vw_lvls")
+            if not cur.tableExists(oldTable):
+                cur.execute("ALTER TABLE {} RENAME TO {}".format(self.lvlTable,
+                                                                 oldTable))
+            if cur.tableExists(newTable):
+                # A connection opened while the old table was renamed may
+                # have created an empty level table
+                cur.execute("DROP TABLE IF EXISTS {}".format(self.lvlTable))
+                cur.execute("ALTER TABLE {} RENAME TO {}".format(newTable,
+                                                                 self.lvlTable))
+            cur.execute('''CREATE VIEW vw_lvls AS SELECT data_id, lvl,
+El, Vl, Wl, Tl, Ml FROM {lvlTable}'''.format(lvlTable=self.lvlTable))
+            cur.execute('''CREATE TABLE IF NOT EXISTS {schemaTable} (
+    version       INTEGER NOT NULL
+)'''.format(schemaTable=self.schemaTable))
+            cur.execute("INSERT INTO {schemaTable}(version) VALUES(?)".
+                        format(schemaTable=self.schemaTable), [SCHEMA_VERSION])
+        self._version = SCHEMA_VERSION
+        with self.connect() as cur:
+            cur.execute("DROP TABLE {}".format(oldTable))
+            return cur.execute("SELECT count(*) FROM {}".format(self.lvlTable)
+                               ).fetchone()[0]
+
+    def _copyLevels(self, newTable, chunk_size, verbose):
+        # Copies the levels to newTable in the current version
+        from . import mimc
+        with self.connect() as cur:
+            cur.execute("DROP TABLE IF EXISTS {}".format(newTable))
+            cur.execute(self._lvlTableScript(newTable))
+            data_ids = [r[0] for r in cur.execute('''SELECT DISTINCT data_id
+            FROM {lvlTable} ORDER BY data_id'''.
+                                                  format(lvlTable=self.lvlTable)
+                                                  ).fetchall()]
+        count = 0
+        for i in range(0, len(data_ids), chunk_size):
+            with self.connect() as cur:
+                rows = cur.execute('''
+SELECT l.data_id, l.lvl, l.El, l.Vl, l.Wl, l.Tl, l.Ml, l.psums, r.dim FROM
+{lvlTable} l INNER JOIN {dataTable} dr ON dr.data_id=l.data_id
+INNER JOIN {runTable} r ON r.run_id=dr.run_id WHERE l.data_id in ?'''.
+                                   format(lvlTable=self.lvlTable,
+                                          dataTable=self.dataTable,
+                                          runTable=self.runTable),
+                                   [data_ids[i:i+chunk_size]]).fetchall()
+                newRows = []
+                for r in rows:
+                    lvl = _pack_lvls([_parse_lvl_text(r[1], r[-1])])[0]
+                    acc = mimc.MomentAccumulator.from_psums(_unpickle(r[7]),
+                                                            [r[6]])
+                    newRows.append([lvl, _lvl_hash(lvl)] + list(r[2:7]) +
+                                   [acc.mean[0], _pack_sums(acc.csums)[0],
+                                    r[0]])
+                cur.executemany('''
+INSERT INTO {newTable}(lvl, lvl_hash, El, Vl, Wl, Tl, Ml, mean, csums, data_id)
+VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(newTable=newTable), newRows)
+            count += len(newRows)
+            if verbose:
+                print("Converted {} levels of {}/{} iterations".format(
+                    count, min(i+chunk_size, len(data_ids)), len(data_ids)))
 
     def createRun(self, tag, TOL=None, dim=None, params=None,
                   mimc_run=None, comment=""):
         TOL = TOL or mimc_run.params.TOL
         params = params or mimc_run.params
         dim = dim or mimc_run.data.dim
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             cur.execute('''
 INSERT INTO {runTable}(creation_date, TOL, tag, dim, params, done_flag, comment)
 VALUES(datetime(), ?, ?, ?, ?, -1, ?)'''.format(runTable=self.runTable),
@@ -140,12 +547,12 @@ VALUES(datetime(), ?, ?, ?, ?, -1, ?)'''.format(runTable=self.runTable),
             return cur.getLastRowID()
 
     def markRunDone(self, run_id, flag, comment=''):
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             cur.execute(''' UPDATE {runTable} SET done_flag=?,
-            comment = CONCAT(comment,  ?)
+            comment = {concat}
             WHERE run_id=?'''.format(runTable=self.runTable,
-                                     flag=flag, run_id=run_id,
-                                     comment=comment), [flag, comment, run_id])
+                                     concat=cur.concat("comment", "?")),
+                        [flag, comment, run_id])
 
     def markRunSuccessful(self, run_id, comment=''):
         self.markRunDone(run_id, flag=1, comment=comment)
@@ -160,14 +567,15 @@ VALUES(datetime(), ?, ?, ?, ?, -1, ?)'''.format(runTable=self.runTable),
 
     def writeRunData(self, run_id, mimc_run, iteration_idx, TOL,
                      totalTime, userdata=None):
-        base = 0
+        version = self.schemaVersion()
         El = mimc_run.data.calcEl()
         Vl = mimc_run.Vl_estimate
         Tl = mimc_run.data.calcTl()
         Wl = mimc_run.Wl_estimate
         Ml = mimc_run.data.M
+        acc = mimc_run.data.acc
 
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             cur.execute('''
 INSERT INTO {dataTable}(creation_date, totalTime, TOL, bias, stat_error,
 Qparams, userdata, iteration_idx, run_id)
@@ -176,25 +584,34 @@ VALUES(datetime(), ?, ?, ?, ?, ?, ?, ?, ?)'''.format(dataTable=self.dataTable),
                          _pickle(mimc_run.Q), _pickle(userdata),
                          iteration_idx, run_id])
             data_id = cur.getLastRowID()
-            for k in range(0, len(mimc_run.data.lvls)):
-                lvl = ",".join(["%d|%d" % (i, j) for i, j in
-                                enumerate(mimc_run.data.lvls[k]) if j > base])
-                cur.execute('''
-INSERT INTO {lvlTable}(lvl, lvl_hash, El, Vl, Wl, Tl, Ml, psums, data_id)
-VALUES(?, md5(?), ?, ?, ?, ?, ?, ?, ?)
-'''.format(lvlTable=self.lvlTable, lvl=lvl),
-                            [lvl, lvl, El[k], Vl[k], Wl[k], Tl[k], Ml[k],
-                             _pickle(mimc_run.data.psums[k, :]), data_id])
+            if version == 1:
+                lvls = [",".join(["%d|%d" % (i, j) for i, j in enumerate(lvl)
+                                  if j > 0]) for lvl in mimc_run.data.lvls]
+                sums = [[_pickle(p)] for p in acc.psums()]
+                columns = ["psums"]
+            else:
+                lvls = _pack_lvls(mimc_run.data.lvls)
+                sums = list(zip(acc.mean, _pack_sums(acc.csums)))
+                columns = ["mean", "csums"]
+            rows = [[lvls[k], _lvl_hash(lvls[k]), El[k], Vl[k], Wl[k],
+                     Tl[k], Ml[k]] + list(sums[k]) + [data_id]
+                    for k in range(0, len(lvls))]
+            cur.executemany('''
+INSERT INTO {lvlTable}(lvl, lvl_hash, El, Vl, Wl, Tl, Ml, {columns}, data_id)
+VALUES(?, ?, ?, ?, ?, ?, ?, {params}, ?)'''.format(lvlTable=self.lvlTable,
+                                                 columns=", ".join(columns),
+                                                 params=", ".join(["?"]*len(columns))),
+                            rows)
 
     def readRuns(self, run_ids):
         from . import mimc
-        import re
+        version = self.schemaVersion()
         lstvalues = []
         run_ids = np.array(run_ids).astype(np.int).reshape(-1).tolist()
         if len(run_ids) == 0:
             return lstvalues
 
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             runAll = cur.execute(
                         '''SELECT r.run_id, r.params, r.TOL, r.comment, count(*)
                         FROM {runTable} r INNER JOIN {dataTable} dr ON
@@ -210,13 +627,15 @@ SELECT dr.data_id, dr.run_id, dr.TOL, dr.creation_date,
 '''.format(dataTable=self.dataTable), [run_ids]).fetchall()
 
             lvlsAll = cur.execute('''
-            SELECT dr.data_id, l.lvl, l.psums, l.Ml, l.Tl, l.Wl, l.Vl, r.dim FROM
-            {lvlTable} l INNER JOIN {dataTable} dr ON
+            SELECT dr.data_id, l.lvl, l.Ml, l.Tl, l.Wl, l.Vl, {sums}, r.dim
+            FROM {lvlTable} l INNER JOIN {dataTable} dr ON
             dr.data_id=l.data_id INNER JOIN {runTable} r on r.run_id=dr.run_id
             WHERE dr.run_id in ? ORDER BY dr.data_id'''.
                                   format(lvlTable=self.lvlTable,
                                          dataTable=self.dataTable,
-                                         runTable=self.runTable),
+                                         runTable=self.runTable,
+                                         sums="l.psums" if version == 1
+                                         else "l.mean, l.csums"),
                                   [run_ids]).fetchall()
 
         dictRuns = dict()
@@ -226,20 +645,25 @@ SELECT dr.data_id, dr.run_id, dr.TOL, dr.creation_date,
 
         dictLvls = dict()
         import itertools
-        for run_id, itr in itertools.groupby(lvlsAll, key=lambda x:x[0]):
-            psums, lvls, Ml, Tl, Wl, Vl = [], [], [], [], [], []
-            for r in itr:
-                t = np.array(map(int, [p for p in re.split(",|\|", r[1]) if p]),
-                             dtype=np.uint32)
-                ind = np.zeros(r[-1], dtype=np.uint)
-                ind[t[::2]] = t[1::2]
-                lvls.append(ind.tolist())
-                psums.append(_unpickle(r[2]))
-                Ml.append(r[3])
-                Tl.append(r[4])
-                Wl.append(r[5])
-                Vl.append(r[6])
-            dictLvls[run_id] = [psums, lvls, Ml, Tl, Wl, Vl]
+        for data_id, itr in itertools.groupby(lvlsAll, key=lambda x:x[0]):
+            rows = list(itr)
+            dim = rows[0][-1]
+            Ml, Tl, Wl, Vl = zip(*[r[2:6] for r in rows])
+            Ml = np.array(Ml, dtype=np.int)
+            if version == 1:
+                lvls = [_parse_lvl_text(r[1], dim) for r in rows]
+                acc = mimc.MomentAccumulator.from_psums(
+                    [_unpickle(r[6]) for r in rows], Ml)
+            else:
+                lvls = np.frombuffer(b"".join([bytes(r[1]) for r in rows]),
+                                     dtype=_LVL_DTYPE).reshape((-1, dim))
+                csums = np.frombuffer(b"".join([bytes(r[7]) for r in rows]),
+                                      dtype=_SUMS_DTYPE).reshape((len(rows),
+                                                                  -1))
+                acc = mimc.MomentAccumulator(Ml, np.array([r[6] for r in rows],
+                                                          dtype=np.float),
+                                             csums.copy())
+            dictLvls[data_id] = [acc, lvls, Ml, Tl, Wl, Vl]
 
         for data in dataAll:
             val = dict()
@@ -256,16 +680,15 @@ SELECT dr.data_id, dr.run_id, dr.TOL, dr.creation_date,
             val["user_data"] = _unpickle(data[8])
             val["iteration_index"] = data[9]
 
-            psums, lvls, Ml, Tl, Wl, Vl = dictLvls[data_id]
+            acc, lvls, Ml, Tl, Wl, Vl = dictLvls[data_id]
 
-            lvls = np.array(lvls)
+            lvls = np.array(lvls, dtype=np.int)
             sort_rows = lambda a: np.argsort(a.view([('',a.dtype)]*a.shape[1]),0).T[0]
             ind = sort_rows(lvls)
 
             old_data = mimc.MIMCData(run_params[0].dim, lvls=lvls[ind],
-                                     psums=np.array(psums)[ind],
-                                     M=np.array(Ml)[ind],
-                                     t=np.array(Ml)[ind] * np.array(Tl)[ind])
+                                     acc=acc[ind],
+                                     t=Ml[ind] * np.array(Tl)[ind])
             run = mimc.MIMCRun(old_data=old_data,
                                **run_params[0].getDict())
             run.bias = data[5]
@@ -278,7 +701,7 @@ SELECT dr.data_id, dr.run_id, dr.TOL, dr.creation_date,
         return lstvalues
 
     def _fetchArray(self, query, params=None):
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             dataAll = cur.execute(query, params if params else [])
             return np.array(dataAll.fetchall())
 
@@ -332,7 +755,7 @@ SELECT dr.data_id, dr.run_id, dr.TOL, dr.creation_date,
         return ids
 
     def deleteRuns(self, run_ids):
-        with DBConn(**self.connArgs) as cur:
+        with self.connect() as cur:
             cur.execute("DELETE from {runTable} where run_id in ?".format(runTable=self.runTable),
                         [np.array(run_ids).astype(np.int).reshape(-1).tolist()])
             return cur.getRowCount()
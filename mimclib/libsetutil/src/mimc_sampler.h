@@ -0,0 +1,49 @@
+#ifndef __MIMC_SAMPLER_H__
+#define __MIMC_SAMPLER_H__
+
+/*
+  ABI of a sampler plugin, a shared library that mimclib.native.NativeSampler
+  loads with ctypes and uses as the fnSampleLvl of a MIMCRun. The plugin
+  exports the following functions, all returning 0 on success and an error
+  code otherwise. The prefix mimc_sampler can be changed when loading.
+
+  int mimc_sampler_init(const char *args, void **ctx);
+      Creates the context of the sampler from a free form string args.
+
+  int mimc_sampler_seed(void *ctx, unsigned long long seed);
+      Seeds the random generator of the sampler. Called before every block
+      of samples, so that every block has its own stream.
+
+  int mimc_sampler_sample(void *ctx, const unsigned int *inds,
+                          unsigned int count, unsigned int dim,
+                          unsigned int M, double *values);
+      Computes M samples of the quantity of interest at the count indices
+      inds, a row-major count x dim matrix. The k'th index of the m'th
+      sample is written to values[m*count + k].
+
+  int mimc_sampler_finalize(void *ctx);
+      Frees the context.
+*/
+
+typedef unsigned int uint32;
+
+#ifdef __cplusplus
+extern "C"{
+#endif
+    typedef int (*mimc_sampler_sample_fn)(void *ctx, const uint32 *inds,
+                                          uint32 count, uint32 dim,
+                                          uint32 M, double *values);
+
+    /* Draws M samples with fnSample of the differences
+       x = sum_k mods[k]*values[k] and adds the sums of (x-center)**p for
+       p=1..moments to psums, where center is set to the mean of the first
+       samples */
+    int SampleLvlNative(mimc_sampler_sample_fn fnSample, void *ctx,
+                        const double *mods, const uint32 *inds,
+                        uint32 count, uint32 dim, uint32 M,
+                        uint32 moments, double *center, double *psums);
+#ifdef __cplusplus
+}
+#endif
+
+#endif    // __MIMC_SAMPLER_H__
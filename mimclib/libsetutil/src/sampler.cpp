@@ -0,0 +1,44 @@
+#include <vector>
+#include <algorithm>
+#include <cmath>
+#include "mimc_sampler.h"
+
+// Samples are requested from the plugin in chunks of this size, to bound
+// the memory of the values
+static const uint32 chunk_size = 1024;
+
+int SampleLvlNative(mimc_sampler_sample_fn fnSample, void *ctx,
+                    const double *mods, const uint32 *inds,
+                    uint32 count, uint32 dim, uint32 M,
+                    uint32 moments, double *center, double *psums){
+    std::vector<double> values(std::min(chunk_size, M)*count);
+    std::vector<double> deltas(std::min(chunk_size, M));
+    for (uint32 m=0;m<M;m+=chunk_size){
+        uint32 n = std::min(chunk_size, M-m);
+        int ierr = fnSample(ctx, inds, count, dim, n, values.data());
+        if (ierr)
+            return ierr;
+        for (uint32 i=0;i<n;i++){
+            deltas[i] = 0;
+            for (uint32 k=0;k<count;k++)
+                deltas[i] += mods[k]*values[i*count+k];
+        }
+        if (m == 0){
+            // The mean of the first chunk is close enough to the mean to
+            // avoid the cancellation of raw power sums
+            *center = 0;
+            for (uint32 i=0;i<n;i++)
+                *center += deltas[i];
+            *center /= n;
+        }
+        for (uint32 i=0;i<n;i++){
+            double dev = deltas[i] - *center;
+            double prod = dev;
+            for (uint32 j=0;j<moments;j++){
+                psums[j] += prod;
+                prod *= dev;
+            }
+        }
+    }
+    return 0;
+}
@@ -4,6 +4,7 @@
 #include <limits>
 #include <vector>
 #include <list>
+#include <algorithm>
 #include <assert.h>
 #include <iostream>
 #include "var_list.h"
@@ -272,7 +273,8 @@ PVarSizeList GetIndexSet(const PProfitCalculator profCalc,
 
     ind_set.sort(compare_setprof);
 
-    *p_profits = static_cast<double*>(malloc(sizeof(double) * ind_set.size()));
+    if (p_profits)
+        *p_profits = static_cast<double*>(malloc(sizeof(double) * ind_set.size()));
     uint32 i=0;
     PVarSizeList pRet = new VarSizeList(ind_set.size());
     for (auto itr=ind_set.begin();itr!=ind_set.end();itr++){
@@ -283,6 +285,36 @@ PVarSizeList GetIndexSet(const PProfitCalculator profCalc,
     return pRet;
 }
 
+PIndexSetExtender GetIndexSetExtender(const PVarSizeList pset,
+                                      const PProfitCalculator profCalc) {
+    if (pset)
+        return new IndexSetExtender(*pset, profCalc);
+    return new IndexSetExtender(VarSizeList(), profCalc);
+}
+
+uint32 IndexSetExtender_count(const PIndexSetExtender ext) {
+    return ext->count();
+}
+
+double IndexSetExtender_min_outer(const PIndexSetExtender ext) {
+    return ext->GetMinOuterProfit();
+}
+
+PVarSizeList IndexSetExtender_extend(PIndexSetExtender ext, double max_prof,
+                                     double **p_profits) {
+    PVarSizeList pRet = new VarSizeList();
+    std::vector<double> new_profits;
+    ext->Extend(max_prof, *pRet, new_profits);
+    if (p_profits) {
+        *p_profits = static_cast<double*>(malloc(sizeof(double) * new_profits.size()));
+        std::copy(new_profits.begin(), new_profits.end(), *p_profits);
+    }
+    return pRet;
+}
+
+void FreeIndexSetExtender(PIndexSetExtender ext){
+    delete ext;
+}
 
 std::vector<ind_t> TDSet(ind_t d, uint32 count, unsigned int base){
     assert(d>=1 && count>=1);
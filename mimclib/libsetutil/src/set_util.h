@@ -11,6 +11,7 @@ extern "C"{
 #else
     typedef void* PProfitCalculator;
     typedef void* PVarSizeList;
+    typedef void* PIndexSetExtender;
     typedef unsigned int bool;
 #endif
 
@@ -37,6 +38,14 @@ extern "C"{
     PVarSizeList GetIndexSet(const PProfitCalculator profCalc,
                              double max_prof, double **p_profits);
 
+    PIndexSetExtender GetIndexSetExtender(const PVarSizeList,
+                                          const PProfitCalculator profCalc);
+    uint32 IndexSetExtender_count(const PIndexSetExtender);
+    double IndexSetExtender_min_outer(const PIndexSetExtender);
+    PVarSizeList IndexSetExtender_extend(PIndexSetExtender, double max_prof,
+                                         double **p_profits);
+    void FreeIndexSetExtender(PIndexSetExtender);
+
     void GenTDSet(ind_t d, ind_t base, ind_t *td_set, uint32 count);
     void TensorGrid(ind_t d, ind_t base, const ind_t *m, ind_t* tensor_grid,
                     uint32 count);
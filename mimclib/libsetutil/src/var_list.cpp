@@ -109,6 +109,52 @@ double VarSizeList::GetMinOuterProfit(const PProfitCalculator profCalc) const {
     return minProf;
 }
 
+IndexSetExtender::IndexSetExtender(const VarSizeList &set,
+                                   const PProfitCalculator profCalc)
+    : m_seen(set), m_profCalc(profCalc), m_count(set.count()) {
+    if (set.count() == 0) {
+        m_seen.push_back(mul_ind_t());
+        m_margin.push({profCalc->CalcLogProf(mul_ind_t()), 0, mul_ind_t()});
+    }
+    for (uint32 k=0;k<set.count();k++)
+        AddMargin(set.get(k));
+}
+
+void IndexSetExtender::AddMargin(const mul_ind_t &ind) {
+    mul_ind_t cur = ind;
+    ind_t max_d = m_profCalc->MaxDim();
+    for (uint32 i=0;i<max_d;i++){
+        cur.step(i, 1);
+        if (!m_seen.has_ind(cur)) {
+            m_seen.push_back(cur);
+            m_margin.push({m_profCalc->CalcLogProf(cur), m_seen.count(), cur});
+        }
+        cur.step(i, -1);
+    }
+}
+
+double IndexSetExtender::GetMinOuterProfit() const {
+    if (m_margin.empty())
+        return std::numeric_limits<double>::infinity();
+    return m_margin.top().prof;
+}
+
+void IndexSetExtender::Extend(double max_prof, VarSizeList &new_set,
+                              std::vector<double> &new_profits) {
+    // Adds to the set, and to new_set in the order of their profits, all
+    // indices whose profit is at most max_prof. This assumes that the
+    // profits are increasing, so that such indices are reachable from
+    // the margin through indices that satisfy the same condition.
+    while (!m_margin.empty() && m_margin.top().prof <= max_prof) {
+        margin_t cur = m_margin.top();
+        m_margin.pop();
+        new_set.push_back(cur.ind);
+        new_profits.push_back(cur.prof);
+        m_count++;
+        AddMargin(cur.ind);
+    }
+}
+
 void VarSizeList::CalculateSetProfit(const PProfitCalculator profCalc,
                                      double *log_error, double *log_work,
                                      uint32 size) const {
@@ -9,6 +9,7 @@ typedef unsigned short ind_t;
 #include <vector>
 #include <map>
 #include <list>
+#include <queue>
 
 class SparseMIndex {
 public:
@@ -311,6 +312,40 @@ protected:
 
 typedef VarSizeList* PVarSizeList;
 
+// An index set together with its outer margin, the indices that are not in
+// the set but follow one of its indices, ordered by profit. Extending the
+// set only visits the added indices and their neighbors.
+class IndexSetExtender {
+public:
+    IndexSetExtender(const VarSizeList &set, const PProfitCalculator profCalc);
+
+    uint32 count() const { return m_count; }
+    double GetMinOuterProfit() const;
+    void Extend(double max_prof, VarSizeList &new_set,
+                std::vector<double> &new_profits);
+
+protected:
+    void AddMargin(const mul_ind_t &ind);
+
+    struct margin_t {
+        double prof;
+        size_t order;   // Indices of equal profit are added in this order
+        mul_ind_t ind;
+    };
+    struct margin_greater {
+        bool operator()(const margin_t &a, const margin_t &b) const {
+            return a.prof > b.prof || (a.prof == b.prof && a.order > b.order);
+        }
+    };
+    std::priority_queue<margin_t, std::vector<margin_t>,
+                        margin_greater> m_margin;
+    VarSizeList m_seen;     // The set and its margin
+    PProfitCalculator m_profCalc;
+    uint32 m_count;
+};
+
+typedef IndexSetExtender* PIndexSetExtender;
+
 
 inline std::ostream& operator<< (std::ostream& out, const mul_ind_t& v) {
     out << "[";
@@ -4,8 +4,12 @@ from __future__ import print_function
 
 import numpy as np
 import itertools
+import math
 import warnings
+import time
+import os
 from . import setutil
+from .trace import Tracer, LatencyHistogram, null_phase
 
 __all__ = []
 
@@ -20,40 +24,355 @@ def compute_raw_moments(psums, M, empty_value=0):
     '''
     idx = M != 0
     val = np.empty_like(psums, dtype=np.float)
-    val[idx, :] = psums[idx, :] / np.tile(M[idx].reshape((-1,1)),
-                                          (1, psums.shape[1]))
-    val[M == 0, :] = empty_value
+    val[idx, :] = psums[idx, :] / M[idx, None]
+    val[~idx, :] = empty_value
     return val
 
-def compute_central_moment(psums, M, moment, empty_value=0):
+@public
+def compute_power_sums(x, moments, center=0.):
     '''
-    Returns the centralized moments or empty_value when M=0.
+    Returns the sums of (x-center)**p over the samples x for p=1..moments,
+    in one pass over x using running products.
     '''
-    raw = compute_raw_moments(psums, M, empty_value=empty_value)
-    if moment == 1:
-        return raw[:, 0]
-    n = moment
-    val = (-1)**n * raw[:, 0]**n
-    # From http://mathworld.wolfram.com/CentralMoment.html
-    nfact = np.math.factorial(n)
-    for k in range(1, moment+1):
-        nchoosek = nfact / (np.math.factorial(k) * np.math.factorial(n-k))
-        val += nchoosek * (-1)**(n-k) * raw[:, k-1] * raw[:, 0]**(n-k)
-    if moment % 2 == 1:
-        return val
-    # The moment should be positive
-    if np.min(val)<0.0:
+    dev = np.array(x, dtype=np.float).reshape(-1) - center
+    val = np.empty(moments)
+    prod = dev.copy()
+    for p in range(1, moments+1):
+        val[p-1] = np.sum(prod)
+        if p < moments:
+            prod *= dev
+    return val
+
+def _shift_power_sums(S, c):
+    '''
+    Given S[:, k], the sums of x**k for k=0..P of every level, returns the
+    sums of (x+c)**p for p=1..P, using the binomial expansion
+    sum_k nchoosek(p, k) c**(p-k) S[:, k].
+    '''
+    P = S.shape[1]-1
+    # cpow[:, j] is c**j
+    cpow = np.empty((len(c), P+1))
+    cpow[:, 0] = 1
+    for j in range(1, P+1):
+        cpow[:, j] = cpow[:, j-1] * c
+    val = np.empty((S.shape[0], P))
+    for p in range(1, P+1):
+        coeff = np.array([_nchoosek(p, k) for k in range(0, p+1)],
+                         dtype=np.float)
+        val[:, p-1] = np.sum(coeff * S[:, :p+1] * cpow[:, p::-1], axis=1)
+    return val
+
+@public
+def compute_central_moments(psums, M, empty_value=0):
+    '''
+    Returns the central moments of all orders up to psums.shape[1] of all
+    levels in a matrix, with the mean in the first column, or empty_value
+    when M=0.
+    '''
+    psums = np.atleast_2d(np.array(psums, dtype=np.float))
+    M = np.array(M).reshape(-1)
+    idx = M != 0
+    val = np.empty_like(psums)
+    val[~idx, :] = empty_value
+    mean = psums[idx, 0] / M[idx]
+    val[idx, 1:] = _shift_power_sums(np.hstack((M[idx, None], psums[idx, :])),
+                                     -mean)[:, 1:] / M[idx, None]
+    val[idx, 0] = mean
+    # The even moments should be positive
+    even = val[idx, 1::2]
+    if even.size > 0 and np.min(even) < 0.0:
         """
         There might be kurtosis values that are actually
         zero but slightly negative, smaller in magnitude
         than the machine precision. Fixing these manually.
         """
-        idx = np.abs(val) < np.finfo(float).eps
-        val[idx] = np.abs(val[idx])
-        if np.min(val)<0.0:
-            raise ArithmeticError("Significantly negative even moment! Possible problem in computing sums up to {}.".format(moment))
+        small = np.abs(even) < np.finfo(float).eps
+        even[small] = np.abs(even[small])
+        val[idx, 1::2] = even
+        if np.min(even) < 0.0:
+            raise ArithmeticError("Significantly negative even moment! Possible problem in computing sums up to {}.".format(psums.shape[1]))
     return val
 
+def compute_central_moment(psums, M, moment, empty_value=0):
+    '''
+    Returns the centralized moments or empty_value when M=0.
+    '''
+    return compute_central_moments(psums[:, :moment], M,
+                                   empty_value=empty_value)[:, moment-1]
+
+
+def _grow_buffer(buf, size, count):
+    '''
+    Returns a buffer with room for count rows whose first size rows are
+    those of buf and the rest, up to count, are zeros. When buf is too small
+    its capacity is at least doubled, so that growing one row at a time
+    takes amortized constant time.
+    '''
+    if count > buf.shape[0]:
+        new = np.empty((max(count, 2*buf.shape[0]),) + buf.shape[1:],
+                       dtype=buf.dtype)
+        new[:size] = buf[:size]
+        buf = new
+    buf[size:count] = 0
+    return buf
+
+
+def _nchoosek(n, k):
+    return math.factorial(n) // (math.factorial(k) * math.factorial(n-k))
+
+
+@public
+class MomentAccumulator(object):
+
+    """
+    Accumulates, for every level, the number of samples, their mean and
+    the sums of powers of their deviations from the mean (central sums).
+
+    Unlike raw power sums, central sums of two sets of samples can be
+    merged without catastrophic cancellation using the pairwise updates of
+    Chan et al. as generalized to arbitrary moments by Pebay (2008).
+
+    """
+
+    def __init__(self, M, mean, csums):
+        # The arrays are buffers whose first _count rows are used
+        self._M = M            # Number of samples
+        self._mean = mean      # Mean of samples
+        self._csums = csums    # csums[:, p-1] is sum((x-mean)**p)
+        self._count = len(M)
+
+    @property
+    def M(self):
+        return self._M[:self._count]
+
+    @property
+    def mean(self):
+        return self._mean[:self._count]
+
+    @property
+    def csums(self):
+        return self._csums[:self._count]
+
+    @staticmethod
+    def zeros(count, moments):
+        return MomentAccumulator(np.zeros(count, dtype=np.int),
+                                 np.zeros(count),
+                                 np.zeros((count, moments)))
+
+    @staticmethod
+    def from_samples(x, moments):
+        '''
+        Returns an accumulator with a single level containing the samples x
+        '''
+        x = np.array(x, dtype=np.float).reshape(-1)
+        acc = MomentAccumulator.zeros(1, moments)
+        if len(x) == 0:
+            return acc
+        acc.M[0] = len(x)
+        acc.mean[0] = np.mean(x)
+        acc.csums[0, :] = compute_power_sums(x, moments, center=acc.mean[0])
+        acc.csums[0, 0] = 0
+        return acc
+
+    @staticmethod
+    def from_psums(psums, M, center=0.):
+        '''
+        Returns an accumulator from the sums psums of the powers of the
+        deviations of the samples from center, as computed by
+        compute_power_sums. This is as accurate as the psums themselves,
+        which lose the variance to cancellation unless center is close to
+        the mean.
+        '''
+        psums = np.atleast_2d(np.array(psums, dtype=np.float))
+        M = np.array(M).reshape(-1)
+        center = np.broadcast_to(np.array(center, dtype=np.float), M.shape)
+        acc = MomentAccumulator.zeros(len(M), psums.shape[1])
+        idx = M != 0
+        shift = np.zeros(len(M))
+        shift[idx] = psums[idx, 0] / M[idx]
+        acc.M[:] = M
+        acc.mean[:] = center + shift
+        acc.mean[~idx] = 0
+        acc.csums[:, :] = _shift_power_sums(np.hstack((acc.M.reshape((-1, 1)),
+                                                       psums)), -shift)
+        acc.csums[:, 0] = 0
+        return acc
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, ind):
+        # Slices are views, sharing the data of this accumulator
+        return MomentAccumulator(self.M[ind].reshape(-1),
+                                 self.mean[ind].reshape(-1),
+                                 self.csums[ind, :].reshape((-1, self.moments())))
+
+    def moments(self):
+        return self._csums.shape[1]
+
+    def resize(self, count):
+        self._M = _grow_buffer(self._M, self._count, count)
+        self._mean = _grow_buffer(self._mean, self._count, count)
+        self._csums = _grow_buffer(self._csums, self._count, count)
+        self._count = count
+
+    def psums(self):
+        '''
+        Returns the raw sums of powers of the samples
+        '''
+        C = np.hstack((self.M.reshape((-1, 1)), self.csums))
+        C[:, 1] = 0
+        return _shift_power_sums(C, self.mean)
+
+    def central_moment(self, moment, empty_value=0):
+        '''
+        Returns the central moments (or the mean when moment is 1) or
+        empty_value when M=0.
+        '''
+        if moment > self.moments():
+            raise ValueError("The {}'th moment was not computed".format(moment))
+        idx = self.M != 0
+        val = np.empty(len(self))
+        val[~idx] = empty_value
+        if moment == 1:
+            val[idx] = self.mean[idx]
+        else:
+            val[idx] = self.csums[idx, moment-1] / self.M[idx]
+        return val
+
+    def central_moments(self, empty_value=0):
+        '''
+        Returns all the central moments of all levels in a matrix, with the
+        mean in the first column, or empty_value when M=0.
+        '''
+        idx = self.M != 0
+        val = np.empty((len(self), self.moments()))
+        val[~idx, :] = empty_value
+        val[idx, :] = self.csums[idx, :] / self.M[idx, None]
+        val[idx, 0] = self.mean[idx]
+        return val
+
+    def merge(self, other, ind=None):
+        '''
+        Adds the samples in other to the levels ind (all levels by default)
+        '''
+        ind = np.arange(len(self)) if ind is None else \
+              np.array(ind, dtype=np.int).reshape(-1)
+        assert(len(ind) == len(other) and self.moments() == other.moments())
+        nA = self.M[ind].astype(np.float)
+        nB = other.M.astype(np.float)
+        # Levels that had no samples simply take the new ones
+        empty = nA == 0
+        self.M[ind[empty]] = other.M[empty]
+        self.mean[ind[empty]] = other.mean[empty]
+        self.csums[ind[empty], :] = other.csums[empty, :]
+
+        sel = np.logical_and(~empty, nB > 0)
+        ind, nA, nB = ind[sel], nA[sel], nB[sel]
+        n = nA + nB
+        delta = other.mean[sel] - self.mean[ind]
+        cA = self.csums[ind, :]
+        cB = other.csums[sel, :]
+        for p in range(2, self.moments()+1):
+            val = cA[:, p-1] + cB[:, p-1] + \
+                  (nA*nB*delta/n)**p * (1./nB**(p-1) - (-1./nA)**(p-1))
+            for k in range(1, p-1):
+                val += _nchoosek(p, k) * (cA[:, p-k-1] * (-nB*delta/n)**k +
+                                          cB[:, p-k-1] * (nA*delta/n)**k)
+            self.csums[ind, p-1] = val
+        self.mean[ind] += nB * delta / n
+        self.M[ind] += other.M[sel]
+        return self
+
+
+@public
+class LevelSet(object):
+
+    """
+    Stores multi-index levels as the rows of a compact matrix together
+    with a hash index from every level to its row, so that membership
+    and neighbor queries take constant time.
+
+    Indexing with an integer returns the level as a list, while indexing
+    with a slice or a mask returns a new LevelSet.
+
+    """
+
+    def __init__(self, dim, lvls=None):
+        self.dim = dim
+        self._lvls = np.empty((0, dim), dtype=setutil.ind_t)  # Buffer
+        self._count = 0
+        self._index = dict()    # Built lazily for slices
+        if lvls is not None and len(lvls) > 0:
+            self.extend(lvls)
+
+    def _rows(self):
+        return self._lvls[:self._count]
+
+    def _getIndex(self):
+        if self._index is None:
+            self._index = dict((tuple(lvl), i) for i, lvl in
+                               enumerate(self._rows().tolist()))
+        return self._index
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, ind):
+        if isinstance(ind, (int, np.integer)):
+            return self._rows()[ind].tolist()
+        # Slices are views of the levels of this set
+        sub = LevelSet(self.dim)
+        sub._lvls = self._rows()[ind].reshape((-1, self.dim))
+        sub._count = sub._lvls.shape[0]
+        sub._index = None
+        return sub
+
+    def __iter__(self):
+        return iter(self._rows().tolist())
+
+    def __contains__(self, lvl):
+        return tuple(lvl) in self._getIndex()
+
+    def __array__(self, dtype=None, copy=None):
+        return self._rows().astype(dtype or np.int)
+
+    def find(self, lvl):
+        '''
+        Returns the row of lvl or None if lvl is not in the set
+        '''
+        return self._getIndex().get(tuple(lvl))
+
+    def tolist(self):
+        return self._rows().tolist()
+
+    def extend(self, new_lvls):
+        new_lvls = np.array(new_lvls, dtype=setutil.ind_t).reshape((-1, self.dim))
+        index = self._getIndex()
+        start = self._count
+        new_index = dict()
+        for i, lvl in enumerate(new_lvls.tolist(), start):
+            if tuple(lvl) in index or tuple(lvl) in new_index:
+                raise ValueError("Level {} is already in the set".format(lvl))
+            new_index[tuple(lvl)] = i
+        # The set is unchanged if any level is a duplicate
+        index.update(new_index)
+        self._count += new_lvls.shape[0]
+        self._lvls = _grow_buffer(self._lvls, start, self._count)
+        self._lvls[start:self._count] = new_lvls
+
+    def has_next(self, i, ind=None):
+        '''
+        Returns a boolean array that is True for every level l, or only
+        for the rows ind, such that l+e_i is also in the set
+        '''
+        index = self._getIndex()
+        nxt = (self._rows() if ind is None else self._rows()[ind]).tolist()
+        for lvl in nxt:
+            lvl[i] += 1
+        return np.array([tuple(lvl) in index for lvl in nxt],
+                        dtype=np.bool)
+
 
 @public
 class MIMCData(object):
@@ -68,23 +387,43 @@ class MIMCData(object):
     """
 
     def __init__(self, dim, lvls=None, psums=None, t=None, M=None,
-                 moments=2):
+                 moments=2, acc=None):
         self.dim = dim
         self.lvls = lvls          # MIMC lvls
-        self.psums = psums        # sums of lvls
-        self.t = t                # Time of lvls
-        self.M = M                # Number of samples in each lvl
-        if self.lvls is None:
-            self.lvls = []
-        if self.psums is None:
-            self.psums = np.empty((0, moments))
-        if self.t is None:
-            self.t = np.empty(0)
-        if self.M is None:
-            self.M = np.empty(0, dtype=np.int)
-        assert(len(self.lvls) == self.psums.shape[0])
-        assert(len(self.lvls) == self.M.shape[0])
-        assert(len(self.lvls) == self.t.shape[0])
+        self._t = t               # Time of lvls
+        if not isinstance(self.lvls, LevelSet):
+            self.lvls = LevelSet(dim, lvls)
+        if self._t is None:
+            self._t = np.empty(0)
+        if acc is None:
+            if psums is None:
+                psums = np.empty((0, moments))
+            if M is None:
+                M = np.empty(0, dtype=np.int)
+            assert(len(self.lvls) == psums.shape[0])
+            acc = MomentAccumulator.from_psums(psums, M)
+        self.acc = acc            # Moments of samples in each lvl
+        assert(len(self.lvls) == len(self.acc))
+        assert(len(self.lvls) == self._t.shape[0])
+
+    @property
+    def t(self):
+        # Time of lvls
+        return self._t[:len(self.acc)]
+
+    @t.setter
+    def t(self, value):
+        self._t[:len(self.acc)] = value
+
+    @property
+    def M(self):
+        # Number of samples in each lvl
+        return self.acc.M
+
+    @property
+    def psums(self):
+        # Sums of powers of samples in each lvl
+        return self.acc.psums()
 
     def calcEg(self):
         """
@@ -97,16 +436,17 @@ class MIMCData(object):
         return len(self.lvls)
 
     def __getitem__(self, ind):
+        # Slices are views, sharing the data of this object
         return MIMCData(self.dim,
-                        lvls=np.array(self.lvls, dtype=object)[ind].reshape((-1,self.dim)).tolist(),
-                        psums=self.psums[ind, :].reshape((-1, self.psums.shape[1])),
-                        t=self.t[ind].reshape(-1), M=self.M[ind].reshape(-1))
+                        lvls=self.lvls[ind],
+                        acc=self.acc[ind],
+                        t=self.t[ind].reshape(-1))
 
     def Dim(self):
         return self.dim
 
     def computedMoments(self):
-        return self.psums.shape[1]
+        return self.acc.moments()
 
     def calcVl(self):
         return self.calcCentralMoment(2, empty_value=np.inf)
@@ -116,17 +456,25 @@ class MIMCData(object):
         Returns the sample estimators for moments
         for each level.
         '''
-        if moment > self.psums.shape[1]:
+        if moment > self.computedMoments():
             raise ValueError("The {}'th moment was not computed".format(moment))
         assert(moment > 0)
+        if moment == 1:
+            return self.acc.central_moment(1, empty_value=0)
         idx = self.M != 0
         val = np.zeros_like(self.M, dtype=np.float)
         val[idx] = self.psums[idx, moment-1] / self.M[idx]
         return val
 
     def calcCentralMoment(self, moment, empty_value=np.inf):
-        return compute_central_moment(self.psums, self.M, moment,
-                                      empty_value=empty_value)
+        return self.acc.central_moment(moment, empty_value=empty_value)
+
+    def calcCentralMoments(self, empty_value=np.inf):
+        '''
+        Returns all computed central moments of all levels, with the mean
+        in the first column.
+        '''
+        return self.acc.central_moments(empty_value=empty_value)
 
     def calcTl(self):
         idx = self.M != 0
@@ -138,26 +486,29 @@ class MIMCData(object):
         return np.sum(self.t)
 
     def addSamples(self, psums, M, t):
-        assert psums.shape[0] == len(M) and len(M) == len(t) and np.min(M) >= 0, \
+        '''
+        Adds samples to all levels. psums is either a MomentAccumulator
+        or an array of sums of powers of the samples.
+        '''
+        if not isinstance(psums, MomentAccumulator):
+            psums = MomentAccumulator.from_psums(psums, M)
+        assert len(psums) == len(M) and len(M) == len(t) and np.min(M) >= 0, \
             "Inconsistent arguments "
 
-        self.psums += psums
-        self.M += M
+        self.acc.merge(psums)
         self.t += t
 
     def zero_samples(self):
-        self.M = np.zeros_like(self.M)
         self.t = np.zeros_like(self.t)
-        self.psums = np.zeros_like(self.psums)
+        self.acc = MomentAccumulator.zeros(len(self.acc), self.acc.moments())
 
     def addLevels(self, new_lvls):
         assert(len(new_lvls) > 0)
         prev = len(self.lvls)
         self.lvls.extend(new_lvls)
         s = len(self.lvls)
-        self.psums.resize((s, self.psums.shape[1]), refcheck=False)
-        self.t.resize(s, refcheck=False)
-        self.M.resize(s, refcheck=False)
+        self.acc.resize(s)
+        self._t = _grow_buffer(self._t, prev, s)
         return prev
 
 
@@ -190,12 +541,28 @@ class MIMCRun(object):
         self.fnWorkModel = None
         self.fnSampleLvl = None
         self.fnSampleQoI = None
+        self.fnSampleQoIBatch = None
         self.fnItrDone = None
         self.fnExtendLvls = None
         self.Vl_estimate = None
         self.Wl_estimate = None
         self.bias = np.inf           # Approximation of the discretization error
         self.stat_error = np.inf     # Sampling error (based on M)
+        # Per-level estimates, recomputed only for levels that changed
+        self._VlCache = _LevelCache(lambda data: data.calcVl())
+        self._WlCache = _LevelCache(lambda data: self.fnWorkModel(data.lvls))
+        self._ElCache = _LevelCache(lambda data: data.calcEl())
+        self._bndCache = _BoundaryCache()
+        self._workFit = None         # (w0, a, rates) of the fitted work model
+        self._pool = None
+        self._itrState = None        # TOL iteration, used for checkpoints
+        self._lastCheckpoint = 0
+        self.tracer = None
+        if hasattr(self.params, "trace"):
+            self.tracer = Tracer()
+        self.streams = None
+        if hasattr(self.params, "seed") and self.params.seed >= 0:
+            self.streams = RandomStreams(self.params.seed)
         if old_data is not None:
             assert(old_data.dim == self.params.dim)
             self.all_data = self.data = old_data
@@ -224,6 +591,9 @@ supported in one dimensional problem")
     def _checkFunctions(self):
         # If self.params.reuse_samples is True then
         # all_data will always equal data
+        if self.fnWorkModel is None and hasattr(self.params, "fit_work_model") \
+           and self.params.fit_work_model:
+            self.fnWorkModel = self._fittedWorkModel
         if self.fnWorkModel is None and hasattr(self.params, "gamma"):
             self.fnWorkModel = lambda lvls: work_estimate(lvls,
                                                           np.log(self.params.beta) *
@@ -234,16 +604,9 @@ supported in one dimensional problem")
                                                              self.params.h0inv,
                                                              np.array(self.params.beta))
 
-        if self.params.bayesian and self.fnWorkModel is None:
-            raise NotImplementedError("Bayesian parameter fitting is only \
-supported with a given work model")
-
         if self.fnWorkModel is None:
-            # ADDING WORK MODEL B
             warnings.warn("fnWorkModel is not provided, using run-time estimates.")
-            raise NotImplemented("Need to check that the lvls \
-are the same as the argument ones")
-            self.fnWorkModel = lambda lvls: self.Tl()
+            self.fnWorkModel = self._fittedWorkModel
         # self.fnExtendLvls = self.fnExtendLvls or \
         #                     (lambda: extend_lvls_tensor(self.data.dim,
         #                                                 self.data.lvls,
@@ -257,24 +620,46 @@ are the same as the argument ones")
             if len(weights) == 1:
                 weights = weights[0]*np.ones(self.params.dim)
 
-            self.fnExtendLvls = lambda w=weights: extend_lvls_td(w,
-                                                                 self.data.lvls,
-                                                                 self.params.M0,
-                                                                 self.params.min_lvls/self.params.dim)
+            extend = _TDLevelsExtender(weights,
+                                       self.params.min_lvls/self.params.dim)
+            self.fnExtendLvls = lambda: extend(self.data.lvls, self.params.M0)
+        # Samples are only timed one by one for the latency histograms of
+        # the trace, which costs a call to time.time() per sample
+        latency = self.tracer is not None and self.tracer.record
         if self.fnSampleQoI is not None:
-            if self.fnSampleLvl is not None:
+            if self.fnSampleLvl is not None or self.fnSampleQoIBatch is not None:
                 raise ValueError("Cannot set both fnSampleLvl and fnSampleQoI")
-            self.fnSampleLvl = lambda *a: GenericSampleLvl(self.fnSampleQoI, *a)
+            self.fnSampleLvl = lambda *a: GenericSampleLvl(self.fnSampleQoI, *a,
+                                                           latency=latency)
+
+        if self.fnSampleQoIBatch is not None:
+            if self.fnSampleLvl is not None:
+                raise ValueError("Cannot set both fnSampleLvl and fnSampleQoIBatch")
+            batch_size = self.params.batch_size \
+                         if hasattr(self.params, "batch_size") else 1000
+            self.fnSampleLvl = lambda *a: GenericSampleLvlBatch(self.fnSampleQoIBatch,
+                                                                *a,
+                                                                batch_size=batch_size,
+                                                                latency=latency)
 
         if self.fnSampleLvl is None:
-            raise ValueError("Must set the sampling functions fnSampleLvl or fnSampleQoI")
+            raise ValueError("Must set the sampling functions fnSampleLvl, \
+fnSampleQoI or fnSampleQoIBatch")
 
     def setFunctions(self, **kwargs):
         # fnExtendLvls(): Returns new lvls and number of samples on each.
         #    called only once if the Bayesian method is used
         # fnSampleLvl(moments, mods, inds, M):
         #    Returns M, array: M sums of mods*inds, and total
-        #    (linear) time it took to compute them
+        #    (linear) time it took to compute them. The array can be
+        #    replaced by a MomentAccumulator of a single level, which is
+        #    more accurate for higher moments. A fourth returned item, a
+        #    trace.LatencyHistogram of the time of the samples, is used
+        #    by -mimc_trace instead of the average time of the block
+        # fnSampleQoI(inds): Returns an array of the QoI computed at
+        #    every index in inds for a single sample
+        # fnSampleQoIBatch(inds, M): Returns an (M, len(inds)) array of
+        #    the QoI computed at every index in inds for M samples
         # fnItrDone(i, TOLs, totalTime): Called at the end of iteration
         #    i out of TOLs
         # fnWorkModel(lvls): Returns work estimate of lvls
@@ -282,7 +667,8 @@ are the same as the argument ones")
         for k in kwargs.keys():
             if k not in ["fnExtendLvls", "fnSampleLvl",
                          "fnItrDone", "fnWorkModel",
-                         "fnHierarchy", "fnSampleQoI"]:
+                         "fnHierarchy", "fnSampleQoI",
+                         "fnSampleQoIBatch"]:
                 raise KeyError("Invalid function name")
             setattr(self, k, kwargs[k])
 
@@ -336,6 +722,10 @@ with get_geometric_hl. Not needed if fnHierarchy is provided.")
         add_store('gamma', type=float, nargs='+',
                   help="Work exponent to be used with work_estimate.\
 Not needed if fnWorkModel and fnExtendLvls are provided.")
+        add_store('fit_work_model', type='bool', default=False,
+                  help="Use a work model fitted to the measured run time \
+of the levels instead of work_estimate with -gamma. The fitted model is \
+always used if neither fnWorkModel nor -gamma are provided.")
 
         # The following arguments are not needed if bayes is False
         if default_bayes:
@@ -382,6 +772,31 @@ for tolerance smaller than TOL. Not needed if TOLs is provided to doRun.")
             add_store('h0inv', type=float, nargs='+', default=2,
                       help="Minimum element size get_geometric_hl. \
 Not needed if fnHierarchy is provided.")
+            add_store('workers', type=int, default=1,
+                      help="Number of worker processes used to generate \
+samples. Samples are generated in the main process if this is 1.")
+            add_store('seed', type=int, default=-1,
+                      help="Seed from which an independent random stream is \
+derived for every block of samples. The samples then do not depend on -workers. \
+Negative values disable the streams.")
+            add_store('block_size', type=int, default=0,
+                      help="Maximum number of samples sent to a worker in a \
+single call to fnSampleLvl. Non-positive values send all samples of a level \
+in one block.")
+            add_store('checkpoint', type=str,
+                      help="File to which the state of the run is \
+periodically saved. A run can be continued from this file using resume.")
+            add_store('checkpoint_interval', type=float, default=0,
+                      help="Minimum number of seconds between checkpoints. \
+Not needed if -checkpoint is not provided.")
+            add_store('trace', type=str,
+                  help="File to which a trace of the phases of the run and \
+the latency of the samples of every level are written at the end of the \
+run, as JSON lines if the name ends with .jsonl and as a Chrome trace \
+otherwise.")
+            add_store('batch_size', type=int, default=1000,
+                      help="Maximum number of samples requested in a single \
+call to fnSampleQoIBatch. Not needed if fnSampleQoIBatch is not provided.")
         return mimcgrp
 
     def calcTotalWork(self):
@@ -414,10 +829,10 @@ Bias={:.12e}\nStatErr={:.12e}\
     ################## Bayesian specific functions
     def _estimateBias(self):
         if not self.params.bayesian:
-            bnd = is_boundary(self.data.dim, self.data.lvls)
+            bnd = self._bndCache.update(self.data.dim, self.data.lvls)
             if np.sum(bnd) == len(self.data.lvls):
                 return np.inf
-            bnd_val = self.data[bnd].calcEl()
+            bnd_val = self._ElCache.update(self.data)[bnd]
             if self.params.abs_bnd:
                 return np.abs(np.sum(np.abs(bnd_val)))
             return np.abs(np.sum(bnd_val))
@@ -438,11 +853,12 @@ Bias={:.12e}\nStatErr={:.12e}\
         if L <= 1:
             raise Exception("Must have at least 2 levels")
         hl = self.fnHierarchy(np.arange(0, L+1).reshape((-1, 1))).reshape(1, -1)[0]
-        M = np.concatenate((self.all_data[1:].M, np.zeros(L-oL)))
-        s1 = np.concatenate((self.all_data.psums[1:, 0], np.zeros(L-oL)))
-        m1 = np.concatenate((self.all_data[1:].calcEl(), np.zeros(L-oL)))
-        s2 = np.concatenate((self.all_data.psums[1:, 1],
-                             np.zeros(L-oL)))
+        fine = self.all_data[1:]
+        psums = fine.psums
+        M = np.concatenate((fine.M, np.zeros(L-oL)))
+        s1 = np.concatenate((psums[:, 0], np.zeros(L-oL)))
+        m1 = np.concatenate((fine.calcEl(), np.zeros(L-oL)))
+        s2 = np.concatenate((psums[:, 1], np.zeros(L-oL)))
         mu = self.Q.W*(hl[:-1]**self.Q.w[0] - hl[1:]**self.Q.w[0])
         Lambda = 1./(self.Q.S*(hl[:-1]**(self.Q.s[0]/2.) - hl[1:]**(self.Q.s[0]/2.))**2)
         G_3 = self.params.bayes_k1 * Lambda + M/2.0
@@ -502,42 +918,187 @@ estimate optimal number of levels"
         return minL
 
     ################## END: Bayesian specific function
+    def _fittedWorkModel(self, lvls):
+        if self._workFit is None:
+            return np.ones(len(lvls))   # No timings yet, assume equal work
+        w0, a, rates = self._workFit
+        return w0 + np.exp(a) * work_estimate(lvls, rates)
+
+    def _estimateWorkModel(self):
+        if self.fnWorkModel != self._fittedWorkModel:
+            return
+        idx = self.all_data.M > 0
+        if not np.any(idx):
+            return
+        fit = fit_work_model(self.all_data.lvls[idx],
+                             self.all_data[idx].calcTl())
+        if fit is None:
+            return   # Keep the previous fit
+        self._workFit = fit
+        self._WlCache.clear()   # All levels depend on the fit
+
+    def addTraceHook(self, fn):
+        '''
+        Calls fn(name, start, duration, args) at the end of every phase of
+        the run, see trace.Tracer. Hooks do not need -mimc_trace, without
+        which the events are only passed to the hooks.
+        '''
+        if self.tracer is None:
+            self.tracer = Tracer(record=False)
+        self.tracer.addHook(fn)
+
+    def _phase(self, name, **args):
+        # Times a phase of the run if tracing is enabled
+        if self.tracer is None:
+            return null_phase()
+        return self.tracer.phase(name, **args)
+
     def _estimateAll(self):
-        self._estimateQParams()
-        self.Vl_estimate = self.all_data.calcVl() if not self.params.bayesian \
-                           else self._estimateBayesianVl()
-        self.Wl_estimate = self.fnWorkModel(self.data.lvls)
-        self.bias = self._estimateBias()
-        self.stat_error = np.inf if np.any(self.data.M == 0) \
-                          else self.params.Ca * \
-                               np.sqrt(np.sum(self.Vl_estimate / self.data.M))
+        with self._phase("estimate"):
+            self._estimateQParams()
+            self._estimateWorkModel()
+            self.Vl_estimate = self._VlCache.update(self.all_data) \
+                               if not self.params.bayesian \
+                                  else self._estimateBayesianVl()
+            self.Wl_estimate = self._WlCache.update(self.data)
+            self.bias = self._estimateBias()
+            self.stat_error = np.inf if np.any(self.data.M == 0) \
+                              else self.params.Ca * \
+                                   np.sqrt(np.sum(self.Vl_estimate / self.data.M))
 
     def _addLevels(self, lvls):
         self.data.addLevels(lvls)
         if self.all_data != self.data:
             self.all_data.addLevels(lvls)
 
+    def _startWorkers(self):
+        workers = self.params.workers if hasattr(self.params, "workers") else 1
+        if workers <= 1:
+            return
+        import multiprocessing
+        # Workers must be forked so that they inherit fnSampleLvl, which
+        # is usually a closure that cannot be pickled.
+        ctx = multiprocessing.get_context("fork") \
+              if hasattr(multiprocessing, "get_context") else multiprocessing
+        self._pool = ctx.Pool(processes=workers,
+                              initializer=_init_sampling_worker,
+                              initargs=(self.fnSampleLvl,))
+
+    def _stopWorkers(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
     def _genSamples(self, totalM, verbose):
         lvls = self.data.lvls
         s = len(lvls)
         M = np.zeros(s, dtype=np.int)
-        psums = np.zeros_like(self.data.psums)
-        p = np.arange(1, psums.shape[1]+1)
+        psums = MomentAccumulator.zeros(s, self.data.computedMoments())
+        p = np.arange(1, psums.moments()+1)
         t = np.zeros(s)
+        block_size = self.params.block_size \
+                     if hasattr(self.params, "block_size") else 0
+        blocks = []
         for i in range(0, s):
             if totalM[i] <= self.data.M[i]:
                 continue
             if verbose:
                 print("# Doing", totalM[i]-self.data.M[i], "of level", lvls[i])
             mods, inds = lvl_to_inds_general(lvls[i])
-            M[i], psums[i, :], t[i] = self.fnSampleLvl(p, mods, inds,
-                                                       totalM[i] -
-                                                       self.data.M[i])
+            blocksM = split_samples(totalM[i]-self.data.M[i], block_size)
+            seeds = [None] * len(blocksM) if self.streams is None \
+                    else self.streams.nextBlocks(lvls[i], len(blocksM))
+            blocks.extend([(i, (seed, (p, mods, inds, blockM)))
+                           for seed, blockM in zip(seeds, blocksM)])
+
+        args = [b[1] for b in blocks]
+        with self._phase("sample", blocks=len(args)):
+            if self._pool is not None:
+                results = self._pool.map(_sample_block, args, chunksize=1)
+            else:
+                results = [_call_sampler(self.fnSampleLvl, *a) for a in args]
+
+        # Reduce in the order of the blocks so that the sums do not
+        # depend on the scheduling of the workers
+        for (i, _), (start, pid, res) in zip(blocks, results):
+            blockM, blockPsums, blockT = res[:3]
+            if self.tracer is not None:
+                self.tracer.addSampleBlock(lvls[i], blockM, blockT,
+                                           start=start, pid=pid,
+                                           latency=res[3] if len(res) > 3
+                                           else None)
+            if not isinstance(blockPsums, MomentAccumulator):
+                blockPsums = MomentAccumulator.from_psums(blockPsums,
+                                                          np.array([blockM]))
+            M[i] += blockM
+            psums.merge(blockPsums, i)
+            t[i] += blockT
         self.data.addSamples(psums, M, t)
         if self.all_data != self.data:
             self.all_data.addSamples(psums, M, t)
         self._estimateAll()
 
+    def _saveCheckpoint(self, force=False):
+        if not hasattr(self.params, "checkpoint") or self._itrState is None:
+            return
+        interval = self.params.checkpoint_interval \
+                   if hasattr(self.params, "checkpoint_interval") else 0
+        if not force and time.time() - self._lastCheckpoint < interval:
+            return
+        with self._phase("checkpoint"):
+            self._writeCheckpoint()
+        self._lastCheckpoint = time.time()
+
+    def _writeCheckpoint(self):
+        import json
+        finalTOL, TOLs, itrIndex, tic = self._itrState
+        arrays = _data_to_arrays(self.data, "")
+        if self.all_data != self.data:
+            arrays.update(_data_to_arrays(self.all_data, "all_"))
+        if self.Vl_estimate is not None:
+            arrays["Vl_estimate"] = self.Vl_estimate
+            arrays["Wl_estimate"] = self.Wl_estimate
+        if self.streams is not None:
+            arrays["stream_lvls"] = np.array(list(self.streams.blocks.keys()),
+                                             dtype=np.int).reshape((-1, self.data.dim))
+            arrays["stream_blocks"] = np.array(list(self.streams.blocks.values()),
+                                               dtype=np.int)
+        tojson = lambda d: json.dumps(d, default=lambda x: np.array(x).tolist())
+        # Write to a temporary file first, so that a preempted write does
+        # not destroy the previous checkpoint
+        tmp = self.params.checkpoint + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, params=tojson(self.params.getDict()),
+                     Q=tojson(self.Q.getDict()),
+                     finalTOL=finalTOL, TOLs=TOLs, itrIndex=itrIndex,
+                     itrTime=time.time() - tic,
+                     bias=self.bias, stat_error=self.stat_error, **arrays)
+        os.rename(tmp, self.params.checkpoint)
+
+    def _loadCheckpoint(self, path):
+        import json
+        with np.load(path) as f:
+            params = json.loads(str(f["params"]))
+            if params["dim"] != self.params.dim or \
+               params["moments"] != self.params.moments:
+                raise ValueError("Checkpoint was written by a run with \
+different dim or moments")
+            self.all_data = self.data = _data_from_arrays(f, "", self.data.dim)
+            if "all_t" in f:
+                self.all_data = _data_from_arrays(f, "all_", self.data.dim)
+            if "Vl_estimate" in f:
+                self.Vl_estimate = f["Vl_estimate"]
+                self.Wl_estimate = f["Wl_estimate"]
+            if "stream_blocks" in f and self.streams is not None:
+                self.streams.blocks = dict(zip(map(tuple, f["stream_lvls"].tolist()),
+                                               f["stream_blocks"].tolist()))
+            self.Q = MyDefaultDict(**json.loads(str(f["Q"])))
+            self.bias = float(f["bias"])
+            self.stat_error = float(f["stat_error"])
+            return (float(f["finalTOL"]), f["TOLs"], int(f["itrIndex"]),
+                    float(f["itrTime"]))
+
     def _calcTheta(self, TOL, bias_est):
         if not self.params.const_theta:
             return 1 - bias_est/TOL
@@ -566,77 +1127,255 @@ estimate optimal number of levels"
         if not all(x >= y for x, y in zip(TOLs, TOLs[1:])):
             raise Exception("Tolerances must be decreasing")
 
-        import time
-        tic = time.time()
         self.Q.theta = self.params.theta
         self.bias = np.inf
         self.stat_error = np.inf
+        self._doTOLs(finalTOL, TOLs, 0, 0., verbose)
+
+    def resume(self, path, verbose=None):
+        '''
+        Continues a run from the checkpoint file path, which was written
+        by a run with the same parameters. The functions must be set
+        as they were for the original run.
+        '''
+        self._checkFunctions()
+        if verbose is None:
+            verbose = self.params.verbose
+        finalTOL, TOLs, itrIndex, itrTime = self._loadCheckpoint(path)
+        self._doTOLs(finalTOL, TOLs, itrIndex, itrTime, verbose)
+
+    def _doTOLs(self, finalTOL, TOLs, startIndex, startTime, verbose):
+        import time
+        tic = time.time() - startTime
         import gc
         def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
             return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
 
-        for itrIndex, TOL in enumerate(TOLs):
-            if verbose:
-                print("# TOL", TOL)
-            while True:
-                gc.collect()
-                if self.params.bayesian and len(self.data.lvls) > 0:
-                    L = self._estimateOptimalL(TOL)
-                    if L > len(self.data.lvls):
-                        self._addLevels(np.arange(len(self.data.lvls),
-                                                  L+1).reshape((-1, 1)))
-                        self._estimateAll()
+        self._startWorkers()
+        try:
+            for itrIndex, TOL in enumerate(TOLs[startIndex:], startIndex):
+                self._itrState = (finalTOL, TOLs, itrIndex, tic)
+                if verbose:
+                    print("# TOL", TOL)
+                while True:
+                    with self._phase("gc"):
+                        gc.collect()
+                    if self.params.bayesian and len(self.data.lvls) > 0:
+                        with self._phase("optimal_L"):
+                            L = self._estimateOptimalL(TOL)
+                        if L > len(self.data.lvls):
+                            self._addLevels(np.arange(len(self.data.lvls),
+                                                      L+1).reshape((-1, 1)))
+                            self._estimateAll()
 
-                self.Q.theta = np.maximum(self._calcTheta(TOL, self.bias),
-                                          self.params.theta)
-                if len(self.data.lvls) == 0 or \
-                   (not self.params.bayesian and self.bias > (1 - self.Q.theta) * TOL):
-                    # Bias is not satisfied (or this is the first iteration)
-                    # Add more levels
-                    newlvls, newTodoM = self.fnExtendLvls()
-                    prev = len(self.data.lvls)
-                    self._addLevels(newlvls)
-                    self._genSamples(np.concatenate((self.data.M[:prev],
-                                                     newTodoM)), verbose)
-                    self._estimateAll()
                     self.Q.theta = np.maximum(self._calcTheta(TOL, self.bias),
                                               self.params.theta)
-
-                todoM = self._calcTheoryM(TOL, self.Q.theta,
-                                          self.Vl_estimate,
-                                          self.Wl_estimate)
-                if verbose:
-                    print("# theta", self.Q.theta)
-                    print("# New M: ", todoM)
-                if not self.params.reuse_samples:
-                    self.data.zero_samples()
-                self._genSamples(todoM, verbose)
+                    if len(self.data.lvls) == 0 or \
+                       (not self.params.bayesian and self.bias > (1 - self.Q.theta) * TOL):
+                        # Bias is not satisfied (or this is the first iteration)
+                        # Add more levels
+                        with self._phase("extend_lvls"):
+                            newlvls, newTodoM = self.fnExtendLvls()
+                        prev = len(self.data.lvls)
+                        self._addLevels(newlvls)
+                        self._genSamples(np.concatenate((self.data.M[:prev],
+                                                         newTodoM)), verbose)
+                        self._estimateAll()
+                        self.Q.theta = np.maximum(self._calcTheta(TOL, self.bias),
+                                                  self.params.theta)
+
+                    todoM = self._calcTheoryM(TOL, self.Q.theta,
+                                              self.Vl_estimate,
+                                              self.Wl_estimate)
+                    if verbose:
+                        print("# theta", self.Q.theta)
+                        print("# New M: ", todoM)
+                    if not self.params.reuse_samples:
+                        self.data.zero_samples()
+                    self._genSamples(todoM, verbose)
+                    if verbose:
+                        print(self, end="")
+                        print("------------------------------------------------")
+                    if self.params.bayesian or self.totalErrorEst() < TOL:
+                        break
+                    # The state at the start of the next pass, so that a
+                    # resumed run continues exactly as this one would
+                    self._saveCheckpoint()
+
+                totalTime = time.time() - tic
+                if self.tracer is not None:
+                    self.tracer.addEvent("TOL", tic, totalTime,
+                                         args={"TOL": TOL, "itr": itrIndex})
+                tic = time.time()
                 if verbose:
-                    print(self, end="")
-                    print("------------------------------------------------")
-                if self.params.bayesian or self.totalErrorEst() < TOL:
+                    print("{} took {}".format(TOL, totalTime))
+                    print("################################################")
+                if self.fnItrDone:
+                    with self._phase("itr_done", TOL=TOL):
+                        self.fnItrDone(itrIndex, TOL, totalTime)
+                self._itrState = (finalTOL, TOLs, itrIndex+1, tic)
+                self._saveCheckpoint(force=True)
+                if isclose(TOL, finalTOL) and self.totalErrorEst() < finalTOL:
                     break
 
-            totalTime = time.time() - tic
-            tic = time.time()
-            if verbose:
-                print("{} took {}".format(TOL, totalTime))
-                print("################################################")
-            if self.fnItrDone:
-                self.fnItrDone(itrIndex, TOL, totalTime)
-            if isclose(TOL, finalTOL) and self.totalErrorEst() < finalTOL:
-                break
+        finally:
+            self._stopWorkers()
+            if self.tracer is not None and hasattr(self.params, "trace"):
+                self.tracer.write(self.params.trace)
+
+
+def _data_to_arrays(data, prefix):
+    return {prefix + "lvls": np.array(data.lvls),
+            prefix + "t": data.t,
+            prefix + "M": data.acc.M,
+            prefix + "mean": data.acc.mean,
+            prefix + "csums": data.acc.csums}
+
+
+def _data_from_arrays(arrays, prefix, dim):
+    acc = MomentAccumulator(arrays[prefix + "M"], arrays[prefix + "mean"],
+                            arrays[prefix + "csums"])
+    return MIMCData(dim, lvls=arrays[prefix + "lvls"],
+                    t=arrays[prefix + "t"], acc=acc)
+
+
+_worker_fnSampleLvl = None
+
+
+def _init_sampling_worker(fnSampleLvl):
+    global _worker_fnSampleLvl
+    _worker_fnSampleLvl = fnSampleLvl
+    # Forked workers inherit the state of the global random generator
+    # and would otherwise all produce the same samples.
+    np.random.seed()
+
+
+def _sample_block(args):
+    return _call_sampler(_worker_fnSampleLvl, *args)
+
+
+def _call_sampler(fnSampleLvl, seed, args):
+    # Returns the start time and process of the block with its result
+    if seed is not None:
+        RandomStreams.seedGlobal(seed)
+    return time.time(), os.getpid(), fnSampleLvl(*args)
 
 
 @public
-def GenericSampleLvl(fnSampleQoI, moments, mods, inds, M):
+class RandomStreams(object):
+
+    """
+    Derives an independent random stream for every block of samples of
+    every level from a single seed.
+
+    The stream of a block depends only on the seed, the level and the
+    index of the block among the blocks of that level. Hence the samples
+    do not depend on the number of workers or on the order in which the
+    blocks are computed, as long as the block size is fixed.
+
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.blocks = dict()     # Number of blocks drawn for every level
+
+    def getSeedSequence(self, lvl, block):
+        return np.random.SeedSequence(self.seed,
+                                      spawn_key=(int(block),) +
+                                      tuple(int(l) for l in lvl))
+
+    def nextBlocks(self, lvl, count):
+        '''
+        Returns the seed sequences of the next count blocks of lvl
+        '''
+        key = tuple(int(l) for l in lvl)
+        start = self.blocks.get(key, 0)
+        self.blocks[key] = start + count
+        return [self.getSeedSequence(key, b) for b in
+                range(start, start+count)]
+
+    def getGenerator(self, lvl, block):
+        return np.random.default_rng(self.getSeedSequence(lvl, block))
+
+    @staticmethod
+    def seedGlobal(seed_seq):
+        '''
+        Seeds the global numpy random generator, which most samplers
+        use, from seed_seq.
+        '''
+        np.random.seed(seed_seq.generate_state(8))
+
+
+@public
+def split_samples(M, block_size):
+    '''
+    Splits M samples into blocks of at most block_size samples.
+    Returns a list of the sizes of the blocks.
+    '''
+    M = int(M)
+    if block_size <= 0 or M <= block_size:
+        return [M]
+    return [block_size] * (M // block_size) + \
+        ([M % block_size] if M % block_size > 0 else [])
+
+
+@public
+def GenericSampleLvl(fnSampleQoI, moments, mods, inds, M, batch_size=1000,
+                     latency=False):
+    '''
+    Computes M samples of the level whose indices and modifiers are inds
+    and mods, fnSampleQoI(inds) returning a single sample. If latency is
+    True, every sample is timed and a trace.LatencyHistogram of the times
+    is returned as a fourth item.
+    '''
     import time
     timeStart = time.time()
-    psums = np.zeros(len(moments))
-    for m in range(0, M):
-        solves = fnSampleQoI(inds)
-        psums += np.sum(mods*solves)**moments
-    return M, psums, time.time() - timeStart
+    psums = MomentAccumulator.zeros(1, len(moments))
+    hist = LatencyHistogram() if latency else None
+    for m in range(0, M, batch_size):
+        count = min(batch_size, M-m)
+        deltas = np.empty(count)
+        if hist is None:
+            for i in range(0, count):
+                deltas[i] = np.sum(mods*fnSampleQoI(inds))
+        else:
+            times = np.empty(count)
+            for i in range(0, count):
+                tic = time.time()
+                deltas[i] = np.sum(mods*fnSampleQoI(inds))
+                times[i] = time.time() - tic
+            hist.add(times)
+        psums.merge(MomentAccumulator.from_samples(deltas, len(moments)))
+    if hist is None:
+        return M, psums, time.time() - timeStart
+    return M, psums, time.time() - timeStart, hist
+
+
+@public
+def GenericSampleLvlBatch(fnSampleQoIBatch, moments, mods, inds, M,
+                          batch_size=1000, latency=False):
+    '''
+    Same as GenericSampleLvl, but fnSampleQoIBatch(inds, count) returns
+    an array of shape (count, len(inds)) of samples. At most batch_size
+    samples are requested at a time to bound memory usage. The samples
+    of a batch are only timed together, so the latency histogram has the
+    average time of every batch.
+    '''
+    import time
+    timeStart = time.time()
+    psums = MomentAccumulator.zeros(1, len(moments))
+    hist = LatencyHistogram() if latency else None
+    for m in range(0, M, batch_size):
+        count = min(batch_size, M-m)
+        tic = time.time()
+        solves = fnSampleQoIBatch(inds, count)
+        deltas = np.dot(solves.reshape((count, len(mods))), mods)
+        if hist is not None:
+            hist.add((time.time() - tic) / count, count)
+        psums.merge(MomentAccumulator.from_samples(deltas, len(moments)))
+    if hist is None:
+        return M, psums, time.time() - timeStart
+    return M, psums, time.time() - timeStart, hist
 
 
 @public
@@ -651,12 +1390,15 @@ def extend_lvls_tensor(dim, lvls, M0, min_deg=1):
         seeds = [ll for ll in lvls if np.max(ll) == deg]
 
     additions = [f for f in itertools.product([0, 1], repeat=dim) if max(f) > 0]
+    added = set(tuple(l) for l in lvls)
     while True:
         newlvls = list()
         for l in seeds:
-            newlvls.extend([(np.array(l) + a).tolist() for a in
-                            additions if (np.array(l) + a).tolist()
-                            not in newlvls])
+            for a in additions:
+                lvl = (np.array(l) + a).tolist()
+                if tuple(lvl) not in added:
+                    added.add(tuple(lvl))
+                    newlvls.append(lvl)
         out_lvls.extend(newlvls)
         deg += 1
         if deg >= min_deg:
@@ -665,21 +1407,62 @@ def extend_lvls_tensor(dim, lvls, M0, min_deg=1):
     return out_lvls, M0*np.ones(len(out_lvls), dtype=np.int)
 
 
+class _TDLevelsExtender(object):
+    # Keeps the TD index set and its outer margin between calls, so that
+    # each extension only visits the added levels instead of the whole set.
+    # The state is rebuilt when the levels are not the ones known to the
+    # extender, i.e. the previous levels followed by the ones returned by
+    # the previous call. New levels are returned in order of profit.
+    def __init__(self, w, min_deg=2):
+        self.w = np.array(w)
+        self.min_deg = min_deg
+        self.profCalc = setutil.AnisoProfCalculator(self.w*0, self.w)
+        self.ext = None
+        self.known = None
+
+    def _degree(self, lvls):
+        # Computed as by GetIndexSet, so that levels on the boundary of
+        # the TD set are treated alike
+        return np.max(np.sum(self.w*np.array(lvls), axis=1))
+
+    def _rebuild(self, lvls):
+        d = len(self.w)
+        self.known = np.array(lvls, dtype=np.int).reshape((-1, d))
+        if len(lvls) > 0:
+            C = setutil.VarSizeList.from_dense_matrix(self.known, base=0,
+                                                      min_dim=d)
+            self.prev_deg = self._degree(self.known)
+        else:
+            C = setutil.VarSizeList.from_dense_matrix(np.empty((0, d)),
+                                                      min_dim=d)
+            self.prev_deg = 0
+        self.ext = setutil.IndexSetExtender(self.profCalc, C)
+
+    def __call__(self, lvls, M0):
+        if self.known is None or len(lvls) != len(self.known) or \
+           not np.array_equal(np.array(lvls).reshape(self.known.shape),
+                              self.known):
+            self._rebuild(lvls)
+        min_outer = self.ext.calcMinOuterProf() if len(self.ext) > 0 else 0
+        max_deg = self.prev_deg
+        # Increase max_deg until at least one new level is added
+        while True:
+            max_deg += np.min(self.w)
+            max_deg = np.maximum(max_deg, self.min_deg)
+            if max_deg >= min_outer:
+                break
+        newC, _ = self.ext.Extend(max_deg)
+        newlvls = newC.to_dense_matrix(d_end=len(self.w)) - 1
+        if len(newlvls) > 0:
+            self.prev_deg = max(self.prev_deg, self._degree(newlvls))
+            self.known = np.concatenate((self.known, newlvls))
+        return newlvls.tolist(), M0*np.ones(len(newlvls), dtype=np.int)
+
+
 @public
 def extend_lvls_td(w, lvls, M0, min_deg=2):
     # w specifies the dimension
-    prev_deg = np.max(np.sum(np.array(
-        [w*np.array(l) for l in lvls]), axis=1)) if lvls else 0
-    max_deg = prev_deg
-    while True:
-        max_deg += np.min(w)
-        max_deg = np.maximum(max_deg, min_deg)
-        C, _ = setutil.AnisoProfCalculator(w*0, w).GetIndexSet(max_deg)
-        all_lvls = C.to_dense_matrix() - 1
-        newlvls = [lvl.tolist() for lvl in all_lvls if lvl.tolist()
-                   not in lvls]
-        if len(newlvls) > 0:
-            return newlvls, M0*np.ones(len(newlvls), dtype=np.int)
+    return _TDLevelsExtender(w, min_deg)(lvls, M0)
 
 
 @public
@@ -687,17 +1470,145 @@ def work_estimate(lvls, gamma):
     return np.prod(np.exp(np.array(lvls)*gamma), axis=1)
 
 
-def is_boundary(d, lvls):
+def _huber(r, delta):
+    u = np.abs(r) / delta
+    return np.where(u <= 1, u**2 / 2., u - 0.5)
+
+
+def _huber_lstsq(X, y, delta=1.345, max_itr=50):
+    # Iteratively reweighted least squares with Huber weights, using
+    # the median absolute deviation of the residuals as scale
+    w = np.ones(len(y))
+    for itr in range(0, max_itr):
+        sw = np.sqrt(w)
+        coef = np.linalg.lstsq(X * sw[:, None], y * sw, rcond=None)[0]
+        r = y - X.dot(coef)
+        scale = np.median(np.abs(r - np.median(r))) / 0.6745
+        if scale == 0:
+            break
+        u = np.abs(r) / (delta * scale)
+        new_w = np.where(u <= 1, 1., 1. / np.maximum(u, 1))
+        if np.max(np.abs(new_w - w)) < 1e-8:
+            break
+        w = new_w
+    return coef
+
+
+@public
+def fit_work_model(lvls, Tl, overheads=20, ridge=1e-8):
+    '''
+    Fits the work model w0 + exp(a) * work_estimate(lvls, rates) to the
+    average run time per sample Tl of lvls, using a Huber regression of
+    log(Tl - w0) on lvls. The fixed overhead w0 is chosen among overheads
+    values in [0, min(Tl)) as the one with the smallest Huber loss of the
+    relative error of the model. Rates in directions that are not resolved
+    by lvls are fitted to zero. Levels whose Tl is not positive, as
+    measured for cheap levels with a coarse timer, are ignored.
+    Returns w0, a and rates, or None if no level has a positive Tl.
+    '''
+    lvls = np.array(lvls, dtype=np.float)
+    Tl = np.array(Tl, dtype=np.float)
+    valid = np.isfinite(Tl) & (Tl > 0)
+    if not np.any(valid):
+        return None
+    lvls, Tl = lvls[valid], Tl[valid]
+    n, dim = lvls.shape
+    # The ridge rows pull unresolved rates to zero
+    X = np.vstack((np.hstack((np.ones((n, 1)), lvls)),
+                   np.hstack((np.zeros((dim, 1)), np.sqrt(ridge)*np.eye(dim)))))
+    best = None
+    for w0 in np.min(Tl) * np.linspace(0, 1, overheads, endpoint=False):
+        y = np.concatenate((np.log(Tl - w0), np.zeros(dim)))
+        coef = _huber_lstsq(X, y)
+        model = w0 + np.exp(coef[0] + lvls.dot(coef[1:]))
+        loss = np.sum(_huber(np.log(model / Tl), 0.1))
+        if best is None or loss < best[0]:
+            best = (loss, w0, coef)
+    _, w0, coef = best
+    return w0, coef[0], coef[1:]
+
+
+def is_boundary(d, lvls, ind=None):
     if len(lvls) == 1:
-        return [True]   # Special case for zero element
-    bnd = np.zeros(len(lvls), dtype=int)
+        # Special case for zero element
+        return [True] if ind is None else np.ones(len(ind), dtype=np.bool)
+    if not isinstance(lvls, LevelSet):
+        lvls = LevelSet(d, lvls)
+    mat = np.array(lvls)
+    if ind is not None:
+        mat = mat[ind]
+    bnd = np.zeros(len(mat), dtype=int)
     for i in range(0, d):
-        x = np.zeros(d)
-        x[i] = 1
-        bnd += np.array([1 if l[i] == 0 or (np.array(l)+x).tolist() in lvls else 0 for l in lvls])
+        bnd += np.logical_or(mat[:, i] == 0, lvls.has_next(i, ind))
     return bnd < d
 
 
+class _LevelCache(object):
+    '''
+    Caches per-level values of a MIMCData that depend only on the samples of
+    each level, so that they are only recomputed for levels that were added
+    or got new samples since the last update.
+    '''
+    def __init__(self, fnCompute):
+        self.fnCompute = fnCompute  # fnCompute(data) returns values per level
+        self.data = None
+        self.acc = None
+        self.M = np.zeros(0, dtype=np.int)
+        self.values = np.zeros(0)
+
+    def clear(self):
+        self.data = None
+
+    def update(self, data):
+        n = len(data)
+        changed = np.ones(n, dtype=np.bool)
+        if data is self.data and data.acc is self.acc:
+            prev = len(self.M)
+            changed[:prev] = data.M[:prev] != self.M
+            values = np.concatenate((self.values, np.zeros(n-prev)))
+        else:
+            values = np.zeros(n)
+        if np.any(changed):
+            values[changed] = self.fnCompute(data[changed])
+        self.data, self.acc = data, data.acc
+        self.M = data.M.copy()
+        self.values = values
+        return values
+
+
+class _BoundaryCache(object):
+    '''
+    Caches the result of is_boundary for a growing LevelSet, recomputing it
+    only for new levels and for levels that precede them.
+    '''
+    def __init__(self):
+        self.lvls = None
+        self.bnd = np.zeros(0, dtype=np.bool)
+
+    def update(self, d, lvls):
+        n = len(lvls)
+        prev = len(self.bnd)
+        if lvls is not self.lvls or prev <= 1 or prev > n:
+            self.lvls = lvls
+            self.bnd = np.array(is_boundary(d, lvls), dtype=np.bool)
+            return self.bnd
+        ind = set(range(prev, n))
+        for lvl in lvls[prev:]:
+            for i in range(0, d):
+                if lvl[i] > 0:
+                    lvl[i] -= 1
+                    j = lvls.find(lvl)
+                    if j is not None and j < prev:
+                        ind.add(j)
+                    lvl[i] += 1
+        bnd = np.concatenate((self.bnd, np.zeros(n-prev, dtype=np.bool)))
+        if len(ind) > 0:
+            ind = np.array(sorted(ind))
+            bnd[ind] = is_boundary(d, lvls, ind)
+        self.bnd = bnd
+        return bnd
+
+
 def lvl_to_inds_general(lvl):
 
     """
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import ctypes as ct
+import time
+
+__all__ = []
+
+
+def public(sym):
+    __all__.append(sym.__name__)
+    return sym
+
+
+def _sample_lvl(fnSample, ctx, mods, inds, M, center, psums):
+    from . import setutil
+    return setutil.__lib__.SampleLvlNative(fnSample, ctx, mods, inds.ravel(),
+                                           inds.shape[0], inds.shape[1], M,
+                                           len(psums), ct.byref(center),
+                                           psums)
+
+
+@public
+class NativeSampler(object):
+    '''
+    A sampler in a shared library implementing the plugin ABI of
+    libsetutil/src/mimc_sampler.h, to be used as the fnSampleLvl of a
+    MIMCRun. The samples are drawn and the sums of the powers of their
+    deviations from the mean of the first samples are accumulated in C,
+    one call per block of samples.
+
+    The plugin is seeded from the global numpy generator before every
+    block, so the streams of MIMCRun (mimc_seed) apply to it as well.
+    '''
+    def __init__(self, path, args="", prefix="mimc_sampler"):
+        self.lib = ct.CDLL(path)
+        self._init = getattr(self.lib, prefix + "_init")
+        self._init.restype = ct.c_int
+        self._init.argtypes = [ct.c_char_p, ct.POINTER(ct.c_voidp)]
+        self._seed = getattr(self.lib, prefix + "_seed")
+        self._seed.restype = ct.c_int
+        self._seed.argtypes = [ct.c_voidp, ct.c_ulonglong]
+        self._finalize = getattr(self.lib, prefix + "_finalize")
+        self._finalize.restype = ct.c_int
+        self._finalize.argtypes = [ct.c_voidp]
+        # Only passed on to SampleLvlNative
+        self._sample = ct.cast(getattr(self.lib, prefix + "_sample"),
+                               ct.c_voidp)
+
+        self.ctx = ct.c_voidp()
+        self.checkErrCode(self._init(args.encode(), ct.byref(self.ctx)))
+
+    def __call__(self, moments, mods, inds, M):
+        # moments are the powers 1, 2, ..., len(moments)
+        from .mimc import MomentAccumulator
+        timeStart = time.time()
+        mods = np.array(mods, dtype=np.double)
+        inds = np.array(inds, dtype=np.uint32).reshape((len(mods), -1))
+        center = ct.c_double(0.)
+        psums = np.zeros(len(moments))
+        self.checkErrCode(self._seed(self.ctx,
+                                     np.random.randint(0, 2**62,
+                                                       dtype=np.int64)))
+        self.checkErrCode(_sample_lvl(self._sample, self.ctx, mods, inds,
+                                      M, center, psums))
+        return M, MomentAccumulator.from_psums(psums, [M],
+                                               center=center.value), \
+            time.time() - timeStart
+
+    def close(self):
+        if self.ctx is not None:
+            self.checkErrCode(self._finalize(self.ctx))
+            self.ctx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def checkErrCode(self, errCode):
+        if errCode != 0:
+            raise RuntimeError("Native sampler failed with {}".format(errCode))
@@ -1,7 +1,5 @@
 import numpy as np
-import matplotlib.pylab as plt
 from . import mimc
-from matplotlib.ticker import MaxNLocator
 
 __all__ = []
 
@@ -11,43 +9,60 @@ def public(sym):
     return sym
 
 
-@public
-class FunctionLine2D(plt.Line2D):
-    def __init__(self, fn, data=None, **kwargs):
-        self.flip = kwargs.pop('flip', False)
-        self.fn = fn
-        if data is not None:
-            x = np.array([d[0] for d in data])
-            y = np.array([d[1] for d in data])
-            if len(x) > 0 and len(y) > 0:
-                const = [np.mean(y/fn(x)), 0]
-                # const = np.polyfit(fn(x), y, 1)
-                # print(const, np.mean(y/fn(x)))
-                self.fn = lambda x, cc=const, ff=fn: cc[0] * ff(x) + cc[1]
-
-        super(FunctionLine2D, self).__init__([], [], **kwargs)
-
-    def _linspace(self, lim, scale, N=100):
-        if scale == 'log':
-            return np.exp(np.linspace(np.log(lim[0]), np.log(lim[1]), N))
-        else:
-            return np.linspace(lim[0], lim[1], N)
+__FunctionLine2D = []
 
-    def draw(self, renderer):
+
+def _function_line_2d_class():
+    # The subclass of Line2D is defined on first use, so that importing
+    # this module does not import matplotlib
+    if len(__FunctionLine2D) == 0:
         import matplotlib.pylab as plt
-        ax = self.get_axes()
-        if self.flip:
-            y = self._linspace(ax.get_ylim(), ax.get_yscale())
-            self.set_xdata(self.fn(y))
-            self.set_ydata(y)
-        else:
-            x = self._linspace(ax.get_xlim(), ax.get_xscale())
-            self.set_xdata(x)
-            self.set_ydata(self.fn(x))
 
-        plt.Line2D.draw(self, renderer)
-        self.set_xdata([])
-        self.set_ydata([])
+        class _FunctionLine2D(plt.Line2D):
+            def __init__(self, fn, data=None, **kwargs):
+                self.flip = kwargs.pop('flip', False)
+                self.fn = fn
+                if data is not None:
+                    x = np.array([d[0] for d in data])
+                    y = np.array([d[1] for d in data])
+                    if len(x) > 0 and len(y) > 0:
+                        const = [np.mean(y/fn(x)), 0]
+                        # const = np.polyfit(fn(x), y, 1)
+                        # print(const, np.mean(y/fn(x)))
+                        self.fn = lambda x, cc=const, ff=fn: cc[0] * ff(x) + cc[1]
+
+                super(_FunctionLine2D, self).__init__([], [], **kwargs)
+
+            def _linspace(self, lim, scale, N=100):
+                if scale == 'log':
+                    return np.exp(np.linspace(np.log(lim[0]), np.log(lim[1]), N))
+                else:
+                    return np.linspace(lim[0], lim[1], N)
+
+            def draw(self, renderer):
+                ax = self.get_axes()
+                if self.flip:
+                    y = self._linspace(ax.get_ylim(), ax.get_yscale())
+                    self.set_xdata(self.fn(y))
+                    self.set_ydata(y)
+                else:
+                    x = self._linspace(ax.get_xlim(), ax.get_xscale())
+                    self.set_xdata(x)
+                    self.set_ydata(self.fn(x))
+
+                plt.Line2D.draw(self, renderer)
+                self.set_xdata([])
+                self.set_ydata([])
+
+        __FunctionLine2D.append(_FunctionLine2D)
+    return __FunctionLine2D[0]
+
+
+@public
+class FunctionLine2D(object):
+    # Instances are of a subclass of matplotlib's Line2D
+    def __new__(cls, fn, data=None, **kwargs):
+        return _function_line_2d_class()(fn, data=data, **kwargs)
 
     @staticmethod
     def ExpLine(rate, const=1, data=None, **kwargs):
@@ -250,8 +265,7 @@ def __calc_moments(runs_data, seed=None, direction=None):
         cur = seed
         inds = []
         while True:
-            ii = next((i for i, l in enumerate(curRun.run.data.lvls)
-                       if np.all(l == cur)), None)
+            ii = curRun.run.data.lvls.find(cur)
             if ii is None:
                 break
             inds.append(ii)
@@ -265,11 +279,8 @@ def __calc_moments(runs_data, seed=None, direction=None):
         M[:L] += curRun.run.data.M[inds]
         Tl[:L] += curRun.run.data.t[inds]
 
-    central_moments = np.empty_like(psums)
-    for m in range(1, psums.shape[1]+1):
-        central_moments[:, m-1] = mimc.compute_central_moment(psums,
-                                                              M, m,
-                                                              empty_value=np.inf)
+    central_moments = mimc.compute_central_moments(psums, M,
+                                                   empty_value=np.inf)
     Tl /= M
     return central_moments, Tl, M
 
@@ -284,6 +295,7 @@ def plotExpectVsLvls(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$E_\ell$')
     ax.set_yscale('log')
@@ -307,6 +319,7 @@ def plotVarVsLvls(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     args, kwargs = __normalize_fmt(args, kwargs)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$V_\ell$')
@@ -330,6 +343,7 @@ def plotKurtosisVsLvls(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     args, kwargs = __normalize_fmt(args, kwargs)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$\textnormal{Kurt}_\ell$')
@@ -354,6 +368,7 @@ def plotSkewnessVsLvls(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     args, kwargs = __normalize_fmt(args, kwargs)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel(r'$\textnormal{Skew}_\ell$')
@@ -379,6 +394,7 @@ def plotTimeVsLvls(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     args, kwargs = __normalize_fmt(args, kwargs)
     ax.set_xlabel(r'$\ell$')
     ax.set_ylabel('Time (s)')
@@ -449,8 +465,9 @@ def plotLvlsNumVsTOL(ax, runs_data, *args, **kwargs):
 returned by MIMCDatabase.readRunData()
 ax is in instance of matplotlib.axes
 """
+    from matplotlib.ticker import MaxNLocator
     summary = np.array([[r.TOL,
-                         np.max([np.sum(l) for l in r.run.data.lvls])]
+                         np.max(np.sum(np.array(r.run.data.lvls), axis=1))]
                         for r in runs_data])
 
     ax.set_xscale('log')
@@ -485,7 +502,7 @@ ax is in instance of matplotlib.axes
 """
     central_moments, _, _ = __calc_moments(runs_data)
     El = np.abs(central_moments[:, 0])
-    L = lambda r: np.max([np.sum(l) for l in r.run.data.lvls])
+    L = lambda r: np.max(np.sum(np.array(r.run.data.lvls), axis=1))
     if chi == 1:
         summary = np.array([[r.TOL,
                              (1. + (1./(2.*eta))*1./(L(r)+1.))**-1,
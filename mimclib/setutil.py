@@ -38,104 +38,154 @@ __arr_ind_t__ = npct.ndpointer(dtype=ind_t, flags='C_CONTIGUOUS')
 #         newInd.extend(opt_ind)
 #     return VarSizeList(newInd, sizes=sizes)
 
-__lib__ = npct.load_library("libset_util", __file__)
+def _load_library(name):
+    # numpy.ctypeslib.load_library imports numpy.distutils, which takes
+    # longer than importing the rest of mimclib, so try ctypes first
+    import sysconfig
+    libdir = os.path.dirname(__file__)
+    for ext in [sysconfig.get_config_var("EXT_SUFFIX"), ".so", ".dylib",
+                ".dll"]:
+        if ext is not None and os.path.exists(os.path.join(libdir, name + ext)):
+            return ct.cdll.LoadLibrary(os.path.join(libdir, name + ext))
+    return npct.load_library(name, __file__)
 
-__lib__.CheckAdmissibility.restype = None
-__lib__.CheckAdmissibility.argtypes = [ct.c_voidp, __ct_ind_t__,
-                                       __ct_ind_t__, __arr_bool__]
 
-__lib__.MakeProfitsAdmissible.restype = None
-__lib__.MakeProfitsAdmissible.argtypes = [ct.c_voidp, __ct_ind_t__,
-                                          __ct_ind_t__, __arr_double__]
+def __load_lib():
+    __lib__ = _load_library("libset_util")
 
-# __lib__.GetLevelBoundaries.restype = None
-# __lib__.GetLevelBoundaries.argtypes = [ct.c_voidp,
-#                                        __arr_uint32__, ct.c_uint32,
-#                                        __arr_int32__, __arr_bool__]
+    __lib__.CheckAdmissibility.restype = None
+    __lib__.CheckAdmissibility.argtypes = [ct.c_voidp, __ct_ind_t__,
+                                           __ct_ind_t__, __arr_bool__]
 
-# __lib__.GetBoundaryInd.restype = None
-# __lib__.GetBoundaryInd.argtypes = [ct.c_uint32, ct.c_uint32,
-#                                    ct.c_int32, __arr_int32__,
-#                                    __arr_int32__, __arr_bool__]
+    __lib__.MakeProfitsAdmissible.restype = None
+    __lib__.MakeProfitsAdmissible.argtypes = [ct.c_voidp, __ct_ind_t__,
+                                              __ct_ind_t__, __arr_double__]
 
-__lib__.GetMinOuterProfit.restype = ct.c_double
-__lib__.GetMinOuterProfit.argtypes = [ct.c_voidp, ct.c_voidp]
+    # __lib__.GetLevelBoundaries.restype = None
+    # __lib__.GetLevelBoundaries.argtypes = [ct.c_voidp,
+    #                                        __arr_uint32__, ct.c_uint32,
+    #                                        __arr_int32__, __arr_bool__]
+
+    # __lib__.GetBoundaryInd.restype = None
+    # __lib__.GetBoundaryInd.argtypes = [ct.c_uint32, ct.c_uint32,
+    #                                    ct.c_int32, __arr_int32__,
+    #                                    __arr_int32__, __arr_bool__]
+
+    __lib__.GetMinOuterProfit.restype = ct.c_double
+    __lib__.GetMinOuterProfit.argtypes = [ct.c_voidp, ct.c_voidp]
 
-__lib__.CalculateSetProfit.restype = None
-__lib__.CalculateSetProfit.argtypes = [ct.c_voidp, ct.c_voidp,
-                                       __arr_double__, __arr_double__]
+    __lib__.CalculateSetProfit.restype = None
+    __lib__.CalculateSetProfit.argtypes = [ct.c_voidp, ct.c_voidp,
+                                           __arr_double__, __arr_double__]
+
+    __lib__.FreeMemory.restype = None
+    __lib__.FreeMemory.argtypes = [ct.POINTER(ct.c_voidp)]
 
-__lib__.FreeMemory.restype = None
-__lib__.FreeMemory.argtypes = [ct.POINTER(ct.c_voidp)]
+    __lib__.GetMISCProfit.restype = ct.c_voidp
+    __lib__.GetMISCProfit.argtypes = [__ct_ind_t__, __ct_ind_t__,
+                                      __arr_double__, __arr_double__,
+                                      __arr_double__, __arr_double__]
+
+    __lib__.GetAnisoProfit.restype = ct.c_voidp
+    __lib__.GetAnisoProfit.argtypes = [__ct_ind_t__, __arr_double__, __arr_double__]
 
-__lib__.GetMISCProfit.restype = ct.c_voidp
-__lib__.GetMISCProfit.argtypes = [__ct_ind_t__, __ct_ind_t__,
-                                  __arr_double__, __arr_double__,
-                                  __arr_double__, __arr_double__]
+    __lib__.FreeProfitCalculator.restype = None
+    __lib__.FreeProfitCalculator.argtypes = [ct.c_voidp]
 
-__lib__.GetAnisoProfit.restype = ct.c_voidp
-__lib__.GetAnisoProfit.argtypes = [__ct_ind_t__, __arr_double__, __arr_double__]
+    __lib__.FreeIndexSet.restype = None
+    __lib__.FreeIndexSet.argtypes = [ct.c_voidp]
 
-__lib__.FreeProfitCalculator.restype = None
-__lib__.FreeProfitCalculator.argtypes = [ct.c_voidp]
+    __lib__.GetIndexSet.restype = ct.c_voidp
+    __lib__.GetIndexSet.argtypes = [ct.c_voidp, ct.c_double,
+                                    ct.POINTER(ct.POINTER(ct.c_double))]
 
-__lib__.FreeIndexSet.restype = None
-__lib__.FreeIndexSet.argtypes = [ct.c_voidp]
+    __lib__.GetIndexSetExtender.restype = ct.c_voidp
+    __lib__.GetIndexSetExtender.argtypes = [ct.c_voidp, ct.c_voidp]
+    __lib__.IndexSetExtender_count.restype = ct.c_uint32
+    __lib__.IndexSetExtender_count.argtypes = [ct.c_voidp]
+    __lib__.IndexSetExtender_min_outer.restype = ct.c_double
+    __lib__.IndexSetExtender_min_outer.argtypes = [ct.c_voidp]
+    __lib__.IndexSetExtender_extend.restype = ct.c_voidp
+    __lib__.IndexSetExtender_extend.argtypes = [ct.c_voidp, ct.c_double,
+                                                ct.POINTER(ct.POINTER(ct.c_double))]
+    __lib__.FreeIndexSetExtender.restype = None
+    __lib__.FreeIndexSetExtender.argtypes = [ct.c_voidp]
 
-__lib__.GetIndexSet.restype = ct.c_voidp
-__lib__.GetIndexSet.argtypes = [ct.c_voidp, ct.c_double,
-                                ct.POINTER(ct.POINTER(ct.c_double))]
-__lib__.GenTDSet.restype = None
-__lib__.GenTDSet.argtypes = [__ct_ind_t__, __ct_ind_t__,
-                             __arr_ind_t__, ct.c_uint32]
+    __lib__.GenTDSet.restype = None
+    __lib__.GenTDSet.argtypes = [__ct_ind_t__, __ct_ind_t__,
+                                 __arr_ind_t__, ct.c_uint32]
 
-__lib__.TensorGrid.restype = None
-__lib__.TensorGrid.argtypes = [__ct_ind_t__, __ct_ind_t__,
-                               __arr_ind_t__, __arr_ind_t__, ct.c_uint32]
+    __lib__.TensorGrid.restype = None
+    __lib__.TensorGrid.argtypes = [__ct_ind_t__, __ct_ind_t__,
+                                   __arr_ind_t__, __arr_ind_t__, ct.c_uint32]
 
 
-__lib__.VarSizeList_max_dim.restype = __ct_ind_t__
-__lib__.VarSizeList_max_dim.argtypes = [ct.c_voidp]
+    __lib__.VarSizeList_max_dim.restype = __ct_ind_t__
+    __lib__.VarSizeList_max_dim.argtypes = [ct.c_voidp]
 
-__lib__.VarSizeList_get.restype = __ct_ind_t__
-__lib__.VarSizeList_get.argtypes = [ct.c_voidp, ct.c_uint32, __arr_ind_t__,
-                                    __ct_ind_t__]
+    __lib__.VarSizeList_get.restype = __ct_ind_t__
+    __lib__.VarSizeList_get.argtypes = [ct.c_voidp, ct.c_uint32, __arr_ind_t__,
+                                        __ct_ind_t__]
 
-__lib__.VarSizeList_count.restype = ct.c_uint32
-__lib__.VarSizeList_count.argtypes = [ct.c_voidp]
+    __lib__.VarSizeList_count.restype = ct.c_uint32
+    __lib__.VarSizeList_count.argtypes = [ct.c_voidp]
 
-__lib__.VarSizeList_sublist.restype = ct.c_voidp
-__lib__.VarSizeList_sublist.argtypes = [ct.c_voidp, __arr_uint32__,
-                                        ct.c_uint32]
+    __lib__.VarSizeList_sublist.restype = ct.c_voidp
+    __lib__.VarSizeList_sublist.argtypes = [ct.c_voidp, __arr_uint32__,
+                                            ct.c_uint32]
 
 
-__lib__.VarSizeList_all_dim.restype = None
-__lib__.VarSizeList_all_dim.argtypes = [ct.c_voidp, __arr_uint32__,
-                                        ct.c_uint32]
+    __lib__.VarSizeList_all_dim.restype = None
+    __lib__.VarSizeList_all_dim.argtypes = [ct.c_voidp, __arr_uint32__,
+                                            ct.c_uint32]
 
-__lib__.VarSizeList_all_active_dim.restype = None
-__lib__.VarSizeList_all_active_dim.argtypes = [ct.c_voidp, __arr_uint32__,
-                                               ct.c_uint32]
+    __lib__.VarSizeList_all_active_dim.restype = None
+    __lib__.VarSizeList_all_active_dim.argtypes = [ct.c_voidp, __arr_uint32__,
+                                                   ct.c_uint32]
 
-__lib__.VarSizeList_get_dim.restype = ct.c_uint32
-__lib__.VarSizeList_get_dim.argtypes = [ct.c_voidp, ct.c_uint32]
+    __lib__.VarSizeList_get_dim.restype = ct.c_uint32
+    __lib__.VarSizeList_get_dim.argtypes = [ct.c_voidp, ct.c_uint32]
 
-__lib__.VarSizeList_get_active_dim.restype = ct.c_uint32
-__lib__.VarSizeList_get_active_dim.argtypes = [ct.c_voidp, ct.c_uint32]
+    __lib__.VarSizeList_get_active_dim.restype = ct.c_uint32
+    __lib__.VarSizeList_get_active_dim.argtypes = [ct.c_voidp, ct.c_uint32]
 
-__lib__.VarSizeList_to_matrix.restype = None
-__lib__.VarSizeList_to_matrix.argtypes = [ct.c_voidp, __arr_ind_t__,
-                                          ct.c_uint32, __arr_ind_t__,
-                                          ct.c_uint32]
+    __lib__.VarSizeList_to_matrix.restype = None
+    __lib__.VarSizeList_to_matrix.argtypes = [ct.c_voidp, __arr_ind_t__,
+                                              ct.c_uint32, __arr_ind_t__,
+                                              ct.c_uint32]
 
-__lib__.VarSizeList_from_matrix.restype = ct.c_voidp
-__lib__.VarSizeList_from_matrix.argtypes = [__arr_ind_t__, ct.c_uint32,
-                                            __arr_ind_t__, ct.c_uint32,
-                                            __arr_ind_t__, ct.c_uint32]
+    __lib__.VarSizeList_from_matrix.restype = ct.c_voidp
+    __lib__.VarSizeList_from_matrix.argtypes = [__arr_ind_t__, ct.c_uint32,
+                                                __arr_ind_t__, ct.c_uint32,
+                                                __arr_ind_t__, ct.c_uint32]
 
-__lib__.VarSizeList_find.restype = ct.c_int32
-__lib__.VarSizeList_find.argtypes = [ct.c_voidp, __arr_ind_t__,
-                                     __arr_ind_t__, __ct_ind_t__]
+    __lib__.VarSizeList_find.restype = ct.c_int32
+    __lib__.VarSizeList_find.argtypes = [ct.c_voidp, __arr_ind_t__,
+                                         __arr_ind_t__, __ct_ind_t__]
+
+    __lib__.SampleLvlNative.restype = ct.c_int
+    __lib__.SampleLvlNative.argtypes = [ct.c_voidp, ct.c_voidp,
+                                        __arr_double__, __arr_uint32__,
+                                        ct.c_uint32, ct.c_uint32, ct.c_uint32,
+                                        ct.c_uint32, ct.POINTER(ct.c_double),
+                                        __arr_double__]
+
+    return __lib__
+
+
+class _LazyLibrary(object):
+    # The library is loaded and its functions are declared on first use,
+    # so that importing mimclib stays fast. The loaded library then
+    # replaces this object as the module's __lib__
+    def __init__(self, fnLoad):
+        self._fnLoad = fnLoad
+
+    def __getattr__(self, name):
+        lib = self._fnLoad()
+        globals()["__lib__"] = lib
+        return getattr(lib, name)
+
+__lib__ = _LazyLibrary(__load_lib)
 
 
 @public
@@ -241,6 +291,14 @@ class VarSizeList(object):
                                          j_d.shape[0])
         return index if index >= 0 else None
 
+    @staticmethod
+    def from_dense_matrix(mat, base=1, min_dim=0):
+        mat = np.atleast_2d(np.array(mat, dtype=ind_t)) + (1-base)
+        active = mat > 1
+        return VarSizeList.from_matrix(np.sum(active, axis=1),
+                                       np.nonzero(active)[1],
+                                       mat[active], min_dim=min_dim)
+
     @staticmethod
     def from_matrix(sizes, d_j, data, min_dim=0):
         assert(len(d_j) == len(data))
@@ -277,6 +335,49 @@ class VarSizeList(object):
         return inner_bnd, real_lvls
 
 
+@public
+class IndexSetExtender(object):
+    '''
+    An index set together with its outer margin, the indices that are not
+    in the set but follow one of its indices, ordered by profit. Building
+    it visits the whole set once, while extending it only visits the added
+    indices and their neighbors.
+    '''
+    def __init__(self, profCalc, indSet=None):
+        self.profCalc = profCalc   # Used by the extender until freed
+        self._handle = __lib__.GetIndexSetExtender(
+            None if indSet is None else indSet._handle, profCalc._handle)
+
+    def __del__(self):
+        __lib__.FreeIndexSetExtender(self._handle)
+
+    def __len__(self):
+        return __lib__.IndexSetExtender_count(self._handle)
+
+    def calcMinOuterProf(self):
+        return __lib__.IndexSetExtender_min_outer(self._handle)
+
+    def Extend(self, max_prof):
+        '''
+        Adds to the set all indices whose profit is at most max_prof, and
+        returns them in the order of their profits together with these
+        profits
+        '''
+        mem_prof = ct.POINTER(ct.c_double)()
+        new = __lib__.IndexSetExtender_extend(self._handle, np.float(max_prof),
+                                              ct.byref(mem_prof))
+        indSet = VarSizeList(new, min_dim=self.profCalc.d)
+        try:
+            count = len(indSet)
+            profits = np.ctypeslib.as_array(mem_prof,
+                                            (count,)).copy().reshape(count) \
+                      if count > 0 else np.empty(0)
+        finally:
+            __lib__.FreeMemory(ct.byref(ct.cast(mem_prof, ct.c_void_p)))
+
+        return indSet, profits
+
+
 @public
 class ProfCalculator(object):
     def GetIndexSet(self, max_prof):
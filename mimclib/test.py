@@ -25,11 +25,11 @@ def parse_known_args(parser, warn=True, return_unknown=False):
 def RunStandardTest(fnSampleQoI=None, fnSampleLvl=None,
                     fnAddExtraArgs=None,
                     fnInit=None,
-                    fnSeed=np.random.seed):
+                    fnSeed=np.random.seed,
+                    fnSampleQoIBatch=None):
     import warnings
     import os.path
     import mimclib.mimc as mimc
-    import mimclib.db as mimcdb
     warnings.formatwarning = lambda msg, cat, filename, lineno, line: \
                              "{}:{}: ({}) {}\n".format(os.path.basename(filename),
                                                        lineno, cat.__name__, msg)
@@ -45,6 +45,10 @@ def RunStandardTest(fnSampleQoI=None, fnSampleLvl=None,
                         action="store", help="Database Tag")
     parser.add_argument("-db", type='bool', default=False,
                         action="store", help="Save in Database")
+    parser.add_argument("-db_engine", type=str, default="mysql",
+                        action="store", help="Database engine, mysql or sqlite")
+    parser.add_argument("-db_name", type=str, default="mimc",
+                        action="store", help="Database name, or file for sqlite")
     parser.add_argument("-qoi_seed", type=int, default=-1,
                         action="store", help="Seed for random generator")
 
@@ -61,11 +65,14 @@ def RunStandardTest(fnSampleQoI=None, fnSampleLvl=None,
 
     fnItrDone = None
     if mimcRun.params.db:
-        if hasattr(mimcRun.params, "db_user"):
-            db = mimcdb.MIMCDatabase(user=mimcRun.params.db_user,
-                                     host=mimcRun.params.db_host)
-        else:
-            db = mimcdb.MIMCDatabase(host=mimcRun.params.db_host)
+        import mimclib.db as mimcdb
+        db_args = {"db": mimcRun.params.db_name,
+                   "engine": mimcRun.params.db_engine}
+        if mimcRun.params.db_engine == "mysql":
+            db_args["host"] = mimcRun.params.db_host
+            if hasattr(mimcRun.params, "db_user"):
+                db_args["user"] = mimcRun.params.db_user
+        db = mimcdb.MIMCDatabase(**db_args)
         run_id = db.createRun(mimc_run=mimcRun,
                               tag=mimcRun.params.db_tag)
         fnItrDone = lambda *a: db.writeRunData(run_id, mimcRun, *a)
@@ -74,8 +81,11 @@ def RunStandardTest(fnSampleQoI=None, fnSampleLvl=None,
         fnSampleQoI = lambda inds, fn=fnSampleQoI: fn(mimcRun, inds)
     if fnSampleLvl is not None:
         fnSampleLvl = lambda moments, mods, inds, M, fn=fnSampleLvl, *a: fn(mimcRun, moments, mods, inds, M)
+    if fnSampleQoIBatch is not None:
+        fnSampleQoIBatch = lambda inds, M, fn=fnSampleQoIBatch: fn(mimcRun, inds, M)
 
     mimcRun.setFunctions(fnSampleQoI=fnSampleQoI,
+                         fnSampleQoIBatch=fnSampleQoIBatch,
                          fnSampleLvl=fnSampleLvl, fnItrDone=fnItrDone)
 
     try:
@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import time
+import os
+import json
+from contextlib import contextmanager
+
+__all__ = []
+
+
+def public(sym):
+    __all__.append(sym.__name__)
+    return sym
+
+
+@public
+class LatencyHistogram(object):
+    '''
+    Histogram of the time per sample with logarithmically spaced bins,
+    bins_per_decade bins in every power of ten between min_t and max_t.
+    Times outside this range are counted in the first or last bin.
+    '''
+    def __init__(self, min_t=1e-7, max_t=1e4, bins_per_decade=10):
+        decades = int(np.round(np.log10(max_t / min_t)))
+        self.edges = min_t * 10.**(np.arange(0, decades*bins_per_decade+1) /
+                                   float(bins_per_decade))
+        self.counts = np.zeros(len(self.edges)-1, dtype=np.int64)
+        self.total_t = 0.
+        self.total_M = 0
+
+    def add(self, t, M=1):
+        '''
+        Adds M samples that took t seconds on average. t and M can be
+        arrays, with one entry per sample or per batch of samples.
+        '''
+        t, M = np.broadcast_arrays(np.asarray(t, dtype=np.float64), M)
+        i = np.searchsorted(self.edges, t, side='right') - 1
+        np.add.at(self.counts, np.clip(i, 0, len(self.counts)-1), M)
+        self.total_t += np.sum(t * M)
+        self.total_M += int(np.sum(M))
+
+    def merge(self, other):
+        assert np.array_equal(self.edges, other.edges)
+        self.counts += other.counts
+        self.total_t += other.total_t
+        self.total_M += other.total_M
+
+    def mean(self):
+        return self.total_t / self.total_M if self.total_M > 0 else np.nan
+
+    def quantile(self, q):
+        '''
+        Returns the upper edge of the bin containing the q quantile
+        '''
+        if self.total_M == 0:
+            return np.nan
+        i = np.searchsorted(np.cumsum(self.counts), q * self.total_M)
+        return self.edges[min(i, len(self.counts)-1)+1]
+
+    def getDict(self):
+        # Only non-empty bins are listed
+        nz = np.nonzero(self.counts)[0]
+        return {"lower": self.edges[nz].tolist(),
+                "upper": self.edges[nz+1].tolist(),
+                "counts": self.counts[nz].tolist(),
+                "mean": self.mean(),
+                "M": self.total_M}
+
+
+@public
+class Tracer(object):
+    '''
+    Records the wall time of the phases of a MIMC run and the latency of
+    the samples of every level.
+
+    Phases are timed with the context manager phase(name, **args). Every
+    finished phase is recorded as an event and passed to the hooks, which
+    are functions hook(name, start, duration, args) added with addHook,
+    or with MIMCRun.addTraceHook for the tracer of a run.
+    Events can be written as a Chrome trace (chrome://tracing, Perfetto)
+    or as JSON lines.
+    '''
+    def __init__(self, record=True):
+        self.record = record     # Keep events in memory for the exporters
+        self.events = []
+        self.hooks = []
+        self.latency = dict()    # Histogram of every level
+        self.pid = os.getpid()
+        self._depth = 0
+
+    def addHook(self, fn):
+        self.hooks.append(fn)
+
+    @contextmanager
+    def phase(self, name, **args):
+        start = time.time()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.addEvent(name, start, time.time() - start, args=args)
+
+    def addEvent(self, name, start, duration, pid=None, cat="mimc",
+                 args=None):
+        args = args or dict()
+        if self.record:
+            self.events.append({"name": name, "cat": cat, "start": start,
+                                "duration": duration,
+                                "pid": self.pid if pid is None else pid,
+                                "depth": self._depth,
+                                "args": args})
+        for fn in self.hooks:
+            fn(name, start, duration, args)
+
+    def addSampleBlock(self, lvl, M, t, start=None, pid=None, latency=None):
+        '''
+        Records a block of M samples of lvl that took t seconds in total,
+        and that started at time start in process pid if known.
+
+        latency is the LatencyHistogram of the individual samples of the
+        block if the sampler timed them. Otherwise, all samples of the
+        block are recorded with the average time t/M, which hides the
+        spread of the time within a block.
+        '''
+        lvl = tuple(lvl)
+        if lvl not in self.latency:
+            self.latency[lvl] = LatencyHistogram()
+        if latency is not None:
+            self.latency[lvl].merge(latency)
+        elif M > 0:
+            self.latency[lvl].add(t / M, M)
+        if start is not None:
+            self.addEvent("block", start, t, pid=pid, cat="sampler",
+                          args={"lvl": list(lvl), "M": int(M)})
+
+    def summary(self):
+        '''
+        Returns a dictionary with the total time and count of every phase
+        '''
+        out = dict()
+        for e in self.events:
+            tot = out.setdefault(e["name"], {"count": 0, "time": 0.})
+            tot["count"] += 1
+            tot["time"] += e["duration"]
+        return out
+
+    def writeChromeTrace(self, path):
+        t0 = min([e["start"] for e in self.events]) if self.events else 0
+        trace = [{"name": e["name"], "cat": e["cat"], "ph": "X",
+                  "ts": (e["start"] - t0) * 1e6, "dur": e["duration"] * 1e6,
+                  "pid": e["pid"], "tid": e["pid"],
+                  "args": e["args"]} for e in self.events]
+        trace.extend([{"name": "latency", "cat": "sampler", "ph": "C",
+                       "ts": 0, "pid": self.pid,
+                       "args": {str(list(lvl)): h.mean()}}
+                      for lvl, h in self.latency.items()])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def writeJSONLines(self, path):
+        with open(path, "w") as f:
+            for e in self.events:
+                f.write(json.dumps(dict(e, type="event")) + "\n")
+            for lvl, h in self.latency.items():
+                f.write(json.dumps(dict(h.getDict(), type="latency",
+                                        lvl=list(lvl))) + "\n")
+
+    def write(self, path):
+        '''
+        Writes JSON lines if path ends with .jsonl and a Chrome trace
+        otherwise
+        '''
+        if path.endswith(".jsonl"):
+            self.writeJSONLines(path)
+        else:
+            self.writeChromeTrace(path)
+
+
+@contextmanager
+def null_phase():
+    yield
@@ -2,9 +2,9 @@
 
 import numpy as np
 import scipy as sp
-import matplotlib.pyplot as plt
 import scipy.integrate as spint
 import time
+from collections import OrderedDict
 
 
 def hoLeeExample3(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
@@ -13,33 +13,6 @@ def hoLeeExample3(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
 def hoLeeExample2(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
     return hoLeeExample([[foo[0],foo[1],foo[1]] for foo in inds],t_max=t_max,tau_max=tau_max,r0=r0,sig=sig,verbose=verbose)
 
-def hoLeeExample(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
-    
-    '''
-    Compute the Ho Lee Example in Beck-Tempone-Szepessy-Zouraris
-    '''
-    
-    thi = lambda tau: 0.1*(1-np.exp(-1*tau))
-    f0 = lambda tau: r0-sig*sig*0.5*tau*tau+thi(tau)
-
-    F = lambda x: 1.0-x
-    G = lambda x: 1.0*x
-    Psi = lambda x: 1.0*x
-    U = lambda x: 0.0*x
-
-    d1 = lambda s: sig*sig*s
-
-    drift = lambda s: d1(s)
-
-    v1 = lambda s: sig*np.ones(np.shape(s))
-
-    vols = [v1,]
-
-    identifierString = 'Evaluating the Ho Lee example.\n'
-    identifierString += 'r0: %f, vol %f , t_max %f , tau_max %f .'
-
-    return multiLevelHjmModel(inds,F,G,U,Psi,drift,vols,f0,t_max=t_max,tau_max=tau_max,identifierString=identifierString,verbose=verbose)
-    
 def twoFactorGaussianExample(inds,t_max=1.0,tau_max=3.0,b0=0.0759,b1=-0.0439,k=0.4454,a2=0.5,s1=0.02,s2=0.01,K=0.5,verbose=False):
     
     '''
@@ -47,23 +20,7 @@ def twoFactorGaussianExample(inds,t_max=1.0,tau_max=3.0,b0=0.0759,b1=-0.0439,k=0
     '''
     
 
-    f0 = lambda tau: b0+b1*np.exp(-1.0*k*tau)
-
-    F = lambda x: np.exp(-1.0*x)
-    G = lambda x: np.fmax(np.exp(-1.0*x)-K)
-    Psi = lambda x: 1.0*x
-    U = lambda x: 0.0*x
-    
-    d1 = lambda s: s1*s1*s
-    d20 = lambda s: np.exp(-0.5*a2*s)
-    d2 = lambda s: 2*s2*s2/a2*d20(s)*(1.0-d20(s))
-    
-    drift = lambda s: d1(s)+d2(s) 
-
-    v1 = lambda s: s1*np.ones(np.shape(s))
-    v2 = lambda s: s2*d20(s)
-
-    vols = [v1,v2]
+    F,G,U,Psi,drift,vols,f0 = twoFactorGaussianModel(b0=b0,b1=b1,k=k,a2=a2,s1=s1,s2=s2,K=K)
 
     identifierString = 'Evaluating the Two Factor Gaussian example.\n'
     identifierString += 's1: %f, s2: %f, b0: %f, tau_max: %f, t_max: %f\n'%(s1,s2,b0,tau_max,t_max)
@@ -77,6 +34,11 @@ def multiLevelHjmModel(inds,F,G,U,Psi,drift,vols,f0,t_max=1.0,tau_max=2.0,identi
     Template to solve HJM type problems
     '''
 
+    if not verbose:
+        # Same random draws, with the meshes and tables of level_cache
+        return list(multiLevelHjmModelBatch(inds,1,F,G,U,Psi,drift,vols,f0,t_max=t_max,tau_max=tau_max,maxLev=maxLev)[0])
+
+    import matplotlib.pyplot as plt
     ts = [time.time(),]
 
     if verbose:
@@ -112,7 +74,7 @@ def multiLevelHjmModel(inds,F,G,U,Psi,drift,vols,f0,t_max=1.0,tau_max=2.0,identi
     dt = times[1]-times[0]
     Ws = []
     for foo in range(len(vols)):
-        Ws.append(np.concatenate((np.zeros(1),np.sqrt(dt)*np.cumsum(sp.randn(N_t-1)))))
+        Ws.append(np.concatenate((np.zeros(1),np.sqrt(dt)*np.cumsum(np.random.randn(N_t-1)))))
 
     Ws = np.array(Ws)
 
@@ -208,6 +170,7 @@ def multiLevelHjmModel(inds,F,G,U,Psi,drift,vols,f0,t_max=1.0,tau_max=2.0,identi
     return rv
 
 
+
 def hoLeeExample(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
     
     '''
@@ -247,8 +210,9 @@ def hoLeeExample(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
     # initial values
 
     dt = times[1]-times[0]
-    Ws = np.concatenate((np.zeros(1),np.sqrt(dt)*np.cumsum(sp.randn(N_t-1))))
+    Ws = np.concatenate((np.zeros(1),np.sqrt(dt)*np.cumsum(np.random.randn(N_t-1))))
     if verbose:
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.plot(times,Ws)
         plt.xlabel('$t$')
@@ -324,12 +288,273 @@ def hoLeeExample(inds,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01,verbose=False):
     
     return rv
 
+
+_models = dict()
+
+def _memoizeModel(fnModel):
+    # The same parameters give the same functions, so that they can be used
+    # as keys of level_cache
+    def memoized(*args,**kwargs):
+        key = (fnModel.__name__,args,tuple(sorted(kwargs.items())))
+        if key not in _models:
+            _models[key] = fnModel(*args,**kwargs)
+        return _models[key]
+    return memoized
+
+@_memoizeModel
+def hoLeeModel(r0=0.05,sig=0.01):
+
+    '''
+    Functions of the Ho Lee Example in Beck-Tempone-Szepessy-Zouraris
+    for multiLevelHjmModel. hoLeeExample steps the same model by hand
+    '''
+
+    thi = lambda tau: 0.1*(1-np.exp(-1*tau))
+    f0 = lambda tau: r0-sig*sig*0.5*tau*tau+thi(tau)
+    F = lambda x: 1.0-x
+    G = lambda x: 1.0*x
+    Psi = lambda x: 1.0*x
+    U = lambda x: 0.0*x
+    drift = lambda s: sig*sig*s
+    vols = [lambda s: sig*np.ones(np.shape(s)),]
+    return F,G,U,Psi,drift,vols,f0
+
+@_memoizeModel
+def twoFactorGaussianModel(b0=0.0759,b1=-0.0439,k=0.4454,a2=0.5,s1=0.02,s2=0.01,K=0.5):
+
+    '''
+    Functions of the two factor Gaussian Example in
+    Beck-Tempone-Szepessy-Zouraris, as used by twoFactorGaussianExample
+    '''
+
+    f0 = lambda tau: b0+b1*np.exp(-1.0*k*tau)
+    F = lambda x: np.exp(-1.0*x)
+    G = lambda x: np.fmax(np.exp(-1.0*x)-K)
+    Psi = lambda x: 1.0*x
+    U = lambda x: 0.0*x
+    d20 = lambda s: np.exp(-0.5*a2*s)
+    drift = lambda s: s1*s1*s+2*s2*s2/a2*d20(s)*(1.0-d20(s))
+    vols = [lambda s: s1*np.ones(np.shape(s)), lambda s: s2*d20(s)]
+    return F,G,U,Psi,drift,vols,f0
+
+def hoLeeExampleBatch(inds,M,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01):
+
+    '''
+    Same as hoLeeExample, but returns an (M, len(inds)) array of M samples.
+    The random numbers are drawn in the same order as M calls to
+    hoLeeExample.
+
+    The time stepping of hoLeeExample only adds deterministic drifts and the
+    Wiener increments to the forward curve, so the final curve and the
+    discount term are computed in closed form.
+    '''
+
+    thi = lambda tau: 0.1*(1-np.exp(-1*tau))
+    f0 = lambda tau: r0-sig*sig*0.5*tau*tau+thi(tau)
+
+    N_t = max([foo[0] for foo in inds])
+    N_tau_1 = max([foo[1] for foo in inds])
+
+    times = np.linspace(0,t_max,2**(N_t)+1)
+    taus_2 = np.linspace(t_max,tau_max,2**(N_tau_1)+1)
+    dt = times[1]-times[0]
+    Ws = np.zeros((M,len(times)))
+    Ws[:,1:] = np.sqrt(dt)*np.cumsum(np.random.randn(M,len(times)-1),axis=1)
+
+    rv = np.empty((M,len(inds)))
+    for i,ind in enumerate(inds):
+        t_jump = 2**(N_t-ind[0])
+        tau_T = taus_2[0::2**(N_tau_1-ind[1])]
+        t_eff = times[::t_jump]
+        n = len(t_eff)-1
+        dt_eff = t_eff[1]-t_eff[0]
+        # The short rate is read at t_max after n-1 steps, with f0 at the
+        # (n-1)'th point of the finest mesh as in hoLeeExample
+        short = sig*sig*dt_eff*((n-1)*t_max-np.sum(t_eff[:-2]))+f0(times[n-1])
+        discount = 1.0-(short+sig*Ws[:,(n-1)*t_jump])*dt_eff
+        f_T = sig*sig*dt_eff*(n*tau_T-np.sum(t_eff[:-1]))+f0(tau_T)
+        underlying = spint.simps(f_T,tau_T)+sig*Ws[:,-1]*(tau_max-t_max)
+        rv[:,i] = discount*underlying
+
+    return rv
+
+def hoLeeExample2Batch(inds,M,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01):
+    return hoLeeExampleBatch([[foo[0],foo[1],foo[1]] for foo in inds],M,t_max=t_max,tau_max=tau_max,r0=r0,sig=sig)
+
+def hoLeeExample3Batch(inds,M,t_max=1.0,tau_max=2.0,r0=0.05,sig=0.01):
+    return hoLeeExampleBatch([[foo[0]]*3 for foo in inds],M,t_max=t_max,tau_max=tau_max,r0=r0,sig=sig)
+
+def twoFactorGaussianExampleBatch(inds,M,t_max=1.0,tau_max=3.0,**kwargs):
+    return multiLevelHjmModelBatch(inds,M,*twoFactorGaussianModel(**kwargs),t_max=t_max,tau_max=tau_max)
+
+def multiLevelHjmModelBatch(inds,M,F,G,U,Psi,drift,vols,f0,t_max=1.0,tau_max=2.0,maxLev=30,cache=None):
+
+    '''
+    Same as multiLevelHjmModel, but returns an (M, len(inds)) array of M
+    samples. The random numbers are drawn in the same order as M calls to
+    multiLevelHjmModel.
+
+    The meshes and the drift and volatility tables of every index are taken
+    from cache (level_cache by default), see HjmLevel. Since the forward
+    curves are linear in the Wiener increments, the sampling reduces to
+    products of the increments with these tables.
+    '''
+
+    if cache is None:
+        cache = level_cache
+
+    N_t = max([foo[0] for foo in inds])
+    N_tau_1 = max([foo[1] for foo in inds])
+    N_tau_2 = max([foo[2] for foo in inds])
+
+    if N_t+max(N_tau_1,N_tau_2) > maxLev:
+        raise MemoryError('Asking for exceptionally refined solution!')
+
+    n_t = 2**(N_t)+1
+    dt = t_max/(n_t-1.0)
+    # Ws[k, m, :] is the k'th Wiener path of the m'th sample
+    Ws = np.zeros((len(vols),M,n_t))
+    Ws[:,:,1:] = np.sqrt(dt)*np.cumsum(np.random.randn(M,len(vols),n_t-1),axis=-1).transpose((1,0,2))
+
+    rv = np.empty((M,len(inds)))
+    for i,ind in enumerate(inds):
+        key = (drift,tuple(vols),f0,t_max,tau_max,tuple(ind))
+        lvl = cache.get(key, lambda: HjmLevel(ind,drift,vols,f0,t_max,tau_max))
+        # dWs[m, k*n+j] is the j'th increment of the k'th Wiener path
+        dWs = np.diff(Ws[:,:,0::2**(N_t-ind[0])],axis=-1).transpose((1,0,2)).reshape((M,-1))
+        rate = lvl.rates(dWs)
+        short = np.cumsum(rate*lvl.dt,axis=1)
+        short_prev = np.concatenate((np.zeros((M,1)),short[:,:-1]),axis=1)
+        add = np.sum(F(short_prev)*U(rate),axis=1)*lvl.dt
+        f_T = lvl.f_base+np.dot(dWs,lvl.f_vols)
+        underlying = spint.simps(Psi(f_T),lvl.tau_T,axis=-1)
+        rv[:,i] = F(short[:,-1])*underlying+add
+
+    return rv
+
+class HjmLevel(object):
+
+    '''
+    The parts of multiLevelHjmModel that do not depend on the random draw,
+    for a single index ind.
+
+    With n time steps, the j'th short rate is read from the forward curve
+    at the maturity tau_eff[lstar[j+1]], the col[j]'th of the maturities
+    read by the steps. It is
+        rate_base[j] + sum_k sum_{i<j} rate_vols[k,i,col[j]]*dW_k[i],
+    where dW_k holds the n increments of the k'th Wiener path. The final
+    curve f_n(tau_T) + f0(tau_T) on tau_T >= t_max is f_base + dW.f_vols,
+    where dW holds the increments of all paths one after the other.
+    '''
+
+    def __init__(self,ind,drift,vols,f0,t_max,tau_max):
+        t_eff = np.linspace(0,t_max,2**(ind[0])+1)
+        tau_eff = np.concatenate((np.linspace(0,t_max,2**(ind[2])+1)[:-1],
+                                  np.linspace(t_max,tau_max,2**(ind[1])+1)))
+        self.dt = t_eff[1]-t_eff[0]
+        n = len(t_eff)-1
+
+        # lstar[j] is the last maturity not after t_eff[j]. The j'th step
+        # updates the curve from lstar[j-1] on, which includes every
+        # maturity read after it
+        lstar = np.searchsorted(tau_eff[1:],t_eff,side='right')
+        cols,self.col = np.unique(lstar[1:],return_inverse=True)
+
+        s = tau_eff[cols][None,:]-t_eff[:-1,None]
+        self.rate_vols = np.array([vol(s) for vol in vols])
+        # Sum of the drifts of the steps before the j'th one
+        drifts = np.cumsum(drift(s)*self.dt,axis=0)
+        self.rate_base = f0(tau_eff[cols][self.col])
+        self.rate_base[1:] += drifts[np.arange(n-1),self.col[1:]]
+
+        lT = lstar[-1]
+        self.tau_T = tau_eff[lT:]
+        s = self.tau_T[None,:]-t_eff[:-1,None]
+        self.f_base = np.sum(drift(s),axis=0)*self.dt+f0(self.tau_T)
+        self.f_vols = np.concatenate([vol(s) for vol in vols])
+
+    def rates(self,dWs,block=32):
+        '''
+        Returns the (M, n) short rates of the samples whose increments are
+        the rows of dWs, block time steps at a time
+        '''
+        M = dWs.shape[0]
+        K,n,_ = self.rate_vols.shape
+        dWs = dWs.reshape((M,K,n))
+        rate = np.tile(self.rate_base,(M,1))
+        for j0 in range(1,n,block):
+            j1 = min(j0+block,n)
+            q0 = self.col[j0]
+            vols = self.rate_vols[:,:,q0:self.col[j1-1]+1]
+            q = self.col[j0:j1]-q0
+            # The updates of the steps before the block, and the sums along
+            # the time axis of the updates of the steps in the block
+            before = np.tensordot(dWs[:,:,:j0],vols[:,:j0],axes=([1,2],[0,1]))
+            within = np.cumsum(np.einsum('mki,kiq->miq',dWs[:,:,j0:j1-1],vols[:,j0:j1-1]),axis=1)
+            rate[:,j0:j1] += before[:,q]
+            rate[:,j0+1:j1] += within[:,np.arange(j1-j0-1),q[1:]]
+        return rate
+
+    @property
+    def nbytes(self):
+        return sum([a.nbytes for a in [self.rate_base,self.rate_vols,self.col,
+                                        self.tau_T,self.f_base,self.f_vols]])
+
+class LevelCache(object):
+
+    '''
+    Least recently used cache of HjmLevel's, counting the hits and misses
+    of get. The least recently used levels are dropped once the memory of
+    all levels exceeds max_mb.
+    '''
+
+    def __init__(self,max_mb=256.):
+        self.max_mb = max_mb
+        self.entries = OrderedDict()
+        self.total_mb = 0.
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key,fnMake):
+        '''
+        Returns the entry of key, made by fnMake() if not in the cache
+        '''
+        if key in self.entries:
+            self.hits += 1
+            val = self.entries.pop(key)
+        else:
+            self.misses += 1
+            val = fnMake()
+            self.total_mb += val.nbytes/1024.**2
+        self.entries[key] = val
+        # The level just used is kept even if it alone exceeds max_mb
+        while self.total_mb > self.max_mb and len(self.entries) > 1:
+            self.total_mb -= self.entries.popitem(last=False)[1].nbytes/1024.**2
+        return val
+
+    def clear(self):
+        self.entries.clear()
+        self.total_mb = 0.
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return 'LevelCache: %d entries, %.1fMB, %d hits, %d misses'%(len(self),self.total_mb,self.hits,self.misses)
+
+level_cache = LevelCache()
+
+
 def rateTest2D(fun=hoLeeExample2,Nref=7,M=100,r0=0.05,sig=0.01,weaks=[1,2],strongs=[1,2]):
     
     """
     Test the convergence rates in two different dimensions.
     """
 
+    import matplotlib.pyplot as plt
+
     # First check convergence along first difference
 
     plotX = range(1,Nref+1)
@@ -37,6 +37,9 @@ def addExtraArguments(parser):
                         action="store", help="Initial condition in GBM")
     parser.add_argument("-qoi_seed", type=int, default=-1,
                         action="store", help="Seed for random generator")
+    parser.add_argument("-qoi_batch", type='bool', default=True,
+                        action="store", help="Solve for many samples at once \
+using HJM.hoLeeExample2Batch")
 
 
 def main():
@@ -59,8 +62,12 @@ def main():
                               tag=mimcRun.params.db_tag)
         fnItrDone = lambda *a: db.writeRunData(run_id, mimcRun, *a)
 
-    mimcRun.setFunctions(fnSampleQoI=lambda *a: mySampleQoI(mimcRun, *a),
-                         fnItrDone=fnItrDone)
+    if mimcRun.params.qoi_batch:
+        mimcRun.setFunctions(fnSampleQoIBatch=lambda *a: mySampleQoIBatch(mimcRun, *a),
+                             fnItrDone=fnItrDone)
+    else:
+        mimcRun.setFunctions(fnSampleQoI=lambda *a: mySampleQoI(mimcRun, *a),
+                             fnItrDone=fnItrDone)
 
     try:
         mimcRun.doRun()
@@ -80,5 +87,9 @@ def mySampleQoI(run, inds):
     return HJM.hoLeeExample2(inds)
 
 
+def mySampleQoIBatch(run, inds, M):
+    return HJM.hoLeeExample2Batch(inds, M)
+
+
 if __name__ == "__main__":
     main()
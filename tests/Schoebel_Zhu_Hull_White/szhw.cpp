@@ -3,6 +3,8 @@
 #include <math.h>
 #include <iostream>
 #include <random>
+#include <chrono>
+#include <vector>
 #include <quadmath.h>
 
 #ifndef Pi
@@ -369,7 +371,74 @@ extern "C" {
   double bsNoStep(double S,double sigma, double r, double T, double K){
     return bsModel0(S,sigma,r,T,K);
   };
+  int szhwDtBatch(double dt, double S,double sigma, double r, double T, double K,double kappa,double lambda,double gamma,double p,double theta, double sbar, double eta,bool diff,
+                  unsigned int M, unsigned int moments, double *center, double *psums, double *elapsed){
+    // Sums of (g-center)^j, j=1..moments, of M samples g of szhwDt, and the
+    // time they took. center is the mean of the first samples, so that the
+    // sums do not lose the variance to cancellation
+    auto tic = chrono::steady_clock::now();
+    const unsigned int chunk = 1024;
+    std::vector<double> g(M < chunk ? M : chunk);
+    for(unsigned int j=0;j<moments;j++) psums[j] = 0.0;
+    *center = 0.0;
+    for(unsigned int m=0;m<M;m+=chunk){
+      unsigned int n = M-m < chunk ? M-m : chunk;
+      for(unsigned int i=0;i<n;i++)
+        g[i] = szhwModelDt(dt,S,sigma,r,T,K,kappa,lambda,gamma,p,theta,sbar,eta,diff);
+      if (m == 0){
+        for(unsigned int i=0;i<n;i++) *center += g[i];
+        *center /= n;
+      }
+      for(unsigned int i=0;i<n;i++){
+        double dev = g[i]-*center, prod = dev;
+        for(unsigned int j=0;j<moments;j++){
+          psums[j] += prod;
+          prod *= dev;
+        }
+      }
+    }
+    *elapsed = chrono::duration<double>(chrono::steady_clock::now()-tic).count();
+    return 0;
+  };
+  void szhwSeed(unsigned long seed){
+    gen.seed(seed);
+    myNormal.reset();
+  };
   double randn(){ return normalDouble();}
+
+  // Sampler plugin for mimclib.native.NativeSampler, see mimc_sampler.h.
+  // args holds S sigma r T K kappa lambda gamma p theta sbar eta, and the
+  // level is the first entry of the first index
+  int mimc_sampler_init(const char *args, void **ctx){
+    double *params = new double[12];
+    if (sscanf(args, "%lf %lf %lf %lf %lf %lf %lf %lf %lf %lf %lf %lf",
+               params, params+1, params+2, params+3, params+4, params+5,
+               params+6, params+7, params+8, params+9, params+10, params+11) != 12){
+      delete [] params;
+      return 1;
+    }
+    *ctx = params;
+    return 0;
+  };
+  int mimc_sampler_seed(void *ctx, unsigned long long seed){
+    szhwSeed(seed);
+    return 0;
+  };
+  int mimc_sampler_sample(void *ctx, const unsigned int *inds, unsigned int count,
+                          unsigned int dim, unsigned int M, double *values){
+    const double *q = (const double*)ctx;
+    unsigned int ell = inds[0];
+    double dt = q[3]/4/pow(2.0,ell);
+    for(unsigned int m=0;m<M;m++){
+      values[m*count] = szhwModelDt(dt,q[0],q[1],q[2],q[3],q[4],q[5],q[6],q[7],q[8],q[9],q[10],q[11],ell);
+      for(unsigned int k=1;k<count;k++) values[m*count+k] = 0.0;
+    }
+    return 0;
+  };
+  int mimc_sampler_finalize(void *ctx){
+    delete [] (double*)ctx;
+    return 0;
+  };
   double test(unsigned int N,double dt){return randTest(N,dt);}
 }
 
@@ -2,6 +2,7 @@
 
 import ctypes
 import numpy as np
+import numpy.ctypeslib as npct
 import matplotlib.pyplot as plt
 import time
 lib = ctypes.cdll.LoadLibrary('./libszhw.so')
@@ -13,6 +14,15 @@ lib.test.argtypes = [ctypes.c_uint,ctypes.c_double]
 lib.test.restype = ctypes.c_double
 lib.szhwDt.restype = ctypes.c_double
 lib.szhwDt.argtypes = [ctypes.c_double]*13 + [ctypes.c_bool]
+arr_double = npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS')
+lib.szhwDtBatch.restype = ctypes.c_int
+lib.szhwDtBatch.argtypes = [ctypes.c_double]*13 + [ctypes.c_bool, ctypes.c_uint,
+                                                   ctypes.c_uint,
+                                                   ctypes.POINTER(ctypes.c_double),
+                                                   arr_double,
+                                                   ctypes.POINTER(ctypes.c_double)]
+lib.szhwSeed.restype = None
+lib.szhwSeed.argtypes = [ctypes.c_ulong]
 
 # Function pointers to the C functions
 BS = lib.bsDt 
@@ -20,11 +30,51 @@ BS0 = lib.bsNoStep
 randTest = lib.test
 SZHW = lib.szhwDt
 
-def g_ell(ell):
+def model_ell(ell):
     #double szhwDt(double dt, double S,double sigma, double r, double T, double K,double kappa,double lambda,double gamma,double p,double theta, double sbar, double eta,bool diff
     T = 1.0/12
     dt = T/4/(2**ell)
-    return SZHW(dt,100.0,0.2,0.01,T,100.0,2.0,1.0,0.1,1.0,0.01,0.2,0.1,ell)
+    return (dt,100.0,0.2,0.01,T,100.0,2.0,1.0,0.1,1.0,0.01,0.2,0.1,ell)
+
+def g_ell(ell):
+    return SZHW(*model_ell(ell))
 
 def wrap(run,inds):
     return g_ell(inds[0][0])
+
+def g_ell_batch(ell,M,moments):
+    '''
+    Returns a MomentAccumulator of M samples of g_ell(ell) up to the
+    moment len(moments), and the time spent computing them, in a single
+    call to the C code
+    '''
+    from mimclib.mimc import MomentAccumulator
+    center = ctypes.c_double()
+    psums = np.empty(len(moments))
+    elapsed = ctypes.c_double()
+    lib.szhwDtBatch(*(model_ell(ell) + (M, len(moments), ctypes.byref(center),
+                                        psums, ctypes.byref(elapsed))))
+    return MomentAccumulator.from_psums(psums, [M], center=center.value), \
+        elapsed.value
+
+def fnSampleLvl(run,moments,mods,inds,M):
+    # A sample of inds[0] is already the difference to the coarser levels.
+    # The C generator is seeded from numpy, so that runs are repeatable
+    # and every block of samples gets its own stream
+    lib.szhwSeed(np.random.randint(2**31))
+    psums, elapsed = g_ell_batch(inds[0][0],M,moments)
+    return M, psums, elapsed
+
+def native_sampler(path='./libszhw.so'):
+    # The same sampler through the plugin ABI of mimclib, see mimc_sampler.h
+    from mimclib.native import NativeSampler
+    return NativeSampler(path, args=" ".join(map(repr, model_ell(0)[1:13])))
+
+if __name__ == "__main__":
+    # Throughput of the native sampler on every level
+    M = 10**5
+    for ell in range(0, 6):
+        acc, elapsed = g_ell_batch(ell, M, [1, 2])
+        print("ell=%d: %.3g samples/s, E=%.4g, V=%.4g" %
+              (ell, M/elapsed, acc.central_moment(1)[0],
+               acc.central_moment(2)[0]))
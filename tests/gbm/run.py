@@ -17,6 +17,41 @@ def addExtraArguments(parser):
     parser.add_argument("-qoi_S0", type=float, default=1.,
                         action="store", help="Initial condition in GBM")
 
+def wcumsum_numpy(x, w, block=1024):
+    '''
+    wcumsum is like cumsum, but weighted:
+    out[..., i] = out[..., i-1]*w[..., i] + x[..., i] along the last axis,
+    so that many paths can be summed at once. w[..., 0] is not used.
+    Every block of the last axis is computed with cumulative products of w
+    relative to the start of the block, and only blocks whose products
+    overflow or vanish are summed one element at a time.
+    '''
+    x = np.asarray(x, dtype=np.double)
+    w = np.asarray(w, dtype=np.double)
+    out = np.empty(np.broadcast(x, w).shape)
+    x = np.broadcast_to(x, out.shape)
+    w = np.broadcast_to(w, out.shape)
+    carry = np.zeros(out.shape[:-1])
+    for start in range(0, out.shape[-1], block):
+        end = min(start + block, out.shape[-1])
+        wb = w[..., start:end].copy()
+        if start == 0:
+            wb[..., 0] = 1    # The carry is zero
+        P = np.cumprod(wb, axis=-1)
+        with np.errstate(all='ignore'):
+            ob = P * (carry[..., None] + np.cumsum(x[..., start:end] / P,
+                                                   axis=-1))
+        bad = ~np.all(np.isfinite(ob), axis=-1)
+        if np.any(bad):
+            prev = carry[bad]
+            for i in range(start, end):
+                prev = prev * wb[bad][..., i-start] + x[bad][..., i]
+                ob[bad, i-start] = prev
+        out[..., start:end] = ob
+        carry = ob[..., -1]
+    return out
+
+
 try:
     # Try to import the DLL version of wcumsum,
     # This makes solving the SDE much faster
@@ -30,20 +65,18 @@ try:
                                 ct.c_uint32, __arr_double__]
 
     def wcumsum(x, w):
+        if np.ndim(x) != 1 or np.ndim(w) != 1:
+            return wcumsum_numpy(x, w)
         output = np.empty(len(x))
-        __lib__.wcumsum(x, w, len(x), output)
+        __lib__.wcumsum(np.ascontiguousarray(x, dtype=np.double),
+                        np.ascontiguousarray(w, dtype=np.double),
+                        len(x), output)
         return output
 
-except:
-    raise
-    warnings.warn("Using Python (very slow) version for wcumsum. Consider running make")
-    # wcumsum is like cumsum, but weighted.
-    def wcumsum(x, w):
-        output = np.empty(len(x))
-        output[0] = x[0]
-        for i in range(1, len(output)):
-            output[i] = w[i]*output[i-1] + x[i]
-        return output
+except OSError:
+    warnings.warn("libwcumsum.so was not found, using the NumPy version \
+of wcumsum. Consider running make")
+    wcumsum = wcumsum_numpy
 
 
 def mySampleQoI(run, inds):
@@ -62,7 +95,24 @@ def mySampleQoI(run, inds):
                                             1 + run.params.qoi_mu/mesh)))[-1]
     return solves
 
+
+def mySampleQoIBatch(run, inds, M):
+    # Same as mySampleQoI, but for M paths at once. The random numbers
+    # are drawn in the same order as M calls to mySampleQoI
+    meshes = (run.params.qoi_T/run.fnHierarchy(inds)).reshape(-1).astype(np.int)
+    maxN = np.max(meshes)
+    dW = np.random.normal(size=(M, maxN))/np.sqrt(maxN)
+    solves = np.empty((M, len(inds)))
+    for i, mesh in enumerate(meshes):
+        assert(maxN % mesh == 0)
+        dWl = np.sum(dW.reshape((M, mesh, maxN//mesh)), axis=2)
+        # The Euler scheme S_{n+1} = S_n (1 + mu/N + sigma dW_n) of all paths
+        solves[:, i] = run.params.qoi_S0 * \
+            np.prod(1 + run.params.qoi_mu/mesh + run.params.qoi_sigma*dWl,
+                    axis=1)
+    return solves
+
 if __name__ == "__main__":
     import mimclib.test
-    mimclib.test.RunStandardTest(fnSampleQoI=mySampleQoI,
+    mimclib.test.RunStandardTest(fnSampleQoIBatch=mySampleQoIBatch,
                                  fnAddExtraArgs=addExtraArguments)
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+import mimclib.db as mimcdb
+
+
+def addExtraArguments(parser):
+    parser.add_argument("-db_engine", type=str, action="store",
+                        help="Database engine, mysql or sqlite")
+    parser.add_argument("-db_name", type=str, action="store",
+                        help="Database Name")
+    parser.add_argument("-db_user", type=str, action="store",
+                        help="Database User")
+    parser.add_argument("-db_host", type=str, action="store",
+                        help="Database Host")
+    parser.add_argument("-chunk_size", type=int, default=1000,
+                        action="store",
+                        help="Number of iterations converted at a time")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description="Converts the level table of a MIMC database to "
+        "version {}".format(mimcdb.SCHEMA_VERSION))
+    addExtraArguments(parser)
+    args = parser.parse_args()
+    db_args = dict()
+    if args.db_engine is not None:
+        db_args["engine"] = args.db_engine
+    if args.db_name is not None:
+        db_args["db"] = args.db_name
+    if args.db_user is not None:
+        db_args["user"] = args.db_user
+    if args.db_host is not None:
+        db_args["host"] = args.db_host
+    db = mimcdb.MIMCDatabase(**db_args)
+
+    version = db.schemaVersion()
+    if version == mimcdb.SCHEMA_VERSION:
+        print("The database already has version {}".format(version))
+        return
+    print("Converting the database from version {} to {}".format(
+        version, mimcdb.SCHEMA_VERSION))
+    count = db.migrateSchema(chunk_size=args.chunk_size, verbose=True)
+    print("Converted {} levels".format(count))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,43 +2,57 @@ import numpy.ctypeslib as npct
 import ctypes as ct
 import numpy as np
 import os
+from collections import OrderedDict
 
 arr_double = npct.ndpointer(dtype=np.double, ndim=1, flags='CONTIGUOUS')
+arr_double_2 = npct.ndpointer(dtype=np.double, ndim=2, flags='C_CONTIGUOUS')
 arr_uint = npct.ndpointer(dtype=np.uint32, ndim=2, flags='CONTIGUOUS')
 
 
-class SField(object):
+def _load_lib():
+    # TODO: We need to figure out a way
+    save = ct.cdll._dlltype
     try:
-        # TODO: We need to figure out a way
-        save = ct.cdll._dlltype
-        try:
-            ct.cdll._dlltype = lambda name: ct.CDLL(name, ct.RTLD_GLOBAL)
-            path = os.path.join(os.path.dirname(__file__))
-            lib = npct.load_library("libsolver_nd_df.so", path)
-        finally:
-            ct.cdll._dlltype = save
-        lib.SFieldCreate.restype = ct.c_ulong
-        lib.SFieldBeginRuns.restype = ct.c_ulong
-        lib.SFieldEndRuns.restype = ct.c_ulong
-        lib.SFieldDestroy.restype = ct.c_ulong
-        lib.SFieldSolveFor.restype = ct.c_ulong
-        lib.SFieldGetDim.restype = ct.c_ulong
-        lib.SFieldGetN.restype = ct.c_ulong
-
-        lib.SFieldCreate.argtypes = [ct.c_voidp]
-        lib.SFieldBeginRuns.argtypes = [ct.c_voidp, arr_double,
-                                        arr_uint, ct.c_uint]
-        lib.SFieldEndRuns.argtypes = [ct.c_voidp]
-        lib.SFieldSolveFor.argtypes = [ct.c_voidp, arr_double,
-                                       ct.c_uint, ct.c_void_p]
-        lib.SFieldDestroy.argtypes = [ct.c_voidp]
-        lib.SFieldGetDim.argtypes = [ct.c_voidp]
-        lib.SFieldGetN.argtypes = [ct.c_voidp]
-    except:
-        raise
-        pass
+        ct.cdll._dlltype = lambda name: ct.CDLL(name, ct.RTLD_GLOBAL)
+        path = os.path.join(os.path.dirname(__file__))
+        lib = npct.load_library("libsolver_nd_df.so", path)
+    finally:
+        ct.cdll._dlltype = save
+    lib.SFieldCreate.restype = ct.c_ulong
+    lib.SFieldBeginRuns.restype = ct.c_ulong
+    lib.SFieldEndRuns.restype = ct.c_ulong
+    lib.SFieldDestroy.restype = ct.c_ulong
+    lib.SFieldSolveFor.restype = ct.c_ulong
+    lib.SFieldSolveForBatch.restype = ct.c_ulong
+    lib.SFieldGetDim.restype = ct.c_ulong
+    lib.SFieldGetN.restype = ct.c_ulong
+
+    lib.SFieldCreate.argtypes = [ct.c_voidp]
+    lib.SFieldBeginRuns.argtypes = [ct.c_voidp, arr_double,
+                                    arr_uint, ct.c_uint]
+    lib.SFieldEndRuns.argtypes = [ct.c_voidp]
+    lib.SFieldSolveFor.argtypes = [ct.c_voidp, arr_double,
+                                   ct.c_uint, ct.c_void_p]
+    lib.SFieldSolveForBatch.argtypes = [ct.c_voidp, arr_double_2,
+                                        ct.c_uint, ct.c_uint, arr_double]
+    lib.SFieldDestroy.argtypes = [ct.c_voidp]
+    lib.SFieldGetDim.argtypes = [ct.c_voidp]
+    lib.SFieldGetN.argtypes = [ct.c_voidp]
+    return lib
+
+
+class SField(object):
+    # The library is loaded by the first field or by Init, so that this
+    # module, e.g. SFieldPool, can be imported without it
+    lib = None
+
+    @staticmethod
+    def LoadLib():
+        if SField.lib is None:
+            SField.lib = _load_lib()
 
     def __init__(self, random_gen=None):
+        SField.LoadLib()
         self.random_gen = None or np.random
         self.ref = ct.c_voidp()
         self.checkErrCode(SField.lib.SFieldCreate(ct.byref(self.ref)))
@@ -80,10 +94,36 @@ class SField(object):
                                                     ct.byref(goal)))
         return goal.value
 
+    def SolveForBatch(self, Y):
+        # Solves for every row of the (M, N) matrix Y in one call
+        Y = np.ascontiguousarray(Y, dtype=np.double)
+        assert(Y.ndim == 2 and Y.shape[1] == self.GetN())
+        goals = np.empty(Y.shape[0])
+        self.checkErrCode(SField.lib.SFieldSolveForBatch(self.ref,
+                                                         Y,
+                                                         Y.shape[1],
+                                                         Y.shape[0],
+                                                         goals))
+        return goals
+
     def Sample(self):
         Y = self.random_gen.uniform(-np.sqrt(3), np.sqrt(3), size=self.GetN())
         return self.SolveFor(Y)
 
+    def SampleBatch(self, M, Y=None):
+        # Same random numbers as M calls to Sample. If given, Y is a buffer
+        # of at least M rows that receives the random numbers one row at a
+        # time, so that it is reused instead of allocating a new matrix
+        if Y is None:
+            Y = self.random_gen.uniform(-np.sqrt(3), np.sqrt(3),
+                                        size=(M, self.GetN()))
+            return self.SolveForBatch(Y)
+        Y = Y[:M]
+        for i in range(0, M):
+            Y[i] = self.random_gen.uniform(-np.sqrt(3), np.sqrt(3),
+                                           size=Y.shape[1])
+        return self.SolveForBatch(Y)
+
     def checkErrCode(self, errCode):
         if errCode == 0:
             return
@@ -92,6 +132,7 @@ class SField(object):
     @staticmethod
     def Init():
         import sys
+        SField.LoadLib()
         count = len(sys.argv)
         arr = (ct.c_char_p * len(sys.argv))()
         arr[:] = sys.argv
@@ -100,3 +141,88 @@ class SField(object):
     @staticmethod
     def Final():
         SField.lib.myPetscFinal()
+
+
+class SFieldPool(object):
+    '''
+    Keeps an SField with runs begun for each of the recently used levels, so
+    that sampling a level again skips building its meshes and solvers. The
+    least recently used levels are ended once the estimated memory of all
+    levels exceeds max_mb.
+
+    The estimate includes the solver of every level, see footprint_mb,
+    whose fill and ksp_vecs should be changed with the PETSc options of
+    the solver, e.g. -pc_type or -ksp_gmres_restart.
+    '''
+    def __init__(self, max_mb=512., fill=1., ksp_vecs=35):
+        self.max_mb = max_mb
+        self.fill = fill
+        self.ksp_vecs = ksp_vecs
+        self.fields = OrderedDict()    # key -> (SField, size in MB)
+        self.total_mb = 0.
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def footprint_mb(nelem, d, fill=1., ksp_vecs=35):
+        # The sparse matrix has 1+2d non-zeros of a double and an int per
+        # row. The factorization of the preconditioner has fill times as
+        # many, 1 for the default ILU(0) of PETSc. Besides the right hand
+        # side and the solution, the Krylov solver keeps ksp_vecs vectors,
+        # 35 for the default GMRES(30)
+        if nelem.shape[1] == 1:
+            nelem = np.tile(nelem, d)
+        rows = np.sum(np.prod(nelem.astype(np.double), axis=1))
+        matrix = (1+2*d)*12 + 4
+        return rows * ((1+fill)*matrix + (2+ksp_vecs)*8) / 1024.**2
+
+    def get(self, mods, nelem):
+        '''
+        Returns an SField whose runs are begun with mods and nelem
+        '''
+        mods = np.array(mods, dtype=np.double)
+        nelem = np.array(nelem).astype(np.uint32)
+        key = (mods.tobytes(), nelem.shape, nelem.tobytes())
+        if key in self.fields:
+            self.hits += 1
+            sf, size = self.fields.pop(key)
+        else:
+            self.misses += 1
+            sf = SField()
+            sf.__enter__()
+            try:
+                sf.BeginRuns(mods, nelem)
+                size = SFieldPool.footprint_mb(nelem, sf.GetDim(),
+                                               fill=self.fill,
+                                               ksp_vecs=self.ksp_vecs)
+            except:
+                # Destroying the field also ends runs that were begun
+                sf.__exit__(None, None, None)
+                raise
+            self.total_mb += size
+        self.fields[key] = (sf, size)
+        # The level just used is kept even if it alone exceeds max_mb
+        while self.total_mb > self.max_mb and len(self.fields) > 1:
+            self._release(*self.fields.popitem(last=False)[1])
+        return sf
+
+    def _release(self, sf, size):
+        self.total_mb -= size
+        try:
+            sf.EndRuns()
+        finally:
+            sf.__exit__(None, None, None)
+
+    def clear(self):
+        while len(self.fields) > 0:
+            self._release(*self.fields.popitem(last=False)[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.clear()
+
+    def __str__(self):
+        return "SFieldPool: {} levels, {:.1f}MB, {} hits, {} misses".format(
+            len(self.fields), self.total_mb, self.hits, self.misses)
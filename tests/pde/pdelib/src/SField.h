@@ -8,6 +8,9 @@ int SFieldCreate(SField *sf,unsigned long seed);
 
 int SFieldBeginRuns(SField sf, const double *mod, const unsigned int *Ns, unsigned int count);
 int SFieldSample(SField sf, double *goal);
+int SFieldSolveFor(SField sf, double *Y, unsigned int yCount, double *goal);
+int SFieldSolveForBatch(SField sf, double *Y, unsigned int yCount,
+                        unsigned int M, double *goals);
 int SFieldEndRuns(SField sf);
 
 int SFieldDestroy(SField *sf);
@@ -506,6 +506,18 @@ int SFieldSolveFor(SField sfv, double *Y,
     return 0;
 }
 
+int SFieldSolveForBatch(SField sfv, double *Y, unsigned int yCount,
+                        unsigned int M, double *goals) {
+    // Y is an M x yCount row-major matrix, one sample per row
+    assert(Y && goals);
+    unsigned int m;
+    for (m=0;m<M;m++){
+        int ierr = SFieldSolveFor(sfv, Y+m*yCount, yCount, goals+m);
+        if (ierr) return ierr;
+    }
+    return 0;
+}
+
 int SFieldEndRuns(SField sfv) {
     mySField sf = (mySField)sfv;
     assert(sf->running);
@@ -1,21 +1,48 @@
 import numpy as np
 
+BLOCK_SIZE = 1024
 
-def SamplePDE(sf, run, moments, mods, inds, M):
+
+def SamplePDE(pool, run, moments, mods, inds, M):
     import time
+    from mimclib.mimc import MomentAccumulator
     timeStart = time.time()
-    psums = np.zeros(len(moments))
-    sf.BeginRuns(mods, 1./run.fnHierarchy(inds))
-    for m in range(0, M):
-        psums += sf.Sample()**moments
-    sf.EndRuns()
-    return M, psums, time.time() - timeStart
+    acc = MomentAccumulator.zeros(1, len(moments))
+    # The runs of the level are begun once and reused by later calls
+    sf = pool.get(mods, 1./run.fnHierarchy(inds))
+    # Samples are solved for in blocks to bound the memory of the inputs,
+    # which are drawn into the same buffer for every block
+    Y = np.empty((min(BLOCK_SIZE, M), sf.GetN()))
+    for m in range(0, M, BLOCK_SIZE):
+        goals = sf.SampleBatch(min(BLOCK_SIZE, M-m), Y)
+        acc.merge(MomentAccumulator.from_samples(goals, len(moments)))
+    return M, acc, time.time() - timeStart
+
+
+def addExtraArguments(parser):
+    parser.add_argument("-qoi_pool_mb", type=float, default=512.,
+                        action="store", help="Memory in MB of the levels \
+whose solvers are kept between samples")
+    parser.add_argument("-qoi_pool_fill", type=float, default=1.,
+                        action="store", help="Non-zeros of the factorization \
+of the preconditioner relative to the matrix, to estimate the memory of a \
+level")
+    parser.add_argument("-qoi_pool_ksp_vecs", type=int, default=35,
+                        action="store", help="Work vectors of the Krylov \
+solver, to estimate the memory of a level")
 
 if __name__ == "__main__":
-    from pdelib.SField import SField
+    from pdelib.SField import SField, SFieldPool
     SField.Init()
-    with SField() as sf:
+    with SFieldPool() as pool:
         import mimclib.test
-        mimclib.test.RunStandardTest(fnSampleLvl=lambda *a: SamplePDE(sf, *a))
+
+        def fnInit(run):
+            pool.max_mb = run.params.qoi_pool_mb
+            pool.fill = run.params.qoi_pool_fill
+            pool.ksp_vecs = run.params.qoi_pool_ksp_vecs
+        mimclib.test.RunStandardTest(fnSampleLvl=lambda *a: SamplePDE(pool, *a),
+                                     fnAddExtraArgs=addExtraArguments,
+                                     fnInit=fnInit)
 
     SField.Final()
@@ -17,6 +17,8 @@ def addExtraArguments(parser):
     parser.register('type', 'bool', lambda v: v.lower() in ("yes",
                                                             "true",
                                                             "t", "1"))
+    parser.add_argument("-db_engine", type=str, action="store",
+                        help="Database engine, mysql or sqlite")
     parser.add_argument("-db_name", type=str, action="store",
                         help="Database Name")
     parser.add_argument("-db_user", type=str, action="store",
@@ -38,6 +40,8 @@ def main():
     import mimclib.test
     args = mimclib.test.parse_known_args(parser)
     db_args = dict()
+    if args.db_engine is not None:
+        db_args["engine"] = args.db_engine
     if args.db_name is not None:
         db_args["db"] = args.db_name
     if args.db_user is not None:
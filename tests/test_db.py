@@ -0,0 +1,323 @@
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+import numpy as np
+import mimclib.db as mimcdb
+import mimclib.mimc as mimc
+
+
+def _sample(inds):
+    h = np.array(inds, dtype=np.float)
+    return 1 + np.sum(2.**-h, axis=1) + \
+        np.random.normal()*0.1*np.prod(2.**-h, axis=1)
+
+
+def _run(fnSampleQoI=_sample):
+    np.random.seed(0)
+    run = mimc.MIMCRun(dim=2, moments=2, reuse_samples=True, bayesian=False,
+                       w=[1., 1.], s=[1., 1.], gamma=[1., 1.],
+                       beta=[2., 2.], TOL=0.05, max_TOL=0.1, max_add_itr=2,
+                       r1=2, r2=1.1, h0inv=[2, 2], M0=10, min_lvls=2, Ca=3,
+                       theta=0.5, abs_bnd=False, const_theta=False,
+                       verbose=False)
+    run.setFunctions(fnSampleQoI=fnSampleQoI)
+    run.doRun()
+    return run
+
+
+def _py2_pickle(x):
+    # cPickle.dumps(x, 2) of a float64 array under Python 2, where the data
+    # of the array is a str
+    data = struct.pack('<%dd' % len(x), *x)
+    return (b"\x80\x02cnumpy.core.multiarray\n_reconstruct\nq\x01cnumpy\n"
+            b"ndarray\nq\x02K\x00\x85U\x01b\x87Rq\x03(K\x01K" +
+            bytearray([len(x)]) + b"\x85cnumpy\ndtype\nq\x04U\x02f8K\x00K\x01"
+            b"\x87Rq\x05(K\x03U\x01<NNNJ\xff\xff\xff\xffJ\xff\xff\xff\xffK\x00"
+            b"tb\x89U" + bytearray([len(data)]) + data + b"tb.")
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "mimc.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_read(self, db, run_id, run, iterations=1):
+        # Every iteration was written with the data of run
+        data = db.readRuns([run_id])
+        self.assertEqual(len(data), iterations)
+        ind = np.lexsort(np.array(run.data.lvls).T[::-1])
+        for d in data:
+            read = d.run.data
+            np.testing.assert_array_equal(read.lvls,
+                                          np.array(run.data.lvls)[ind])
+            np.testing.assert_array_equal(read.M, run.data.M[ind])
+            np.testing.assert_allclose(read.psums, run.data.psums[ind],
+                                       rtol=1e-12)
+            self.assertEqual(d.run.stat_error, run.stat_error)
+
+    def test_round_trip(self):
+        run = _run()
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            self.assertEqual(db.schemaVersion(), mimcdb.SCHEMA_VERSION)
+            run_id = db.createRun(tag="test", mimc_run=run)
+            db.writeRunData(run_id, run, iteration_idx=0, TOL=run.params.TOL,
+                            totalTime=1., userdata={"a": [1, 2]})
+            db.markRunSuccessful(run_id, comment="done")
+        # The data is on disk and read by a new connection
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite",
+                                 persistent=False) as db:
+            np.testing.assert_array_equal(db.getRunsIDs(tag="test",
+                                                        done_flag=1),
+                                          [run_id])
+            self._check_read(db, run_id, run)
+            data = db.readRuns([run_id])[0]
+            self.assertEqual(data.user_data, {"a": [1, 2]})
+            self.assertEqual(data.comment, "done")
+            np.testing.assert_array_equal(data.run.Vl_estimate,
+                                          run.Vl_estimate[np.lexsort(
+                                              np.array(run.data.lvls).T[::-1])])
+            self.assertEqual(db.deleteRuns([run_id]), 1)
+            self.assertEqual(len(db.getRunsIDs(tag="test")), 0)
+            with db.connect() as cur:
+                # The levels are deleted with their run
+                self.assertEqual(cur.execute("SELECT count(*) FROM tbl_lvls"
+                                             ).fetchone()[0], 0)
+
+    def test_large_mean(self):
+        # The variances of a QoI with a large mean are lost in raw power sums
+        run = _run(lambda inds: 1e8 + _sample(inds))
+        Vl = run.data.calcVl()
+        self.assertLess(np.min(Vl), 1e-3)
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            run_id = db.createRun(tag="test", mimc_run=run)
+            db.writeRunData(run_id, run, iteration_idx=0, TOL=run.params.TOL,
+                            totalTime=1.)
+            read = db.readRuns([run_id])[0].run.data
+        ind = np.lexsort(np.array(run.data.lvls).T[::-1])
+        np.testing.assert_array_equal(read.acc.mean, run.data.acc.mean[ind])
+        np.testing.assert_array_equal(read.acc.csums,
+                                      run.data.acc.csums[ind])
+        np.testing.assert_allclose(read.calcVl(), Vl[ind], rtol=1e-12)
+        self.assertGreater(np.max(np.abs(mimc.MomentAccumulator.from_psums(
+            run.data.psums, run.data.M).central_moment(2) - Vl) / Vl), 1e-3)
+
+    def test_single_insert(self):
+        # The levels of an iteration are written by a single executemany
+        run = _run()
+        calls = []
+        execute, executemany = mimcdb.SQLiteConn.execute, \
+            mimcdb.SQLiteConn.executemany
+
+        def record_execute(conn, query, params=[]):
+            calls.append(("execute", query))
+            return execute(conn, query, params)
+
+        def record_executemany(conn, query, seq_params):
+            seq_params = list(seq_params)
+            calls.append(("executemany", query, len(seq_params)))
+            return executemany(conn, query, seq_params)
+
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            run_id = db.createRun(tag="test", mimc_run=run)
+            db.schemaVersion()
+            mimcdb.SQLiteConn.execute = record_execute
+            mimcdb.SQLiteConn.executemany = record_executemany
+            try:
+                db.writeRunData(run_id, run, iteration_idx=0,
+                                TOL=run.params.TOL, totalTime=1.)
+            finally:
+                mimcdb.SQLiteConn.execute = execute
+                mimcdb.SQLiteConn.executemany = executemany
+            self._check_read(db, run_id, run)
+        lvl_calls = [c for c in calls if "tbl_lvls" in c[1]]
+        self.assertEqual(len(lvl_calls), 1)
+        self.assertEqual(lvl_calls[0][0], "executemany")
+        self.assertEqual(lvl_calls[0][2], len(run.data.lvls))
+
+    def test_mysql_queries(self):
+        # The queries sent to MySQLdb by DBConn, without a server
+        class Cursor(object):
+            def __init__(self, log):
+                self.log = log
+
+            def executemany(self, query, seq_params):
+                self.log.append((query, seq_params))
+
+            def close(self):
+                self.log.append("close")
+
+        class Connection(object):
+            def __init__(self):
+                self.log = []
+
+            def cursor(self):
+                return Cursor(self.log)
+
+            def commit(self):
+                self.log.append("commit")
+
+            def rollback(self):
+                self.log.append("rollback")
+
+            def close(self):
+                self.log.append("close connection")
+
+        conn = Connection()
+        with mimcdb.DBConn(conn=conn) as cur:
+            cur.executemany("INSERT INTO t(a, b) VALUES(?, ?)",
+                            [[1, "x"], [2, "y"]])
+        self.assertEqual(conn.log, [("INSERT INTO t(a, b) VALUES(%s, %s)",
+                                     [(1, "x"), (2, "y")]),
+                                    "commit", "close"])
+        conn = Connection()
+        with self.assertRaises(KeyError):
+            with mimcdb.DBConn(conn=conn, close=True) as cur:
+                raise KeyError()
+        self.assertEqual(conn.log, ["rollback", "close", "close connection"])
+
+    def test_rollback(self):
+        # A failed write leaves neither the iteration nor its levels
+        run = _run()
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            run_id = db.createRun(tag="test", mimc_run=run)
+            Vl = run.Vl_estimate
+            run.Vl_estimate = Vl[:1]
+            with self.assertRaises(IndexError):
+                db.writeRunData(run_id, run, iteration_idx=0,
+                                TOL=run.params.TOL, totalTime=1.)
+            run.Vl_estimate = Vl
+            with db.connect() as cur:
+                self.assertEqual(cur.execute("SELECT count(*) FROM tbl_data"
+                                             ).fetchone()[0], 0)
+            # The connection is still usable
+            db.writeRunData(run_id, run, iteration_idx=0, TOL=run.params.TOL,
+                            totalTime=1.)
+            self._check_read(db, run_id, run)
+
+    def test_fork(self):
+        # A forked process opens its own connection instead of sharing the
+        # one of its parent
+        run = _run()
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            run_id = db.createRun(tag="test", mimc_run=run)
+            conn = db._conn
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    db.writeRunData(run_id, run, iteration_idx=1,
+                                    TOL=run.params.TOL, totalTime=1.)
+                    if db._conn is not conn:
+                        status = 0
+                    db.close()
+                finally:
+                    os._exit(status)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            # The connection of the parent is neither replaced nor closed
+            db.writeRunData(run_id, run, iteration_idx=0, TOL=run.params.TOL,
+                            totalTime=1.)
+            self.assertIs(db._conn, conn)
+            data = db.readRuns([run_id])
+            self.assertEqual(sorted(d.iteration_index for d in data), [0, 1])
+
+    def _v1_database(self, run, py2=False):
+        # A database of version 1, written by Python 2 if py2
+        conn = sqlite3.connect(self.path)
+        conn.execute('''
+CREATE TABLE tbl_lvls (
+    data_id       INTEGER NOT NULL,
+    lvl           TEXT NOT NULL,
+    lvl_hash      VARCHAR(35) NOT NULL,
+    El            REAL,
+    Vl            REAL,
+    Wl            REAL,
+    Tl            REAL,
+    Ml            INTEGER,
+    psums         BLOB,
+    UNIQUE (data_id, lvl_hash)
+)''')
+        conn.commit()
+        conn.close()
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            self.assertEqual(db.schemaVersion(), 1)
+            run_id = db.createRun(tag="test", mimc_run=run)
+            for itr in range(3):
+                db.writeRunData(run_id, run, iteration_idx=itr,
+                                TOL=run.params.TOL, totalTime=1.)
+            if py2:
+                with db.connect() as cur:
+                    rows = cur.execute("SELECT rowid, psums FROM tbl_lvls"
+                                       ).fetchall()
+                    cur.executemany("UPDATE tbl_lvls SET psums=? WHERE "
+                                    "rowid=?",
+                                    [[_py2_pickle(mimcdb._unpickle(p)), r]
+                                     for r, p in rows])
+            self._check_read(db, run_id, run, iterations=3)
+        return run_id
+
+    def test_migrate_py2_pickles(self):
+        run = _run()
+        run_id = self._v1_database(run, py2=True)
+        with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+            self.assertEqual(db.migrateSchema(chunk_size=1),
+                             3*len(run.data.lvls))
+            self.assertEqual(db.schemaVersion(), mimcdb.SCHEMA_VERSION)
+            self._check_read(db, run_id, run, iterations=3)
+
+    def test_interrupted_migration(self):
+        # Running the migration again after it failed at any step
+        run = _run()
+        execute, executemany = mimcdb.SQLiteConn.execute, \
+            mimcdb.SQLiteConn.executemany
+        for step in ["INSERT INTO tbl_lvls_v2", "tbl_lvls RENAME TO",
+                     "tbl_lvls_v2 RENAME TO", "CREATE VIEW",
+                     "INSERT INTO tbl_schema", "DROP TABLE tbl_lvls_v1"]:
+            if os.path.exists(self.path):
+                shutil.rmtree(self.tmpdir)
+                os.mkdir(self.tmpdir)
+            run_id = self._v1_database(run)
+
+            def fail_execute(conn, query, params=[]):
+                if step in query:
+                    raise KeyboardInterrupt()
+                return execute(conn, query, params)
+
+            with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+                inserts = []
+
+                def fail_executemany(conn, query, seq_params):
+                    # Fails on the second chunk of levels
+                    if step in query:
+                        inserts.append(query)
+                        if len(inserts) == 2:
+                            raise KeyboardInterrupt()
+                    return executemany(conn, query, seq_params)
+
+                mimcdb.SQLiteConn.execute = fail_execute
+                mimcdb.SQLiteConn.executemany = fail_executemany
+                try:
+                    with self.assertRaises(KeyboardInterrupt):
+                        db.migrateSchema(chunk_size=1)
+                finally:
+                    mimcdb.SQLiteConn.execute = execute
+                    mimcdb.SQLiteConn.executemany = executemany
+            with mimcdb.MIMCDatabase(db=self.path, engine="sqlite") as db:
+                migrated = db.migrateSchema(chunk_size=1)
+                self.assertEqual(db.schemaVersion(), mimcdb.SCHEMA_VERSION)
+                self.assertIn(migrated, [0, 3*len(run.data.lvls)])
+                self._check_read(db, run_id, run, iterations=3)
+                with db.connect() as cur:
+                    self.assertFalse(cur.tableExists("tbl_lvls_v2"))
+                    self.assertEqual(cur.execute(
+                        "SELECT count(*) FROM vw_lvls").fetchone()[0],
+                                     3*len(run.data.lvls))
+
+if __name__ == '__main__':
+    unittest.main()
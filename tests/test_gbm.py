@@ -0,0 +1,85 @@
+import os
+import unittest
+import importlib.util
+import numpy as np
+
+
+def _load_run():
+    # tests/gbm/run.py, under a name that does not clash with the run
+    # modules of the other examples
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "gbm", "run.py")
+    spec = importlib.util.spec_from_file_location("gbm_run", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def _wcumsum(x, w):
+    # The element by element version of wcumsum for a single path
+    out = np.empty(len(x))
+    out[0] = x[0]
+    for i in range(1, len(x)):
+        out[i] = w[i]*out[i-1] + x[i]
+    return out
+
+
+class TestWCumSum(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.gbm = _load_run()
+
+    def _check(self, x, w, block, rtol=1e-12):
+        out = self.gbm.wcumsum_numpy(x, w, block=block)
+        x, w = np.broadcast_arrays(x, w)
+        self.assertEqual(out.shape, x.shape)
+        for xi, wi, oi in zip(x.reshape((-1, x.shape[-1])),
+                              w.reshape((-1, w.shape[-1])),
+                              out.reshape((-1, out.shape[-1]))):
+            np.testing.assert_allclose(oi, _wcumsum(xi, wi), rtol=rtol,
+                                       atol=1e-300)
+
+    def test_paths(self):
+        np.random.seed(0)
+        x = np.random.randn(5, 100)
+        w = 1 + 0.1*np.random.randn(5, 100)
+        for block in [1, 7, 100, 1024]:
+            self._check(x, w, block)
+            self._check(x[0], w[0], block)
+        # The weights of a single path for all paths
+        self._check(x, w[0], 7)
+        # The initial condition of the GBM example
+        self._check(np.concatenate(([1.], np.zeros(99))), w[0], 16)
+
+    def test_overflow(self):
+        # The cumulative products of the weights underflow or overflow
+        # within a block, so that only the blocks of the first and last
+        # paths are summed one element at a time
+        np.random.seed(1)
+        x = np.random.randn(3, 64)
+        w = 1 + 0.1*np.random.randn(3, 64)
+        w[0, 10:20] = 1e-100
+        # Large weights of a path that is zero up to them
+        x[2, :45] = 0
+        w[2, 40:45] = 1e200
+        with np.errstate(over='raise', invalid='raise'):
+            ref = _wcumsum(x[2], w[2])
+        self.assertTrue(np.all(np.isfinite(ref)))
+        with np.errstate(over='ignore', under='ignore'):
+            P = np.cumprod(w, axis=-1)
+        self.assertEqual(P[0, -1], 0)
+        self.assertTrue(np.isinf(P[2, -1]))
+        for block in [8, 32, 64]:
+            self._check(x, w, block)
+
+    def test_library(self):
+        if self.gbm.wcumsum is self.gbm.wcumsum_numpy:
+            self.skipTest("libwcumsum.so is not built")
+        np.random.seed(2)
+        x, w = np.random.randn(50), 1 + 0.1*np.random.randn(50)
+        np.testing.assert_allclose(self.gbm.wcumsum(x, w), _wcumsum(x, w),
+                                   rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "HJM"))
+
+
+def _time_stepping(ind, dW, F, G, U, Psi, drift, vols, f0, t_max=1.0,
+                   tau_max=2.0):
+    # The forward curve stepped in time as in multiLevelHjmModel, for the
+    # increments dW[k, j] of the Wiener paths
+    import scipy.integrate as spint
+    t = np.linspace(0, t_max, 2**ind[0]+1)
+    tau = np.concatenate((np.linspace(0, t_max, 2**ind[2]+1)[:-1],
+                          np.linspace(t_max, tau_max, 2**ind[1]+1)))
+    dt = t[1]-t[0]
+    f = np.zeros(len(tau))
+    short, add, lstar = 0., 0., 0
+    for j in range(1, len(t)):
+        prev = lstar
+        while tau[lstar+1] <= t[j]:
+            lstar += 1
+        rate = f[lstar]+f0(tau[lstar])
+        add += F(short)*U(rate)*dt
+        short += rate*dt
+        f[prev:] += drift(tau[prev:]-t[j-1])*dt
+        for k, vol in enumerate(vols):
+            f[prev:] += vol(tau[prev:]-t[j-1])*dW[k, j-1]
+    return F(short)*spint.simps(Psi(f[lstar:]+f0(tau[lstar:])),
+                                tau[lstar:])+add
+
+
+class TestHJM(unittest.TestCase):
+    inds = [[3, 2, 2], [2, 2, 2], [3, 1, 1], [2, 1, 1]]
+
+    def test_time_stepping(self):
+        import HJM
+        M = 4
+        for model in [HJM.hoLeeModel(), HJM.twoFactorGaussianModel()]:
+            for ind in [[0, 0, 0], [4, 2, 1], [3, 2, 5], [5, 3, 3]]:
+                np.random.seed(2)
+                batch = HJM.multiLevelHjmModelBatch([ind], M, *model)[:, 0]
+                np.random.seed(2)
+                dW = np.sqrt(2.**-ind[0]) * \
+                     np.random.randn(M, len(model[5]), 2**ind[0])
+                ref = [_time_stepping(ind, dW[m], *model) for m in range(M)]
+                np.testing.assert_allclose(batch, ref, rtol=1e-10)
+
+    def test_cache_memory(self):
+        import HJM
+        cache = HJM.LevelCache(max_mb=1.)
+        F, G, U, Psi, drift, vols, f0 = HJM.hoLeeModel()
+        for N in range(7, 13):
+            ind = (N, 4, 4)
+            lvl = cache.get(ind, lambda: HJM.HjmLevel(ind, drift, vols, f0,
+                                                      1., 2.))
+            # No table is quadratic in the number of time steps
+            self.assertLess(lvl.nbytes, 8 * 4.**N)
+            self.assertLessEqual(cache.total_mb, max(cache.max_mb,
+                                                     lvl.nbytes/1024.**2))
+            self.assertAlmostEqual(cache.total_mb,
+                                   sum([l.nbytes for l in
+                                        cache.entries.values()])/1024.**2)
+        self.assertIs(cache.get(ind, None), lvl)
+
+    def test_batch_matches_samples(self):
+        # The default -qoi_batch True and -qoi_batch False must estimate
+        # the same quantity with the same random draws. The samples are
+        # stepped in time by hoLeeExample, the batch is in closed form
+        import run
+        M = 20
+        np.random.seed(0)
+        samples = np.array([run.mySampleQoI(None, self.inds)
+                            for m in range(M)])
+        np.random.seed(0)
+        batch = run.mySampleQoIBatch(None, self.inds, M)
+        self.assertEqual(batch.shape, (M, len(self.inds)))
+        np.testing.assert_allclose(batch, samples, rtol=1e-12)
+
+    def test_baseline(self):
+        # Values of hoLeeExample2 and hoLeeExample3 before the batch
+        # versions were added, from consecutive calls after seeding
+        import HJM
+        for fn2, fn3 in [(HJM.hoLeeExample2, HJM.hoLeeExample3),
+                         (lambda inds: HJM.hoLeeExample2Batch(inds, 1)[0],
+                          lambda inds: HJM.hoLeeExample3Batch(inds, 1)[0])]:
+            np.random.seed(3)
+            np.testing.assert_allclose(fn2([[0, 0]]), [0.13561302108820542],
+                                       rtol=1e-12)
+            np.testing.assert_allclose(fn2([[5, 3], [4, 3], [5, 2], [4, 2]]),
+                                       [0.11915567084768387,
+                                        0.11896699812917642,
+                                        0.119155202977953,
+                                        0.11896653100638181], rtol=1e-12)
+            np.testing.assert_allclose(fn3([[2], [1]]),
+                                       [0.1007269360078429,
+                                        0.09953634373471187], rtol=1e-12)
+
+    def test_two_factor_batch_matches_samples(self):
+        import HJM
+        M = 5
+        model = HJM.twoFactorGaussianModel()
+        N = max([ind[0] for ind in self.inds])
+        np.random.seed(1)
+        batch = HJM.twoFactorGaussianExampleBatch(self.inds, M)
+        np.random.seed(1)
+        dW = np.sqrt(2.**-N) * np.random.randn(M, len(model[5]), 2**N)
+        for i, ind in enumerate(self.inds):
+            # The increments of the coarser time steps
+            dW_ind = dW.reshape((M, len(model[5]), 2**ind[0], -1)).sum(axis=-1)
+            ref = [_time_stepping(ind, dW_ind[m], *model, tau_max=3.0)
+                   for m in range(M)]
+            np.testing.assert_allclose(batch[:, i], ref, rtol=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()
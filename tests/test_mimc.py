@@ -0,0 +1,477 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import mimclib.mimc as mimc
+import mimclib.setutil as setutil
+
+
+class TestWorkModel(unittest.TestCase):
+    lvls = np.arange(6).reshape((-1, 1))
+
+    def test_fit(self):
+        Tl = 1e-3 * 2.**np.arange(6)
+        w0, a, rates = mimc.fit_work_model(self.lvls, Tl)
+        model = w0 + np.exp(a) * mimc.work_estimate(self.lvls, rates)
+        np.testing.assert_allclose(model, Tl, rtol=1e-3)
+
+    def test_zero_and_tiny_timings(self):
+        # Cheap levels measured with a coarse timer
+        Tl = np.array([0., 1e-9, 0., 4e-3, 8e-3, 1.6e-2])
+        with np.errstate(all='raise'):
+            w0, a, rates = mimc.fit_work_model(self.lvls, Tl)
+            model = w0 + np.exp(a) * mimc.work_estimate(self.lvls, rates)
+        self.assertTrue(np.all(np.isfinite(model) & (model > 0)))
+
+    def test_no_timings(self):
+        self.assertIsNone(mimc.fit_work_model(self.lvls, np.zeros(6)))
+        self.assertIsNone(mimc.fit_work_model(self.lvls[:2],
+                                              [np.nan, -1.]))
+
+
+class TestMomentAccumulator(unittest.TestCase):
+    def _check_merge(self, x, splits, rtol):
+        ref = mimc.MomentAccumulator.from_samples(x, 4)
+        acc = mimc.MomentAccumulator.zeros(1, 4)
+        for part in np.split(x, splits):
+            acc.merge(mimc.MomentAccumulator.from_samples(part, 4))
+        self.assertEqual(acc.M[0], len(x))
+        np.testing.assert_allclose(acc.mean, ref.mean, rtol=1e-15)
+        np.testing.assert_allclose(acc.csums[:, 1:], ref.csums[:, 1:],
+                                   rtol=rtol)
+
+    def test_merge(self):
+        np.random.seed(0)
+        x = np.random.exponential(size=1000)
+        self._check_merge(x, [1, 2, 100, 100, 517], rtol=1e-12)
+
+    def test_merge_large_mean(self):
+        # Raw power sums of these samples lose every digit of the variance
+        np.random.seed(0)
+        x = 1e8 + np.random.randn(1000)
+        self._check_merge(x, [300, 301, 700], rtol=1e-5)
+        var = np.var(x - 1e8)
+        acc = mimc.MomentAccumulator.zeros(2, 4)
+        acc.merge(mimc.MomentAccumulator.from_samples(x[:500], 4), [1])
+        acc.merge(mimc.MomentAccumulator.from_samples(x[500:], 4), [1])
+        self.assertEqual(list(acc.M), [0, 1000])
+        np.testing.assert_allclose(acc.central_moment(2)[1], var, rtol=1e-7)
+        self.assertEqual(acc.central_moment(2)[0], 0)
+
+    def test_from_psums_center(self):
+        # Power sums about a center close to the mean, as returned by the
+        # native samplers, keep the variance of samples with a large mean
+        np.random.seed(0)
+        x = 1e8 + np.random.randn(1000)
+        ref = mimc.MomentAccumulator.from_samples(x, 4)
+        acc = mimc.MomentAccumulator.from_psums(
+            mimc.compute_power_sums(x, 4, center=x[0]), [len(x)],
+            center=x[0])
+        np.testing.assert_allclose(acc.mean, ref.mean, rtol=1e-15)
+        np.testing.assert_allclose(acc.csums[:, 1:], ref.csums[:, 1:],
+                                   rtol=1e-5)
+
+
+def _old_central_moment(psums, M, moment):
+    # The formula of http://mathworld.wolfram.com/CentralMoment.html in
+    # terms of the raw moments, used before compute_central_moments
+    raw = psums / M[:, None]
+    if moment == 1:
+        return raw[:, 0]
+    val = (-1)**moment * raw[:, 0]**moment
+    for k in range(1, moment+1):
+        val += mimc._nchoosek(moment, k) * (-1)**(moment-k) * \
+            raw[:, k-1] * raw[:, 0]**(moment-k)
+    return val
+
+
+class TestCentralMoments(unittest.TestCase):
+    def test_samples(self):
+        np.random.seed(0)
+        xs = [np.random.randn(100), 2 + np.random.exponential(size=50),
+              np.random.uniform(-3, 1, size=7), [1.5]]
+        psums = np.array([mimc.compute_power_sums(x, 6) for x in xs])
+        M = np.array([len(x) for x in xs])
+        val = mimc.compute_central_moments(psums, M)
+        self.assertEqual(val.shape, (len(xs), 6))
+        for i, x in enumerate(xs):
+            self.assertAlmostEqual(val[i, 0], np.mean(x), places=13)
+            ref = [np.mean((x - np.mean(x))**k) for k in range(2, 7)]
+            np.testing.assert_allclose(val[i, 1:], ref, rtol=1e-8,
+                                       atol=1e-14)
+        for k in range(1, 7):
+            np.testing.assert_allclose(
+                mimc.compute_central_moment(psums, M, k), val[:, k-1],
+                rtol=1e-13, atol=1e-15)
+            np.testing.assert_allclose(_old_central_moment(psums, M, k),
+                                       val[:, k-1], rtol=1e-8, atol=1e-12)
+
+    def test_empty(self):
+        psums = np.array([[0., 0., 0.], [3., 5., 9.], [0., 0., 0.]])
+        M = np.array([0, 2, 0])
+        for empty_value in [0, np.inf]:
+            val = mimc.compute_central_moments(psums, M,
+                                               empty_value=empty_value)
+            np.testing.assert_array_equal(val[[0, 2]], empty_value)
+            np.testing.assert_allclose(val[1], [1.5, 0.25, 0.])
+            self.assertEqual(mimc.compute_central_moment(
+                psums, M, 2, empty_value=empty_value)[0], empty_value)
+        self.assertTrue(np.all(np.isnan(mimc.compute_central_moments(
+            psums[:1], M[:1], empty_value=np.nan))))
+
+    def test_negative_even_moments(self):
+        # Rounding errors below the machine precision are dropped
+        x = np.full(3, 0.1)
+        val = mimc.compute_central_moments(
+            [mimc.compute_power_sums(x, 4)], [3])
+        self.assertTrue(np.all(val[0, 1::2] >= 0))
+        with self.assertRaises(ArithmeticError):
+            mimc.compute_central_moments([[1., 0.]], [2])
+
+
+class TestLevelSet(unittest.TestCase):
+    def _random_lvls(self, count, seed=0):
+        rs = np.random.RandomState(seed)
+        lvls = []
+        while len(lvls) < count:
+            lvl = rs.randint(0, 6, size=3).tolist()
+            if lvl not in lvls:
+                lvls.append(lvl)
+        return lvls
+
+    def test_find(self):
+        # The same rows as a linear search of the list of levels
+        lvls = self._random_lvls(60)
+        s = mimc.LevelSet(3)
+        for k in range(0, 60, 13):
+            s.extend(lvls[k:k+13])
+        self.assertEqual(len(s), 60)
+        self.assertEqual(s.tolist(), lvls)
+        np.testing.assert_array_equal(np.array(s), lvls)
+        for lvl in np.ndindex(6, 6, 6):
+            lvl = list(lvl)
+            self.assertEqual(s.find(lvl),
+                             lvls.index(lvl) if lvl in lvls else None)
+            self.assertEqual(lvl in s, lvl in lvls)
+
+    def test_duplicates(self):
+        s = mimc.LevelSet(2, [[0, 0], [1, 0]])
+        with self.assertRaises(ValueError):
+            s.extend([[0, 1], [1, 0]])
+        with self.assertRaises(ValueError):
+            s.extend([[0, 1], [0, 1]])
+        # A failed extension leaves the set unchanged
+        self.assertEqual(s.tolist(), [[0, 0], [1, 0]])
+        self.assertIsNone(s.find([0, 1]))
+        s.extend([[0, 1]])
+        self.assertEqual(s.find([0, 1]), 2)
+
+    def test_has_next(self):
+        lvls = self._random_lvls(80, seed=1)
+        s = mimc.LevelSet(3, lvls)
+        ind = np.array([3, 0, 17, 79])
+        for i in range(3):
+            ref = [(np.array(l) + np.eye(3, dtype=int)[i]).tolist() in lvls
+                   for l in lvls]
+            np.testing.assert_array_equal(s.has_next(i), ref)
+            np.testing.assert_array_equal(s.has_next(i, ind),
+                                          np.array(ref)[ind])
+
+    def test_slices(self):
+        lvls = self._random_lvls(30, seed=2)
+        s = mimc.LevelSet(3, lvls)
+        self.assertEqual(s[4], lvls[4])
+        for ind in [slice(5, 20), slice(None, None, 3),
+                    np.arange(30) % 4 == 1]:
+            sub = s[ind]
+            ref = [lvls[k] for k in np.arange(30)[ind]]
+            self.assertIsInstance(sub, mimc.LevelSet)
+            self.assertEqual(sub.tolist(), ref)
+            # Rows of the subset, not of the whole set
+            for k, lvl in enumerate(ref):
+                self.assertEqual(sub.find(lvl), k)
+            self.assertIsNone(sub.find([9, 9, 9]))
+            np.testing.assert_array_equal(
+                sub.has_next(0), [(np.array(l) + [1, 0, 0]).tolist() in ref
+                                  for l in ref])
+            # Extending a subset does not change the set
+            sub.extend([[9, 9, 9]])
+            self.assertEqual(len(sub), len(ref)+1)
+            self.assertEqual(s.tolist(), lvls)
+            self.assertNotIn([9, 9, 9], s)
+
+
+def _is_boundary(d, lvls):
+    # A level is on the boundary if one of its successors is not in the set
+    # while the level is not on the corresponding axis plane
+    if len(lvls) == 1:
+        return [True]
+    return [any(l[i] > 0 and (np.array(l) + np.eye(d, dtype=int)[i]).tolist()
+                not in lvls for i in range(d)) for l in lvls]
+
+
+class TestCaches(unittest.TestCase):
+    def test_boundary(self):
+        d = 3
+        cache = mimc._BoundaryCache()
+        extend = mimc._TDLevelsExtender([0.2, 0.3, 0.5], min_deg=0.5)
+        lvls = mimc.LevelSet(d)
+        for itr in range(6):
+            lvls.extend(extend(lvls, 1)[0])
+            np.testing.assert_array_equal(cache.update(d, lvls),
+                                          _is_boundary(d, lvls.tolist()))
+            np.testing.assert_array_equal(cache.update(d, lvls),
+                                          mimc.is_boundary(d, lvls))
+        # Levels added one at a time, and to a new set
+        for lvl in [[0, 0, 5], [0, 1, 5], [0, 6, 0]]:
+            lvls.extend([lvl])
+            np.testing.assert_array_equal(cache.update(d, lvls),
+                                          _is_boundary(d, lvls.tolist()))
+        lvls = lvls[:10]
+        np.testing.assert_array_equal(cache.update(d, lvls),
+                                      _is_boundary(d, lvls.tolist()))
+
+    def _add_samples(self, data, samples):
+        # samples[i] are the new samples of the i'th level
+        acc = mimc.MomentAccumulator.zeros(len(data), 2)
+        for i, x in enumerate(samples):
+            acc.merge(mimc.MomentAccumulator.from_samples(x, 2), [i])
+        data.addSamples(acc, acc.M.copy(), np.zeros(len(data)))
+
+    def test_level_values(self):
+        computed = []
+
+        def calcVl(data):
+            computed.append(len(data))
+            return data.calcVl()
+
+        np.random.seed(0)
+        data = mimc.MIMCData(1, moments=2)
+        data.addLevels([[0], [1], [2]])
+        self._add_samples(data, np.random.randn(3, 10))
+        cache = mimc._LevelCache(calcVl)
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        self.assertEqual(computed, [3])
+        # New samples of a single level
+        self._add_samples(data, [[], 5 + np.random.randn(4), []])
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        self.assertEqual(computed, [3, 1])
+        # New levels, without samples
+        data.addLevels([[3], [4]])
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        self.assertEqual(computed, [3, 1, 2])
+        # Other samples with the same number of samples on every level
+        M = data.M.copy()
+        data.zero_samples()
+        self._add_samples(data, [np.random.randn(m) for m in M])
+        np.testing.assert_array_equal(data.M, M)
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        self.assertEqual(computed, [3, 1, 2, 5])
+        cache.clear()
+        np.testing.assert_array_equal(cache.update(data), data.calcVl())
+        self.assertEqual(computed, [3, 1, 2, 5, 5])
+
+
+class TestExtendLevels(unittest.TestCase):
+    w = np.array([0.4, 0.6])
+
+    def _td_set(self, max_deg):
+        profCalc = setutil.AnisoProfCalculator(self.w*0, self.w)
+        C, _ = profCalc.GetIndexSet(max_deg)
+        return sorted(map(tuple, C.to_dense_matrix(d_end=len(self.w)) - 1))
+
+    def test_incremental(self):
+        extend = mimc._TDLevelsExtender(self.w, min_deg=1)
+        lvls = mimc.LevelSet(len(self.w))
+        for itr in range(8):
+            newlvls, M = extend(lvls, 10)
+            self.assertGreater(len(newlvls), 0)
+            self.assertTrue(np.all(M == 10))
+            # The same levels as when extending from scratch
+            ref, _ = mimc.extend_lvls_td(self.w, lvls, 10, min_deg=1)
+            self.assertEqual(newlvls, ref)
+            lvls.extend(newlvls)
+            self.assertEqual(sorted(map(tuple, lvls)),
+                             self._td_set(np.max(np.dot(lvls, self.w))))
+
+    def test_rebuild(self):
+        # Levels that were not added by the extender itself
+        extend = mimc._TDLevelsExtender(self.w, min_deg=1)
+        lvls = mimc.LevelSet(len(self.w), [[0, 0], [1, 0], [0, 1]])
+        extend(lvls, 10)
+        lvls = mimc.LevelSet(len(self.w), [[0, 0], [1, 0]])
+        newlvls, _ = extend(lvls, 10)
+        ref, _ = mimc.extend_lvls_td(self.w, lvls, 10, min_deg=1)
+        self.assertEqual(newlvls, ref)
+        self.assertIn([0, 1], newlvls)
+
+    def test_same_length(self):
+        # The same level set extended by other levels than the ones
+        # returned, so that only its contents tell it apart
+        extend = mimc._TDLevelsExtender(self.w, min_deg=1)
+        lvls = mimc.LevelSet(len(self.w), [[0, 0]])
+        newlvls, _ = extend(lvls, 10)
+        self.assertIn([0, 1], newlvls)
+        lvls.extend([[k, 0] for k in range(1, len(newlvls)+1)])
+        newlvls, _ = extend(lvls, 10)
+        ref, _ = mimc.extend_lvls_td(self.w, lvls, 10, min_deg=1)
+        self.assertEqual(newlvls, ref)
+        self.assertIn([0, 1], newlvls)
+
+    def test_profit_order(self):
+        extend = mimc._TDLevelsExtender(self.w, min_deg=1)
+        lvls = []
+        for itr in range(5):
+            newlvls, _ = extend(lvls, 10)
+            deg = np.dot(newlvls, self.w)
+            self.assertTrue(np.all(np.diff(deg) >= -1e-12))
+            lvls = lvls + newlvls
+
+    def test_without_profits(self):
+        profCalc = setutil.AnisoProfCalculator(self.w*0, self.w)
+        handle = setutil.__lib__.GetIndexSet(profCalc._handle, 1., None)
+        setutil.VarSizeList(handle, min_dim=len(self.w))
+        ext = setutil.IndexSetExtender(profCalc)
+        handle = setutil.__lib__.IndexSetExtender_extend(ext._handle, 1., None)
+        self.assertEqual(sorted(map(tuple, setutil.VarSizeList(
+            handle, min_dim=len(self.w)).to_dense_matrix(d_end=2) - 1)),
+                         self._td_set(1.))
+
+
+def _sample(inds):
+    h = np.array(inds, dtype=np.float)
+    return 1 + np.sum(2.**-h, axis=1) + \
+        np.random.normal()*0.1*np.prod(2.**-h, axis=1)
+
+
+def _sample_batch(inds, M):
+    # M calls to _sample, drawing the same random numbers
+    h = np.array(inds, dtype=np.float)
+    return 1 + np.sum(2.**-h, axis=1) + \
+        np.random.normal(size=(M, 1))*0.1*np.prod(2.**-h, axis=1)
+
+
+class TestGenericSampler(unittest.TestCase):
+    def test_batch(self):
+        # Batches that do not divide M and are not aligned with the
+        # batches of GenericSampleLvl
+        mods, inds = mimc.lvl_to_inds_general([2, 1])
+        for batch_size in [1, 7, 1000]:
+            np.random.seed(3)
+            M, ref, _ = mimc.GenericSampleLvl(_sample, [1, 2, 3, 4], mods,
+                                              inds, 50, batch_size=8)
+            np.random.seed(3)
+            res = mimc.GenericSampleLvlBatch(_sample_batch, [1, 2, 3, 4],
+                                             mods, inds, 50,
+                                             batch_size=batch_size)
+            self.assertEqual(len(res), 3)
+            self.assertEqual(M, res[0])
+            acc = res[1]
+            np.testing.assert_array_equal(acc.M, ref.M)
+            np.testing.assert_allclose(acc.mean, ref.mean, rtol=1e-13)
+            np.testing.assert_allclose(acc.csums, ref.csums, rtol=1e-10)
+
+
+def _run(**kwargs):
+    params = dict(dim=2, moments=2, reuse_samples=True, bayesian=False,
+                  w=[1., 1.], s=[1., 1.], gamma=[1., 1.], beta=[2., 2.],
+                  TOL=0.05, max_TOL=0.1, max_add_itr=2, r1=2, r2=1.1,
+                  h0inv=[2, 2], M0=10, min_lvls=2, Ca=3, theta=0.5,
+                  abs_bnd=False, const_theta=False, verbose=False, seed=7,
+                  block_size=64)
+    params.update(kwargs)
+    run = mimc.MIMCRun(**params)
+    run.setFunctions(fnSampleQoI=_sample)
+    return run
+
+
+class TestRandomStreams(unittest.TestCase):
+    def _check_same(self, a, b):
+        np.testing.assert_array_equal(np.array(a.data.lvls),
+                                      np.array(b.data.lvls))
+        np.testing.assert_array_equal(a.data.M, b.data.M)
+        np.testing.assert_allclose(a.data.psums, b.data.psums, rtol=1e-13)
+
+    def test_workers(self):
+        # The samples depend on the seed only, not on the number of
+        # workers nor on the global generator
+        runs = []
+        for workers, seed in [(1, 0), (2, 1), (3, 2)]:
+            np.random.seed(seed)
+            run = _run(workers=workers)
+            run.doRun()
+            runs.append(run)
+        self.assertGreater(np.max(runs[0].data.M), 64)
+        self._check_same(runs[0], runs[1])
+        self._check_same(runs[0], runs[2])
+
+    def test_seed(self):
+        a, b = _run(seed=7), _run(seed=8)
+        a.doRun()
+        b.doRun()
+        self.assertFalse(np.array_equal(a.data.psums[0], b.data.psums[0]))
+
+    def test_streams(self):
+        streams = mimc.RandomStreams(3)
+        first = [s.generate_state(2) for s in streams.nextBlocks([1, 0], 3)]
+        again = [s.generate_state(2) for s in
+                 mimc.RandomStreams(3).nextBlocks((1, 0), 5)[:3]]
+        np.testing.assert_array_equal(first, again)
+        self.assertEqual(streams.blocks[(1, 0)], 3)
+        # Later blocks and other levels get other streams
+        later = streams.nextBlocks([1, 0], 1)[0].generate_state(2)
+        other = streams.nextBlocks([0, 1], 1)[0].generate_state(2)
+        self.assertEqual(len(set(map(tuple, first + [later, other]))), 5)
+
+
+class _Preempted(Exception):
+    pass
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "run.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_resume(self, **fns):
+        ref = _run(TOL=0.02)
+        ref.doRun()
+        run = _run(TOL=0.02, checkpoint=self.path)
+        run.setFunctions(**fns)
+        self.assertRaises(_Preempted, run.doRun)
+        self.assertLess(np.sum(run.data.M), np.sum(ref.data.M))
+
+        # A new process would continue with a different global generator
+        np.random.seed(1)
+        run = _run(TOL=0.02, checkpoint=self.path)
+        run.resume(self.path)
+        np.testing.assert_array_equal(np.array(run.data.lvls),
+                                      np.array(ref.data.lvls))
+        np.testing.assert_array_equal(run.data.M, ref.data.M)
+        np.testing.assert_allclose(run.data.psums, ref.data.psums,
+                                   rtol=1e-13)
+        self.assertEqual(run.totalErrorEst(), ref.totalErrorEst())
+
+    def test_resume_iteration(self):
+        def fnItrDone(i, TOL, totalTime):
+            if i == 1:
+                raise _Preempted()
+        self._check_resume(fnItrDone=fnItrDone)
+
+    def test_resume_sampling(self):
+        calls = []
+
+        def fnSampleQoI(inds):
+            calls.append(1)
+            if len(calls) > 5000:
+                raise _Preempted()
+            return _sample(inds)
+        self._check_resume(fnSampleQoI=fnSampleQoI)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+from unittest import mock
+import numpy as np
 
 class TestStringMethods(unittest.TestCase):
     def test_pde(self):
@@ -7,5 +9,155 @@ class TestStringMethods(unittest.TestCase):
         # TODO: Figure out a way to pass the correct arguments
         self.assertEqual(pde.run.MLMCPDE(), 0)
 
+
+class _StubField(object):
+    # Records the calls that SFieldPool makes to an SField, without the
+    # solver library
+    N = 3
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+        self.buffers = []
+
+    def __enter__(self):
+        self.calls.append("enter")
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.calls.append("exit")
+
+    def BeginRuns(self, mods, nelem):
+        self.calls.append("begin")
+        if self.fail:
+            raise RuntimeError("BeginRuns")
+
+    def EndRuns(self):
+        self.calls.append("end")
+
+    def GetDim(self):
+        return 1
+
+    def GetN(self):
+        return self.N
+
+    def SampleBatch(self, M, Y=None):
+        self.buffers.append(Y)
+        Y = Y[:M]
+        Y[:] = np.random.uniform(-np.sqrt(3), np.sqrt(3), size=Y.shape)
+        return np.sum(Y, axis=1)
+
+
+class _StubRun(object):
+    def fnHierarchy(self, inds):
+        return 2.**-np.array(inds)
+
+
+class TestSFieldPool(unittest.TestCase):
+    def setUp(self):
+        import pde.pdelib.SField as module
+        self.module = module
+        self.fields = []
+
+        def create(fail=False):
+            self.fields.append(_StubField(fail))
+            return self.fields[-1]
+        self.create = create
+
+    def _pool(self, max_mb, fail=False):
+        pool = self.module.SFieldPool(max_mb=max_mb)
+        patch = mock.patch.object(self.module, "SField",
+                                  lambda: self.create(fail))
+        patch.start()
+        self.addCleanup(patch.stop)
+        return pool
+
+    def test_reuse(self):
+        pool = self._pool(max_mb=1e6)
+        sf = pool.get([1.], [[4]])
+        self.assertIs(pool.get([1.], [[4]]), sf)
+        self.assertIsNot(pool.get([2.], [[4]]), sf)
+        self.assertIsNot(pool.get([1.], [[8]]), sf)
+        self.assertEqual((pool.hits, pool.misses), (1, 3))
+        self.assertEqual(len(self.fields), 3)
+        self.assertEqual(self.fields[0].calls, ["enter", "begin"])
+        pool.clear()
+        self.assertEqual(len(pool.fields), 0)
+        self.assertAlmostEqual(pool.total_mb, 0.)
+        for sf in self.fields:
+            self.assertEqual(sf.calls, ["enter", "begin", "end", "exit"])
+
+    def test_evict(self):
+        size = self.module.SFieldPool.footprint_mb(np.array([[1000]]), 1)
+        pool = self._pool(max_mb=2.5*size)
+        first = pool.get([1.], [[1000]])
+        second = pool.get([2.], [[1000]])
+        # Using the first level again makes the second the least recent
+        self.assertIs(pool.get([1.], [[1000]]), first)
+        pool.get([3.], [[1000]])
+        self.assertEqual(len(pool.fields), 2)
+        self.assertAlmostEqual(pool.total_mb, 2*size)
+        self.assertEqual(second.calls, ["enter", "begin", "end", "exit"])
+        self.assertEqual(first.calls, ["enter", "begin"])
+        # A level larger than max_mb is kept alone
+        pool.get([1.], [[10**6]])
+        self.assertEqual(len(pool.fields), 1)
+        self.assertEqual(first.calls[-1], "exit")
+
+    def test_failed_begin(self):
+        pool = self._pool(max_mb=1e6, fail=True)
+        with self.assertRaises(RuntimeError):
+            pool.get([1.], [[4]])
+        self.assertEqual(self.fields[0].calls, ["enter", "begin", "exit"])
+        self.assertEqual(len(pool.fields), 0)
+        self.assertEqual(pool.total_mb, 0.)
+
+
+class TestSampleBatch(unittest.TestCase):
+    def test_buffer(self):
+        # The rows drawn into a buffer are the same random numbers as the
+        # matrix drawn without it
+        from pde.pdelib.SField import SField
+        sf = SField.__new__(SField)
+        sf.random_gen = np.random
+        sf.GetN = lambda: 5
+        sf.SolveForBatch = lambda Y: Y.copy()
+        np.random.seed(0)
+        ref = sf.SampleBatch(7)
+        Y = np.empty((10, 5))
+        np.random.seed(0)
+        np.testing.assert_array_equal(sf.SampleBatch(7, Y), ref)
+        np.testing.assert_array_equal(Y[:7], ref)
+
+
+class TestSamplePDE(unittest.TestCase):
+    def test_blocks(self):
+        import pde.run
+        from mimclib.mimc import MomentAccumulator
+        sf = _StubField()
+
+        class Pool(object):
+            def get(self, mods, nelem):
+                return sf
+
+        np.random.seed(0)
+        with mock.patch.object(pde.run, "BLOCK_SIZE", 4):
+            M, acc, t = pde.run.SamplePDE(Pool(), _StubRun(), np.arange(1, 4),
+                                          [1.], [[0]], 10)
+        self.assertEqual(M, 10)
+        # The blocks are drawn into the same buffer
+        self.assertEqual(len(sf.buffers), 3)
+        self.assertEqual(sf.buffers[0].shape, (4, _StubField.N))
+        for Y in sf.buffers:
+            self.assertIs(Y, sf.buffers[0])
+        np.random.seed(0)
+        goals = np.sum(np.random.uniform(-np.sqrt(3), np.sqrt(3),
+                                         size=(10, _StubField.N)), axis=1)
+        ref = MomentAccumulator.from_samples(goals, 3)
+        np.testing.assert_allclose(acc.mean, ref.mean)
+        np.testing.assert_allclose(acc.csums, ref.csums)
+        np.testing.assert_allclose(acc.psums(), ref.psums())
+
+
 if __name__ == '__main__':
     unittest.main()
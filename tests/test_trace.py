@@ -0,0 +1,82 @@
+import time
+import unittest
+import numpy as np
+import mimclib.mimc as mimc
+from mimclib.trace import LatencyHistogram, Tracer
+
+
+class TestLatency(unittest.TestCase):
+    def test_add(self):
+        hist = LatencyHistogram()
+        hist.add([1e-6, 1e-3, 1e-3])
+        hist.add(1e-1, 4)
+        self.assertEqual(hist.total_M, 7)
+        self.assertEqual(sorted(hist.counts[hist.counts > 0]), [1, 2, 4])
+        self.assertAlmostEqual(hist.mean(), (1e-6 + 2e-3 + 4e-1) / 7)
+        other = LatencyHistogram()
+        other.add(1e-3)
+        hist.merge(other)
+        self.assertEqual(hist.total_M, 8)
+        self.assertEqual(hist.counts.sum(), 8)
+
+    def test_sample_times(self):
+        # One slow sample in a block must show in the histogram instead of
+        # being averaged with the fast samples
+        calls = []
+
+        def sample(inds):
+            calls.append(1)
+            if len(calls) == 5:
+                time.sleep(0.05)
+            return np.zeros(len(inds))
+
+        tracer = Tracer()
+        M, psums, t, latency = mimc.GenericSampleLvl(sample, [1, 2],
+                                                     np.array([1.]), [[0]],
+                                                     20, batch_size=8,
+                                                     latency=True)
+        tracer.addSampleBlock([0], M, t, latency=latency)
+        hist = tracer.latency[(0,)]
+        self.assertEqual(hist.total_M, 20)
+        self.assertGreaterEqual(hist.quantile(1.), 0.05)
+        self.assertLess(hist.quantile(0.9), 0.05 / 20)
+
+    def test_block_average(self):
+        # Samplers that do not time their samples
+        tracer = Tracer()
+        tracer.addSampleBlock([1], 10, 1e-2)
+        hist = tracer.latency[(1,)]
+        self.assertEqual(hist.total_M, 10)
+        self.assertEqual(np.count_nonzero(hist.counts), 1)
+        self.assertAlmostEqual(hist.mean(), 1e-3)
+
+
+    def test_untimed(self):
+        # Without a tracer the samples are not timed one by one
+        res = mimc.GenericSampleLvl(lambda inds: np.ones(len(inds)), [1, 2],
+                                    np.array([1.]), [[0]], 20, batch_size=8)
+        self.assertEqual(len(res), 3)
+        self.assertEqual(res[0], 20)
+
+
+class TestHooks(unittest.TestCase):
+    def test_without_trace(self):
+        run = mimc.MIMCRun(dim=1, moments=2, reuse_samples=True,
+                           bayesian=False, w=[1.], s=[1.], gamma=[1.],
+                           beta=[2.], TOL=0.1, max_TOL=0.1, max_add_itr=0,
+                           r1=2, r2=1.1, h0inv=[2], M0=10, min_lvls=2, Ca=3,
+                           theta=0.5, abs_bnd=False, const_theta=False,
+                           verbose=False)
+        self.assertIsNone(run.tracer)
+        events = []
+        run.addTraceHook(lambda name, start, t, args: events.append(name))
+        run.setFunctions(fnSampleQoI=lambda inds: 1 + 2.**-np.array(inds)[:, 0]
+                         + np.random.normal()*0.1)
+        run.doRun()
+        self.assertIn("sample", events)
+        self.assertIn("estimate", events)
+        # Events are passed to the hooks without being kept
+        self.assertEqual(run.tracer.events, [])
+
+if __name__ == '__main__':
+    unittest.main()